@@ -29,6 +29,7 @@ from abkhazia.commands.abkhazia_language import AbkhaziaLanguage
 from abkhazia.commands.abkhazia_decode import AbkhaziaDecode
 from abkhazia.commands.abkhazia_prepare import AbkhaziaPrepare
 from abkhazia.commands.abkhazia_split import AbkhaziaSplit
+from abkhazia.commands.abkhazia_shard import AbkhaziaShard
 from abkhazia.commands.abkhazia_plot import AbkhaziaPlot
 from abkhazia.commands.abkhazia_features import AbkhaziaFeatures
 from abkhazia.commands.abkhazia_merge_wavs import AbkhaziaMergeWavs
@@ -18,6 +18,9 @@ import os
 
 from abkhazia.commands.abstract_command import AbstractCoreCommand
 from abkhazia.corpus import Corpus
+from abkhazia.corpus.corpus_filter import CorpusFilter
+from abkhazia.corpus.corpus_query import CorpusQuery
+from abkhazia.corpus.corpus_validation import CorpusValidation
 import abkhazia.utils as utils
 
 
@@ -65,9 +68,77 @@ class AbkhaziaFilter(AbstractCoreCommand):
             '--THCHS30', action='store_true',
             help='''Set to true if treating the THCHS30 corpus, to avoid
             repetition of text between speakers.''')
+        group.add_argument(
+            '-j', '--njobs', type=int, default=utils.default_njobs(),
+            metavar='<njobs>',
+            help='number of wavs to trim in parallel with --trim. '
+            'Default is to launch %(default)s jobs.')
+
+        group = parser.add_argument_group(
+            'signal filter arguments', description='''
+            remove the utterances with a bad signal quality, as computed
+            by "abkhazia validate --signal". This filter is applied
+            before the duration filter (if any)''')
+
+        group.add_argument(
+            '--signal-qc', metavar='<qc-file>', default=None,
+            help='the signal QC table to filter the utterances from, '
+            'default is the table written by "abkhazia validate --signal" '
+            'in the corpus data directory, i.e. {}'.format(
+                CorpusValidation.signal_qc_path('<corpus>/data')))
+
+        group.add_argument(
+            '--max-clipping', type=float, metavar='<ratio>',
+            help='maximal proportion of clipped samples in an utterance')
+
+        group.add_argument(
+            '--max-dc-offset', type=float, metavar='<amplitude>',
+            help='maximal DC offset of an utterance, in [0, 1]')
+
+        group.add_argument(
+            '--max-silence', type=float, metavar='<ratio>',
+            help='maximal proportion of silent frames in an utterance')
+
+        group.add_argument(
+            '--min-rms', type=float, metavar='<amplitude>',
+            help='minimal RMS amplitude of an utterance, in [0, 1]')
+
+        group = parser.add_argument_group(
+            'query filter arguments', description='''
+            keep the utterances matching a predicate such as "duration
+            > 0.5 and oov_rate < 0.1 and speaker in @speakers". The
+            predicate supports comparisons, the "and", "or", "not"
+            and "in" operators, numbers and quoted strings, on the
+            columns: {}. This filter is applied after the signal
+            filter and before the duration filter (if any)'''.format(
+                ', '.join(sorted(CorpusQuery.columns))))
+
+        group.add_argument(
+            '-q', '--query', metavar='<predicate>', default=None,
+            help='the predicate the kept utterances must match')
+
+        group.add_argument(
+            '--var', metavar='<name>=<file>', action='append', default=[],
+            help='define the collection @<name> used in the query, '
+            'made of the first word of each line in <file>. '
+            'This option can be repeated')
 
         return parser
 
+    @classmethod
+    def _load_variables(cls, variables):
+        """Return a dict name: list from the --var arguments"""
+        loaded = {}
+        for var in variables:
+            name, _, filename = var.partition('=')
+            if not name or not filename:
+                raise IOError(
+                    'invalid variable "{}", must be <name>=<file>'
+                    .format(var))
+            loaded[name] = [line.split()[0] for line in utils.open_utf8(
+                filename, 'r') if line.strip()]
+        return loaded
+
     @classmethod
     def run(cls, args):
         corpus_dir, output_dir = cls._parse_io_dirs(args)
@@ -76,6 +147,34 @@ class AbkhaziaFilter(AbstractCoreCommand):
 
         corpus = Corpus.load(corpus_dir, validate=args.validate, log=log)
 
+        thresholds = dict(
+            max_clipping=args.max_clipping,
+            max_dc_offset=args.max_dc_offset,
+            max_silence=args.max_silence,
+            min_rms=args.min_rms)
+        signal = args.signal_qc or any(
+            t is not None for t in thresholds.values())
+        query = (CorpusQuery(
+            args.query, variables=cls._load_variables(args.var))
+                 if args.query else None)
+
+        qc = None
+        if signal or (query and query.needs_signal_qc()):
+            qc = CorpusValidation.load_signal_qc(
+                args.signal_qc or CorpusValidation.signal_qc_path(corpus_dir))
+
+        if signal:
+            corpus, _ = CorpusFilter(corpus, log=log).filter_signal(
+                qc, **thresholds)
+
+        if query:
+            corpus, _ = CorpusFilter(corpus, log=log).filter_query(
+                query, signal_qc=qc)
+
+        if (signal or query) and not args.function:
+            corpus.save(os.path.join(output_dir, 'data'))
+            return
+
         # retrieve the test proportion
         (subcorpus, not_kept_utterances) = corpus.create_filter(
                 output_dir,
@@ -95,4 +194,4 @@ class AbkhaziaFilter(AbstractCoreCommand):
                     no_wavs=True, copy_wavs=False)
             subcorpus.trim(
                     corpus_dir, output_dir,
-                    args.function, not_kept_utterances)
+                    args.function, not_kept_utterances, njobs=args.njobs)
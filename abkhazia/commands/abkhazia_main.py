@@ -34,6 +34,7 @@ from abkhazia.commands import (
     AbkhaziaPrepare,
     AbkhaziaFeatures,
     AbkhaziaSplit,
+    AbkhaziaShard,
     AbkhaziaMergeWavs,
     AbkhaziaPlot,
     AbkhaziaFilter,
@@ -50,6 +51,7 @@ class Abkhazia(object):
         AbkhaziaValidate,
         AbkhaziaPrepare,
         AbkhaziaSplit,
+        AbkhaziaShard,
         AbkhaziaMergeWavs,
         AbkhaziaPlot,
         AbkhaziaFilter,
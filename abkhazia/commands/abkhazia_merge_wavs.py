@@ -34,6 +34,24 @@ class AbkhaziaMergeWavs(AbstractCoreCommand):
 
         group = parser.add_argument_group('merge_wavs arguments')
 
+        group.add_argument(
+            '-p', '--padding', type=float, default=0., metavar='<seconds>',
+            help='duration of silence inserted between two merged wavs, '
+            'default is %(default)s')
+
+        group.add_argument(
+            '--virtual', action='store_true',
+            help='do not write the merged wavs but only describe them '
+            'in <output-dir>/data/merged_wavs.txt as the list of the wavs '
+            'they are made of. The Kaldi recipes concatenate them on the '
+            'fly with sox, so no audio is duplicated on disk')
+
+        group.add_argument(
+            '-j', '--njobs', type=int, default=utils.default_njobs(),
+            metavar='<njobs>',
+            help='number of speakers to merge in parallel. '
+            'Default is to launch %(default)s jobs.')
+
         return parser
 
     @classmethod
@@ -44,7 +62,7 @@ class AbkhaziaMergeWavs(AbstractCoreCommand):
 
         corpus = Corpus.load(corpus_dir, validate=args.validate, log=log)
 
-        corpus.merge_wavs(corpus_dir,output_dir)
-        
-        corpus.save(os.path.join(output_dir,'data'),no_wavs=True)
-
+        # the merged corpus is saved in output_dir/data
+        corpus.merge_wavs(
+            os.path.join(output_dir, 'data'), log=log,
+            padding=args.padding, njobs=args.njobs, virtual=args.virtual)
@@ -32,7 +32,9 @@ class AbkhaziaPlot(AbstractCoreCommand):
         log = utils.logger.get_log(
             os.path.join(output_dir, 'filter.log'), verbose=args.verbose)
 
-        corpus = Corpus.load(corpus_dir, validate=args.validate, log=log)
+        # only segments and utt2spk are needed for plotting
+        corpus = Corpus.load(
+            corpus_dir, validate=args.validate, lazy=True, log=log)
         
         corpus_plot = corpus.plot()
 
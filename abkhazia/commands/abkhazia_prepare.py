@@ -21,6 +21,7 @@ import textwrap
 
 import abkhazia.utils as utils
 from abkhazia.commands.abstract_command import AbstractCommand
+from abkhazia.corpus.corpus_saver import CorpusSaver
 
 # import all the corpora preparators
 from abkhazia.corpus.prepare import (
@@ -188,8 +189,9 @@ class AbstractFactory(object):
         # format. Redirect the log to the preparator logger
         corpus.validate(njobs=args.njobs)
 
-        # save the corpus to the output directory
-        corpus.save(output_dir, no_wavs=True)
+        # save the corpus to the output directory, along with the
+        # prepared wavs and the preparation logs
+        CorpusSaver.save(corpus, output_dir, no_wavs=True)
 
     @classmethod
     def run(cls, args):
@@ -495,8 +497,9 @@ class KCSSFactory(AbstractFactory):
         # format. Redirect the log to the preparator logger
         corpus.validate(njobs=args.njobs)
 
-        # save the corpus to the output directory
-        corpus.save(output_dir, no_wavs=True)
+        # save the corpus to the output directory, along with the
+        # prepared wavs and the preparation logs
+        CorpusSaver.save(corpus, output_dir, no_wavs=True)
 
         # save the alignment
         if not args.no_alignment:
@@ -0,0 +1,81 @@
+# Copyright 2016 Thomas Schatz, Xuan-Nga Cao, Mathieu Bernard
+#
+# This file is part of abkhazia: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Abkhazia is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with abkhazia. If not, see <http://www.gnu.org/licenses/>.
+"""Implementation of the 'abkazia shard' command"""
+
+import os
+
+from abkhazia.commands.abstract_command import AbstractCoreCommand
+from abkhazia.corpus import Corpus
+from abkhazia.corpus.corpus_shards import CorpusShards
+import abkhazia.utils as utils
+
+
+class AbkhaziaShard(AbstractCoreCommand):
+    '''This class implements the 'abkhazia shard' command'''
+    name = 'shard'
+    description = 'split a corpus in shards or merge shards back'
+
+    @classmethod
+    def add_parser(cls, subparsers):
+        # get basic parser init from AbstractCommand
+        parser, _ = super(AbkhaziaShard, cls).add_parser(subparsers)
+
+        group = parser.add_argument_group('shard arguments')
+
+        group.add_argument(
+            '-n', '--nshards', type=int, metavar='<n>', default=2,
+            help='number of shards to create, default is %(default)s')
+
+        group.add_argument(
+            '-b', '--by', choices=['speakers', 'duration'],
+            default='speakers',
+            help='''the speakers are distributed over the shards so that
+            the shards are balanced in number of utterances (speakers)
+            or in speech duration (duration), default is %(default)s''')
+
+        group.add_argument(
+            '--copy-wavs', action='store_true',
+            help='copy the wavs in the shards instead of linking them')
+
+        group.add_argument(
+            '-m', '--merge', action='store_true',
+            help='''merge the shards back: <corpus> is a directory
+            written by "abkhazia shard" and the merged corpus is wrote
+            to <output-dir>/data, if not specified use
+            <output-dir>=<corpus>/merged''')
+
+        return parser
+
+    @classmethod
+    def run(cls, args):
+        if args.merge:
+            shards_dir = cls._parse_corpus_dir(args.corpus)
+            output_dir = cls._parse_output_dir(
+                args.output_dir, shards_dir, name='merged', force=args.force)
+            log = utils.logger.get_log(
+                os.path.join(output_dir, 'shard.log'), verbose=args.verbose)
+
+            CorpusShards.merge(
+                shards_dir, os.path.join(output_dir, 'data'), log=log)
+            return
+
+        corpus_dir, output_dir = cls._parse_io_dirs(args)
+        log = utils.logger.get_log(
+            os.path.join(output_dir, 'shard.log'), verbose=args.verbose)
+
+        corpus = Corpus.load(corpus_dir, validate=args.validate, log=log)
+        shards = corpus.shard(args.nshards, by=args.by)
+        CorpusShards.save(
+            shards, output_dir, by=args.by, copy_wavs=args.copy_wavs)
@@ -62,16 +62,63 @@ class AbkhaziaSplit(AbstractCoreCommand):
             'use the current system time). Use this option to compute a '
             'reproducible split')
 
+        group = parser.add_argument_group(
+            'split by duration arguments', description='''
+            split the corpus by speech duration instead of proportions
+            (the options --test-prop and --train-prop are then ignored)''')
+
+        group.add_argument(
+            '--test-hours', type=float, metavar='<hours>', default=None,
+            help='duration of speech to include in the test set')
+
+        group.add_argument(
+            '--train-hours', type=float, metavar='<hours>', default=None,
+            help='duration of speech to include in the train set, '
+            'if not specified the train set is made of all the speech '
+            'not in the test set')
+
+        group.add_argument(
+            '--strata', metavar='<file>', default=None,
+            help='a file with lines "<speaker-id> <stratum>" (e.g. the '
+            'speakers gender), each stratum contributes to the train and '
+            'test sets proportionally to its speech duration. Requires '
+            '--by-speakers')
+
         return parser
 
     @classmethod
     def run(cls, args):
+        if args.test_hours is None and args.train_hours is not None:
+            raise IOError('--train-hours requires --test-hours')
+        if args.strata and not args.by_speakers:
+            raise IOError('--strata requires --by-speakers')
+
         corpus_dir, output_dir = cls._parse_io_dirs(args)
         log = utils.logger.get_log(
             os.path.join(output_dir, 'split.log'), verbose=args.verbose)
 
         corpus = Corpus.load(corpus_dir, validate=args.validate, log=log)
 
+        if args.test_hours is not None:
+            strata = None
+            if args.strata:
+                strata = dict(
+                    line.split() for line in utils.open_utf8(
+                        args.strata, 'r') if line.strip())
+
+            train, test = corpus.split_by_duration(
+                args.test_hours * 3600,
+                train_duration=(
+                    None if args.train_hours is None
+                    else args.train_hours * 3600),
+                by_speakers=args.by_speakers,
+                strata=strata,
+                random_seed=args.random_seed)
+
+            train.save(os.path.join(output_dir, 'train', 'data'))
+            test.save(os.path.join(output_dir, 'test', 'data'))
+            return
+
         # retrieve the test proportion
         if args.train_prop is None:
             test_prop = (
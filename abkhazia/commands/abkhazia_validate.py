@@ -22,6 +22,7 @@ import textwrap
 
 from abkhazia.commands.abstract_command import AbstractCommand
 from abkhazia.corpus import Corpus
+from abkhazia.corpus.corpus_validation import CorpusValidation
 import abkhazia.utils as utils
 
 
@@ -56,7 +57,20 @@ class AbkhaziaValidate(AbstractCommand):
 
         parser.add_argument(
             'corpus', metavar='<corpus>',
-            help='Directory where the corpus to validate is stored.')
+            help='Directory where the corpus to validate is stored, '
+            'either <corpus> or <corpus>/data.')
+
+        parser.add_argument(
+            '--full', action='store_true',
+            help='check the whole corpus, by default the checks already '
+            'passed by unchanged corpus files are skipped')
+
+        parser.add_argument(
+            '--signal', action='store_true',
+            help='also compute signal statistics (clipping, DC offset, '
+            'silence) on each utterance and write them in the corpus data '
+            'directory, i.e. {}, where "abkhazia filter" reads them by '
+            'default'.format(CorpusValidation.signal_qc_path('<corpus>/data')))
 
         return parser
 
@@ -81,10 +95,15 @@ class AbkhaziaValidate(AbstractCommand):
     @classmethod
     def run(cls, args):
         corpus_dir = cls._parse_corpus_dir(args.corpus)
+        if os.path.isdir(os.path.join(corpus_dir, 'data')):
+            corpus_dir = os.path.join(corpus_dir, 'data')
 
         log = utils.logger.get_log(verbose=True)
         try:
-            Corpus.load(corpus_dir, validate=True, log=log)
+            corpus = Corpus.load(corpus_dir, log=log)
+            corpus.validate(full=args.full)
+            if args.signal:
+                CorpusValidation(corpus, log=log).validate_signal()
             log.info('corpus is valid')
             sys.exit(0)
         except IOError as err:
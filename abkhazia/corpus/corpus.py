@@ -22,9 +22,11 @@ from abkhazia.corpus.corpus_saver import CorpusSaver
 from abkhazia.corpus.corpus_loader import CorpusLoader
 from abkhazia.corpus.corpus_validation import CorpusValidation
 from abkhazia.corpus.corpus_split import CorpusSplit
+from abkhazia.corpus.corpus_shards import CorpusShards
 from abkhazia.corpus.corpus_merge_wavs import CorpusMergeWavs
 from abkhazia.corpus.corpus_filter import CorpusFilter
 from abkhazia.corpus.corpus_trimmer import CorpusTrimmer
+from abkhazia.corpus import corpus_tables
 import abkhazia.utils as utils
 
 
@@ -49,6 +51,16 @@ class Corpus(utils.abkhazia_base.AbkhaziaBase):
     - basename of the corpus wav files
     - exemple: ('s01.wav')
 
+    merged_wavs: dict(wav_id, [(wav_id, offset, duration)])
+    -------------------------------------------------------
+
+    - virtual wavs made of the concatenation of wavs in wav_folder,
+      as produced by a virtual merge (see merge_wavs). Optional,
+      stored in merged_wavs.txt
+    - the offset and duration of each wav in the virtual one are in
+      seconds, as float
+    - exemple: ('s01.wav', [('s01a.wav', 0, 12.5), ('s01b.wav', 12.5, 3)])
+
     lexicon: dict(word, phones)
     ---------------------------
 
@@ -96,20 +108,86 @@ class Corpus(utils.abkhazia_base.AbkhaziaBase):
     - alternative phones variants (not yet implemented)
     - exemple: []
 
+    Compact representation
+    ======================
+
+    On large corpora, segments, text, utt2spk and lexicon can be
+    stored in array-backed tables instead of dicts (see the
+    compact() method and the corpus_tables module). They expose the
+    same mapping interface so the corpus behaves the same, but ids
+    are interned to integers and values stored in numpy arrays.
+
+    Cached data
+    ===========
+
+    The durations of the wav files are memoized in a
+    utils.wav.DurationCache. For a corpus loaded from (or saved to) a
+    directory, the cache is persisted in the 'cache' subdirectory
+    (see the `cache_dir` attribute), so the wavs are not read again
+    from one session to another.
+
+    The wavs metadata read during validation is kept in the
+    `wavs_meta` attribute and shared with the subcorpora, so
+    validating a subcorpus does not scan the wavs again.
+
+    The indexes derived from the corpus tables (as returned by
+    utts(), spks(), spk2utt(), wav2utt() and words()) are computed
+    once and cached until the tables they are built on are modified.
+    To track their modifications, the dicts assigned to segments,
+    text, utt2spk and lexicon are converted to
+    corpus_tables.TrackedDict.
+
     """
+    tracked = ('segments', 'text', 'utt2spk', 'lexicon')
+    """The corpus tables whose modifications are tracked"""
 
     @classmethod
-    def load(cls, corpus_dir, validate=False, log=utils.logger.null_logger()):
+    def load(cls, corpus_dir, validate=False, compact=False,
+             snapshot=True, lazy=False, njobs=None,
+             log=utils.logger.null_logger()):
         """Return a corpus initialized from `corpus_dir`
 
         If validate is True, make sure the corpus is valid before
         returning it.
 
+        If compact is True, segments, text, utt2spk and lexicon are
+        loaded in array-backed tables instead of dicts (see the
+        compact() method).
+
+        If snapshot is True and the corpus has been saved with a
+        snapshot (see the save() method) that is still up to date
+        with the text files, load the corpus from that snapshot. This
+        is much faster than parsing the text files and the loaded
+        corpus is compact.
+
+        If lazy is True, the corpus attributes are parsed from their
+        file only when first accessed (see the load_on_access()
+        method). This is useful when only a part of the corpus is
+        needed, as plotting durations does not need text nor lexicon.
+        Else the corpus files are read concurrently by njobs threads
+        (default to one thread per file).
+
         Raise IOError if corpus_dir if an invalid directory, the
         output corpus is not validated.
 
         """
-        return CorpusLoader.load(cls, corpus_dir, validate=validate, log=log)
+        return CorpusLoader.load(
+            cls, corpus_dir, validate=validate, compact=compact,
+            snapshot=snapshot, lazy=lazy, njobs=njobs, log=log)
+
+    @staticmethod
+    def iter_utterances(corpus_dir):
+        """Yield the utterances of the corpus in `corpus_dir`
+
+        The utterances are streamed from the corpus files, without
+        loading the corpus in memory. Each utterance is yielded as a
+        named tuple (utt_id, speaker, wav, start, stop, text), see
+        CorpusLoader.iter_utterances for details.
+
+        Raise IOError if corpus_dir is an invalid directory.
+
+        """
+        return CorpusLoader.iter_utterances(corpus_dir)
 
     def __init__(self, log=utils.logger.null_logger()):
         """Initialize an empty corpus"""
@@ -117,6 +195,11 @@ class Corpus(utils.abkhazia_base.AbkhaziaBase):
 
         self.wav_folder = ''
         self.wavs = set()
+
+        # virtual wavs mapped to the list of (wav, offset, duration)
+        # they are made of, the wavs being in wav_folder (see
+        # merge_wavs)
+        self.merged_wavs = dict()
         self.lexicon = dict()
         self.segments = dict()
         self.text = dict()
@@ -125,7 +208,63 @@ class Corpus(utils.abkhazia_base.AbkhaziaBase):
         self.silences = []
         self.variants = []
 
-    def save(self, path, no_wavs=False, copy_wavs=True, force=False):
+        # directory where to persist cached data, None to disable
+        # persistence (see Corpus.load)
+        self.cache_dir = None
+        self.wav_durations = utils.wav.DurationCache()
+
+        # metadata of the wav files (as returned by utils.wav.scan)
+        # filled during validation, shared with subcorpora. Each entry
+        # is stored with the (size, mtime in ns) of the file it has
+        # been read from
+        self.wavs_meta = {}
+
+        # derived indexes cached by _memoize()
+        self._indexes = {}
+
+        # attributes not yet loaded, mapped to their loader
+        self._lazy = {}
+
+    def __setattr__(self, name, value):
+        # track the modifications of the tables to invalidate the
+        # cached indexes (see _memoize)
+        if name in self.tracked and type(value) is dict:
+            value = corpus_tables.TrackedDict(value)
+        super(Corpus, self).__setattr__(name, value)
+
+    def __getattr__(self, name):
+        # called only when `name` is not found as a regular attribute:
+        # load it if it is registered as a lazy attribute
+        lazy = self.__dict__.get('_lazy', {})
+        if name not in lazy:
+            raise AttributeError(
+                "'{}' object has no attribute '{}'".format(
+                    self.__class__.__name__, name))
+
+        self.log.debug('loading corpus %s', name)
+        value = lazy.pop(name)()
+        setattr(self, name, value)
+        return value
+
+    def __getstate__(self):
+        # loaders cannot be pickled, load all the attributes first
+        for name in list(self._lazy):
+            getattr(self, name)
+        return self.__dict__
+
+    def load_on_access(self, name, loader):
+        """Load the attribute `name` only when it is first accessed
+
+        `loader` is a function with no argument returning the value
+        of the attribute. Any previous value of the attribute is
+        discarded.
+
+        """
+        self.__dict__.pop(name, None)
+        self._lazy[name] = loader
+
+    def save(self, path, no_wavs=False, copy_wavs=True, force=False,
+             snapshot=False):
         """Save the corpus to the directory `path`
 
         :param str path: The output directory is assumed to be a non
@@ -138,27 +277,74 @@ class Corpus(utils.abkhazia_base.AbkhaziaBase):
             instead of symbolic links
 
         :param bool force: when True, overwrite `path` if it is
-            already existing
+            already existing. Only the corpus files with a modified
+            content are rewritten, any other file in `path` is
+            deleted (see CorpusSaver).
 
-        :raise: OSError if force=False and `path` already exists
+        :param bool snapshot: when True, also write a binary snapshot
+            of the corpus in `path`/cache, making further loadings of
+            the corpus much faster (see CorpusSnapshot)
+
+        :raise: OSError if force=False and `path` already exists (an
+            empty directory is accepted)
 
         """
         self.log.info('saving corpus to %s', path)
 
-        if force and os.path.exists(path):
+        if os.path.exists(path) and not (
+                os.path.isdir(path) and not os.listdir(path)):
+            if not force:
+                raise OSError(
+                    'path already exists, use force=True to overwrite it: {}'
+                    .format(path))
+
             self.log.warning('overwriting existing path: %s', path)
-            utils.remove(path)
+            if not os.path.isdir(path):
+                utils.remove(path)
+            else:
+                CorpusSaver.clean(self, path, no_wavs=no_wavs)
+
+        CorpusSaver.save(self, path, no_wavs=no_wavs, copy_wavs=copy_wavs,
+                         snapshot=snapshot)
+
+    def compact(self):
+        """Convert the corpus to its compact representation
+
+        Segments, text, utt2spk and lexicon are converted in place
+        from dicts to the array-backed tables defined in
+        abkhazia.corpus.corpus_tables. The utterance, speaker, wav and
+        word ids are interned to integer codes, segments are stored in
+        numpy arrays and text as arrays of word codes. This reduces
+        the memory footprint of large corpora.
 
-        CorpusSaver.save(self, path, no_wavs=no_wavs, copy_wavs=copy_wavs)
+        Return the corpus itself. Does nothing if the corpus is
+        already compact.
 
-    def validate(self, njobs=utils.default_njobs()):
+        """
+        if not self.is_compact():
+            tables = corpus_tables.new_tables()
+            for name, table in tables.items():
+                table.extend(getattr(self, name))
+                setattr(self, name, table)
+        return self
+
+    def is_compact(self):
+        """Return True if the corpus uses array-backed tables"""
+        return isinstance(self.segments, corpus_tables.AbstractTable)
+
+    def validate(self, njobs=utils.default_njobs(), full=False):
         """Validate speech corpus data
 
         Raise IOError on the first encoutered error, relies on the
         CorpusValidation class.
 
+        The checks already passed by the corpus data, as recorded in
+        the validation cache, are skipped unless `full` is True (see
+        CorpusValidation).
+
         """
-        CorpusValidation(self, njobs=njobs, log=self.log).validate()
+        CorpusValidation(
+            self, njobs=njobs, log=self.log, full=full).validate()
 
     def is_valid(self, njobs=utils.default_njobs()):
         """Return True if the corpus is in a valid state"""
@@ -168,13 +354,52 @@ class Corpus(utils.abkhazia_base.AbkhaziaBase):
             return False
         return True
 
+    def _memoize(self, name, build, *tables):
+        """Return the index `name` built from the corpus `tables`
+
+        `build` is a function with no argument returning the index,
+        `tables` are the names of the corpus attributes it is built
+        from. The index is cached until one of those attributes is
+        modified or replaced.
+
+        """
+        tables = [getattr(self, table) for table in tables]
+        versions = [corpus_tables.version(table) for table in tables]
+
+        try:
+            cached_tables, cached_versions, index = self._indexes[name]
+            if (None not in versions and versions == cached_versions
+                    and all(a is b for a, b in zip(tables, cached_tables))):
+                return index
+        except KeyError:
+            pass
+
+        index = build()
+        self._indexes[name] = (tables, versions, index)
+        return index
+
     def utts(self):
-        """Return the list of utterance ids stored in the corpus"""
-        return list(self.utt2spk.keys())
+        """Return the list of utterance ids stored in the corpus
+
+        The returned list is a copy owned by the caller and supports
+        O(1) membership tests (see corpus_tables.KeyList). Use
+        has_utt() to test membership without copying the list.
+
+        """
+        return self._utts().copy()
+
+    def has_utt(self, utt):
+        """Return True if `utt` is an utterance id of the corpus"""
+        return utt in self._utts()
+
+    def _utts(self):
+        return self._memoize(
+            'utts', lambda: corpus_tables.KeyList(self.utt2spk.keys()),
+            'utt2spk')
 
     def spks(self):
         """Return the list of speaker ids stored in the corpus"""
-        return list(self.spk2utt().keys())
+        return list(self._spk2utt().keys())
 
     def spk2utt(self):
         """Return a dict of speakers mapped to an utterances list
@@ -184,13 +409,19 @@ class Corpus(utils.abkhazia_base.AbkhaziaBase):
         egs/wsj/s5/utils/utt2spk_to_spk2utt.pl.
 
         """
-        # init an empty list for all speakers
-        spk2utt = {spk: [] for spk in set(self.utt2spk.values())}
+        return {spk: list(utts) for spk, utts in self._spk2utt().items()}
 
-        # populate lists with utterance ids
-        for utt, spk in self.utt2spk.items():
-            spk2utt[spk].append(utt)
-        return spk2utt
+    def _spk2utt(self):
+        def _build():
+            # init an empty list for all speakers
+            spk2utt = {spk: [] for spk in set(self.utt2spk.values())}
+
+            # populate lists with utterance ids
+            for utt, spk in self.utt2spk.items():
+                spk2utt[spk].append(utt)
+            return spk2utt
+
+        return self._memoize('spk2utt', _build, 'utt2spk')
 
     def wav2utt(self):
         """Return a dict of wav-ids mapped to utterances/timestamps they contain
@@ -199,30 +430,50 @@ class Corpus(utils.abkhazia_base.AbkhaziaBase):
         tend). Built on self.segments.
 
         """
-        # init an empty list for all wavs
-        wav2utt = {wav: [] for wav, _, _ in self.segments.values()}
+        def _build():
+            # init an empty list for all wavs
+            wav2utt = {wav: [] for wav, _, _ in self.segments.values()}
+
+            def _float(t):
+                return None if t is None else float(t)
 
-        def _float(t):
-            return None if t is None else float(t)
+            # populate lists with utterance ids and timestamps
+            for utt, (wav, tstart, tend) in self.segments.items():
+                wav2utt[wav].append((utt, _float(tstart), _float(tend)))
+            return wav2utt
 
-        # populate lists with utterance ids and timestamps
-        for utt, (wav, tstart, tend) in self.segments.items():
-            wav2utt[wav].append((utt, _float(tstart), _float(tend)))
-        return wav2utt
+        return {wav: list(utts) for wav, utts in self._memoize(
+            'wav2utt', _build, 'segments').items()}
 
     def utt2duration(self):
         """Return a dict of utterances ids mapped to their duration
 
-        Durations are floats expressed in second, read from wav files
+        Durations are floats expressed in second, read from the
+        segments timestamps or, when missing, from the wav files. The
+        wav durations are cached in self.wav_durations (and persisted
+        in self.cache_dir if any) so each wav is read only once.
+
+        The returned dict is cached until the segments or the wav
+        folder change.
 
         """
-        utt2dur = dict()
-        for utt, (wav, start, stop) in self.segments.items():
-            start = 0 if start is None else start
-            wav_path = os.path.join(self.wav_folder, wav)
-            stop = utils.wav.duration(wav_path) if stop is None else stop
-            utt2dur[utt] = stop - start
-        return utt2dur
+        # resolve links once for all the wavs
+        wav_folder = os.path.realpath(self.wav_folder)
+
+        def _build():
+            utt2dur = dict()
+            for utt, (wav, start, stop) in self.segments.items():
+                start = 0 if start is None else start
+                if stop is None:
+                    stop = self.wav_durations.duration(
+                        os.path.join(wav_folder, wav))
+                utt2dur[utt] = stop - start
+
+            self.wav_durations.save()
+            return utt2dur
+
+        return dict(self._memoize(
+            ('utt2duration', wav_folder), _build, 'segments'))
 
     def duration(self, format='seconds'):
         """Return the total duration of the corpus
@@ -252,9 +503,17 @@ class Corpus(utils.abkhazia_base.AbkhaziaBase):
         a set for search efficiency.
 
         """
-        return set(
-            word for utt in self.text.values() for word in utt.split()
-            if (word in self.lexicon if in_lexicon else True))
+        words = self._memoize(
+            'words', lambda: set(
+                word for utt in self.text.values() for word in utt.split()),
+            'text')
+
+        if in_lexicon:
+            words = self._memoize(
+                'words_in_lexicon',
+                lambda: {w for w in words if w in self.lexicon},
+                'text', 'lexicon')
+        return set(words)
 
     def has_several_utts_per_wav(self):
         """Return True if there is several utterances in at least one wav"""
@@ -269,6 +528,10 @@ class Corpus(utils.abkhazia_base.AbkhaziaBase):
         The returned corpus is validated (except if `validate` is
         False) and pruned (except if `prune` is False).
 
+        The segments, text and utt2spk of the subcorpus are
+        copy-on-write views on the ones of this corpus (see
+        corpus_tables.view), the other attributes are shared.
+
         Raise a KeyError if one utterance in `utt_ids` is in the
         input corpus.
 
@@ -280,7 +543,7 @@ class Corpus(utils.abkhazia_base.AbkhaziaBase):
         corpus.meta.source = self.meta.source
         corpus.meta.name = name if name else 'subcorpus of ' + self.meta.name
         corpus.meta.comment = ('{} utterances from {}'
-                               .format(len(utt_ids), len(self.utts())))
+                               .format(len(utt_ids), len(self._utts())))
 
         corpus.lexicon = self.lexicon
         corpus.phones = self.phones
@@ -289,14 +552,20 @@ class Corpus(utils.abkhazia_base.AbkhaziaBase):
 
         corpus.wav_folder = self.wav_folder
         corpus.wavs = self.wavs
+        corpus.merged_wavs = self.merged_wavs
+        corpus.cache_dir = self.cache_dir
+        corpus.wav_durations = self.wav_durations
 
-        corpus.segments = dict()
-        corpus.text = dict()
-        corpus.utt2spk = dict()
-        for utt in utt_ids:
-            corpus.segments[utt] = self.segments[utt]
-            corpus.text[utt] = self.text[utt]
-            corpus.utt2spk[utt] = self.utt2spk[utt]
+        # the wavs metadata collected during validation is shared with
+        # the parent corpus, so the wavs are scanned only once
+        corpus.wavs_meta = self.wavs_meta
+
+        # the utterances indexed tables are copy-on-write views on the
+        # parent ones, no data is copied unless a view is modified
+        utt_ids = list(utt_ids)
+        corpus.segments = corpus_tables.view(self.segments, utt_ids)
+        corpus.text = corpus_tables.view(self.text, utt_ids)
+        corpus.utt2spk = corpus_tables.view(self.utt2spk, utt_ids)
 
         if prune:
             corpus.prune()
@@ -316,7 +585,7 @@ class Corpus(utils.abkhazia_base.AbkhaziaBase):
         If prune_lexicon is True, it also prunes the lexicon and
         phoneset.
         """
-        utts = set(self.utts())
+        utts = self._utts()
 
         # prune utterance indexed dicts from the utterances list
         for d in (self.segments, self.text, self.utt2spk):
@@ -433,6 +702,54 @@ class Corpus(utils.abkhazia_base.AbkhaziaBase):
                      else spliter.split_by_speakers)
         return split_fun(train_prop, test_prop)
 
+    def split_by_duration(self, test_duration, train_duration=None,
+                          by_speakers=True, strata=None, random_seed=None):
+        """Split a corpus in train and testing subcorpora of given durations
+
+        Return a pair (train, testing) of Corpus instances, validated
+        and pruned. Durations are in seconds, if `train_duration` is
+        None the train subcorpus is made of all the data not in the
+        testing one. See CorpusSplit.split_by_duration for details.
+
+        random_seed : seed for pseudo-random numbers generation (default
+          is to use the current system time)
+
+        """
+        spliter = CorpusSplit(self, random_seed=random_seed, prune=True)
+        return spliter.split_by_duration(
+            test_duration, train_duration=train_duration,
+            by_speakers=by_speakers, strata=strata)
+
+    def kfold(self, k, by_speakers=True, random_seed=None):
+        """Yield the `k` (train, testing) pairs of a k-fold split
+
+        The corpus is partitioned in `k` folds, each one being the
+        testing subcorpus of a pair. The subcorpora are pruned but not
+        validated (the corpus is assumed to be valid).
+
+        by_speakers : bool, if True the data for each speaker is in a
+          single fold, else the utterances of each speaker are
+          distributed over all the folds (default is True).
+
+        random_seed : seed for pseudo-random numbers generation (default
+          is to use the current system time)
+
+        """
+        spliter = CorpusSplit(
+            self, log=self.log, random_seed=random_seed, validate=False)
+        return spliter.kfold(k, by_speakers=by_speakers)
+
+    def shard(self, nshards, by='speakers'):
+        """Split the corpus in `nshards` subcorpora
+
+        Return a list of Corpus instances, validated and pruned. Each
+        speaker is in a single shard and the shards are balanced in
+        number of utterances (if `by` is 'speakers') or in duration
+        (if `by` is 'duration'). See CorpusShards for details.
+
+        """
+        return CorpusShards(self, log=self.log).shard(nshards, by=by)
+
     def phonemize(self):
         """Return a phonemized version of the corpus
 
@@ -449,6 +766,9 @@ class Corpus(utils.abkhazia_base.AbkhaziaBase):
         corpus.meta.name = 'phonemized version of ' + self.meta.name
         corpus.wav_folder = self.wav_folder
         corpus.wavs = self.wavs
+        corpus.merged_wavs = self.merged_wavs
+        corpus.cache_dir = self.cache_dir
+        corpus.wav_durations = self.wav_durations
         corpus.segments = self.segments
         corpus.phones = self.phones
         corpus.utt2spk = self.utt2spk
@@ -529,12 +849,43 @@ class Corpus(utils.abkhazia_base.AbkhaziaBase):
 
         return(plt)
 
-    def merge_wavs(self, output_dir, log=None, padding=0.):
+    def merge_wavs(self, output_dir, log=None, padding=0., njobs=1,
+                   virtual=False):
         """ Merge all wav files from same speaker
-        Returns a corpus with one wav file per speaker """
+        Returns a corpus with one wav file per speaker
+
+        The speakers are merged in parallel over `njobs` processes. If
+        `virtual` is True, no audio is written: the merged wavs are
+        only described in self.merged_wavs """
         if log is None:
             log = self.log
-        CorpusMergeWavs(self, log=log).merge_wavs(output_dir, padding)
+        CorpusMergeWavs(self, log=log, njobs=njobs).merge_wavs(
+            output_dir, padding, virtual=virtual)
+
+    def wav_files(self):
+        """Return the set of the files in wav_folder used by the corpus
+
+        These are the corpus wavs, the virtual merged wavs being
+        replaced by the files they are made of (see merged_wavs).
+
+        """
+        files = set()
+        for wav in self.wavs:
+            if wav in self.merged_wavs:
+                files.update(w for w, _, _ in self.merged_wavs[wav])
+            else:
+                files.add(wav)
+        return files
+
+    def query(self, query, variables=None, signal_qc=None):
+        """Return a subcorpus of the utterances matching `query`
+
+        `query` is a predicate over the utterances such as 'duration
+        > 0.5 and speaker in @speakers', see CorpusQuery for details.
+
+        """
+        return CorpusFilter(self, log=self.log).filter_query(
+            query, variables=variables, signal_qc=signal_qc)[0]
 
     def create_filter(self, out_path, function,
                       nb_speaker=None, new_speakers=10, THCHS30=False):
@@ -542,8 +893,9 @@ class Corpus(utils.abkhazia_base.AbkhaziaBase):
         return(CorpusFilter(self).create_filter(
             out_path, function, nb_speaker, new_speakers, THCHS30))
 
-    def trim(self, corpus_dir, output_dir, function, not_kept_utts):
+    def trim(self, corpus_dir, output_dir, function, not_kept_utts,
+             njobs=1):
         """ Remove utterances from the corpus
-            (using sox to trim the wav files)"""
-        CorpusTrimmer(self).trim(
+            (trimming the wav files in `njobs` parallel processes)"""
+        CorpusTrimmer(self, log=self.log, njobs=njobs).trim(
                 corpus_dir, output_dir, function, not_kept_utts)
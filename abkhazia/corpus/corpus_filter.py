@@ -17,7 +17,10 @@
 import os
 
 from collections import defaultdict
-from math import exp
+
+import numpy as np
+
+from abkhazia.corpus.corpus_query import CorpusQuery
 from abkhazia.utils import logger, open_utf8
 
 
@@ -62,9 +65,79 @@ class CorpusFilter(object):
         self.limits = dict()
         self.gender = dict()
         self.spk2utts = dict()
+        self._arrays = None
         self.log.debug('loaded %i utterances from %i speakers',
                        self.size, len(self.speakers))
 
+    def _utterances(self):
+        """Return the utterances as arrays sorted by speaker and start time
+
+        Return the tuple (utts, speakers, codes, durations, bounds):
+        utts and durations are arrays of utterances ids and durations
+        (in seconds), speakers is the sorted array of speakers ids,
+        codes is the index in speakers of each utterance and bounds
+        the index of the first utterance of each speaker. The arrays
+        are computed once and cached.
+
+        """
+        if self._arrays is None:
+            utt2dur = self.corpus.utt2duration()
+            segments = self.corpus.segments
+            utt2spk = self.corpus.utt2spk
+
+            utts = np.asarray(sorted(utt2spk))
+            speakers, codes = np.unique(
+                [utt2spk[utt] for utt in utts], return_inverse=True)
+            starts = np.fromiter(
+                (segments[utt][1] or 0 for utt in utts),
+                dtype=float, count=len(utts))
+            durations = np.fromiter(
+                (utt2dur[utt] for utt in utts), dtype=float, count=len(utts))
+
+            order = np.lexsort((starts, codes))
+            codes = codes[order]
+            self._arrays = (
+                utts[order], speakers, codes, durations[order],
+                np.searchsorted(codes, np.arange(len(speakers))))
+        return self._arrays
+
+    @staticmethod
+    def _cumsum_by_speaker(values, codes, bounds):
+        """Cumulated sum of `values` restarting at each speaker"""
+        cumsum = np.cumsum(values)
+        return cumsum - np.concatenate(([0], cumsum))[bounds][codes]
+
+    @staticmethod
+    def _cutting_distribution(function, times, new_speakers=10):
+        """Return the speech duration to keep for each speaker
+
+        `times` is the speech duration of each speaker, sorted from
+        longest to shortest. Raise IOError if `function` is not
+        'exponential', 'power-law', 'step' or 'nothing'.
+
+        """
+        index = np.arange(len(times))
+        if function == 'exponential':
+            return times[0] * np.exp(-0.4 * (index - 1))
+        elif function == 'power-law':
+            exponent = 1
+            return times[0] / (index + 1) ** exponent + 30
+        elif function == 'step':
+            # number of speaker for which we keep the whole speech
+            spk_threshold = (
+                len(times) if new_speakers is None else new_speakers)
+
+            # duration of speech we keep for the other speakers :
+            dur_threshold = 10 * 60
+            return np.where(
+                index < spk_threshold, times,
+                np.minimum(times, dur_threshold))
+        elif function == 'nothing':
+            return times
+        raise IOError(
+            'unknown filtering function {}, must be exponential, '
+            'power-law, step or nothing'.format(function))
+
     def create_filter(self, out_path, function,
                       nb_speaker=None,
                       new_speakers=10, THCHS30=False):
@@ -75,80 +148,28 @@ class CorpusFilter(object):
            If plot=True, a plot of the speech duration
            distribution and of the cutting function will be displayed.
         """
-        utt2spk = self.corpus.utt2spk
-        utt2dur = self.corpus.utt2duration()
-        spkr2dur = dict()
+        _, speakers, codes, durations, _ = self._utterances()
         self.log.info('sorting speaker by the total duration of speech')
 
         # Sort Speech duration from longest to shortest
-        spk2utts_temp = defaultdict(list)
-        spk2utts = defaultdict(list)
-
-        for spkr in self.speakers:
-            spkr2dur[spkr] = sum([utt2dur[utt_id]
-                                  for utt_id in utt2spk
-                                  if utt2spk[utt_id] == spkr])
-        sorted_speaker = sorted(spkr2dur.items(),
-                                key=lambda k, v: (v, k))
-        sorted_speaker.reverse()
-
-        # For the LibriSpeech corpus, read SPEAKER.TXT to find the genders :
-        # male=set()
-        # self.librispeech_gender(
-        # path='/home/julien/workspace/\
-        #        data/librispeech-raw/LibriSpeech/SPEAKERS.TXT')
-        # for speaker in speakers:
-        #    try:
-        #        self.gender[speaker]
-        #    except:
-        #        continue
-        #    if self.gender[speaker]=='M':
-        #        male.add(speaker)
+        spk_durations = np.bincount(
+            codes, weights=durations, minlength=len(speakers))
+        order = np.lexsort(
+            (np.arange(len(speakers)), spk_durations))[::-1]
 
         # if specified, reduce the number of speakers
         if nb_speaker:
-            if nb_speaker < 1 or nb_speaker > len(sorted_speaker):
+            if nb_speaker < 1 or nb_speaker > len(order):
                 self.log.info(
                     'Invalid number of speaker, keeping all speakers')
-                nb_speaker = len(sorted_speaker)
-            sorted_speaker = sorted_speaker[0:nb_speaker]
-
-        # Create distribution according to decided function
-        names = [spk_id for (spk_id, duration) in sorted_speaker]
-        times = [duration for (spk_id, duration) in sorted_speaker]
-
-        total = self.corpus.duration(format='seconds')
-        x_axis = range(0, len(names))
+                nb_speaker = len(order)
+            order = order[0:nb_speaker]
 
         # Compute the distribution used to cut the corpus
-        if function == "exponential":
-            distrib = [duration0*exp(-0.4*(ind-1)) for ind in x_axis]
-        elif function == "power-law":
-            exponent = 1
-            distrib = [duration0/((ind)**exponent) + 30 for ind in x_axis]
-        elif function == "step":
-            # number of speaker for which we keep the whole speech
-            spk_threshold = new_speakers
-
-            # duration of speech we keep for the other speakers :
-            dur_threshold = 10 * 60
-            distrib = times[0:spk_threshold]
-            t_outsiders = [dur_threshold] * (len(times) - spk_threshold)
-
-            distrib[spk_threshold + 1:len(times)] = t_outsiders
-            distrib = [dist
-                       if dist <= dur else dur
-                       for dist, dur in zip(distrib, times)]
-
-            # keep the speakers in the "family", to construct the test part
-            family_temp = sorted_speaker[0:spk_threshold]
-            family = [speaker for speaker, duration in family_temp]
-            distrib = [dist for (ind, dist) in enumerate(distrib)]
-
-        elif function == "nothing":
-            distrib = times
-
-        limits = dict(zip(names, distrib))
+        names = speakers[order].tolist()
+        distrib = self._cutting_distribution(
+            function, spk_durations[order], new_speakers)
+        limits = dict(zip(names, distrib.tolist()))
 
         # write the names of the "family" speakers, to use them in the test
         if not THCHS30:
@@ -158,87 +179,133 @@ class CorpusFilter(object):
 
     def filter_corpus(self, names, function, limits):
         """Cut the corpus according to the cutting function specified
-           Return the subcorpus
-        """
-        utt2dur = self.corpus.utt2duration()
-        utt_ids = []
-        spk2utts = defaultdict(list)
-        not_kept_utts = defaultdict(list)
 
-        # for each speaker, list utterances
-        #for utt,spkr in self.utts:
-        #    spk2utts[spkr].append(utt)
+        For each speaker in `names`, the utterances are kept in
+        chronological order until the cumulated speech duration
+        reaches `limits[speaker]` (at least 10 utterances are kept),
+        the speakers with a null limit are ignored. The timestamps of
+        the kept utterances are shifted by the duration of the
+        removed ones.
 
-        spk2utts_temp = defaultdict(list)
-        for utt, spkr in self.utts:
-            utt_start = self.corpus.segments[utt][1]
-            spk2utts_temp[spkr].append([utt, utt_start])
-        for spkr in self.speakers:
-            spk2utts_temp[spkr] = sorted(spk2utts_temp[spkr], key=lambda x: x[1])
-            spk2utts[spkr] = [utt for utt, utt_start in spk2utts_temp[spkr]]
+        Return the subcorpus and a dict of the removed utterances
+        (with their segments) per speaker
 
-        # create lists of utterances we want to keep,
-        # utterances we don't want to keep
+        """
+        utts, speakers, codes, durations, bounds = self._utterances()
+
+        # the limit of each utterance's speaker, NaN for ignored speakers
+        spk_limits = np.full(len(speakers), np.nan)
+        spk_index = {spk: i for i, spk in enumerate(speakers.tolist())}
         for speaker in names:
-            utt_and_dur = zip(spk2utts[speaker],
-                              [utt2dur[utt] for utt
-                              in spk2utts[speaker]])
-            decreasing_utts = sorted(utt_and_dur,
-                                     key=lambda utt_and_dur: utt_and_dur[1],
-                                     reverse=True)
-            ascending_utts = sorted(utt_and_dur,
-                                    key=lambda utt_and_dur: utt_and_dur[1])
-            nb_utt = 0
-            if limits[speaker] == 0:
-                continue
-            time = 0
-
-            # keep adding utterances until we reach the limit
-            # TODO Create generator and change for/if in while
-            for utts in spk2utts[speaker]:
-                time += utt2dur[utts]
-                if utts in self.avoid_utts:
-                    continue
-
-                if time < limits[speaker] or nb_utt < 10:
-                    utt_ids.append(utts)
-                    nb_utt += 1
-                else:
-                    nb_utt = 0
-                    time = 0
-                    break
-
-            kept_utt_set = set(utt_ids)
-
-            # here we build the list of utts we remove,
-            # and we adjust the boundaries of
-            # the other utterances, in order to have correct timestamps
-            offset = 0
-            for utt in spk2utts[speaker]:
-                # for each wav, we compute the cumsum
-                # of the lengths of the utts we remove
-                # in order to have correct timestamps
-                # for the other utts in the files
-                wav_id, utt_tbegin, utt_tend = self.corpus.segments[utt]
+            if limits[speaker] != 0:
+                spk_limits[spk_index[speaker]] = limits[speaker]
+        utt_limits = spk_limits[codes]
+        selected = ~np.isnan(utt_limits)
+
+        # keep adding utterances until we reach the limit: the avoided
+        # utterances count in the duration but not in the number of
+        # utterances. As both the duration and the number of
+        # utterances are increasing, the kept utterances are the ones
+        # before the first one over the limits.
+        avoided = np.isin(utts, self.avoid_utts)
+        time = self._cumsum_by_speaker(durations, codes, bounds)
+        nb_utt = self._cumsum_by_speaker(~avoided, codes, bounds) - ~avoided
+        with np.errstate(invalid='ignore'):
+            over = (time >= utt_limits) & (nb_utt >= 10)
+        kept = selected & ~avoided & ~over
+        removed = selected & ~kept
 
-                if utt_tbegin-offset < 0 or utt_tend-offset < 0:
+        # here we build the list of utts we remove, and we adjust the
+        # boundaries of the other utterances, in order to have correct
+        # timestamps: the offset of an utterance is the cumulated
+        # duration of the utterances removed before it
+        offsets = self._cumsum_by_speaker(
+            np.where(removed, durations, 0), codes, bounds)
+
+        segments = self.corpus.segments
+        nwarns = 0
+        for i in np.flatnonzero(kept & (offsets > 0)):
+            utt = str(utts[i])
+            wav_id, utt_tbegin, utt_tend = segments[utt]
+            if utt_tbegin - offsets[i] < 0 or utt_tend - offsets[i] < 0:
+                nwarns += 1
+            segments[utt] = (
+                wav_id, utt_tbegin - offsets[i], utt_tend - offsets[i])
+        if nwarns:
+            self.log.info(
+                'WARN : offset is greater than utterance boundaries '
+                'for %i utterances', nwarns)
 
-                    self.log.info('''WARN : offset is greater'''
-                                  '''than utterance boundaries''')
-                if utt not in kept_utt_set:
+        not_kept_utts = defaultdict(list)
+        for i in np.flatnonzero(removed):
+            utt = str(utts[i])
+            not_kept_utts[str(speakers[codes[i]])].append(
+                (utt, segments[utt]))
 
-                    offset = offset + utt2dur[utt]
-                    not_kept_utts[speaker].append(
-                        (utt, self.corpus.segments[utt]))
-                else:
-                    self.corpus.segments[utt] = (
-                        wav_id, utt_tbegin - offset, utt_tend - offset)
+        self.log.debug(
+            'keeping %i utterances, removing %i',
+            np.count_nonzero(kept), np.count_nonzero(removed))
 
         return(self.corpus.subcorpus(
-            utt_ids, prune=True,
+            utts[kept].tolist(), prune=True,
             name=function, validate=True),
                not_kept_utts)
 
+    def filter_signal(self, qc, max_clipping=None, max_dc_offset=None,
+                      max_silence=None, min_rms=None):
+        """Remove the utterances with a bad signal quality
+
+        `qc` is a signal QC table as returned by
+        CorpusValidation.validate_signal or load_signal_qc. The
+        utterances exceeding one of the specified thresholds are
+        removed, as well as the utterances not in `qc`.
+
+        Return the pair (subcorpus, removed utterances)
+
+        """
+        keep = np.ones(len(qc['utt']), dtype=bool)
+        for threshold, mask in (
+                (max_clipping, lambda t: qc['clipping'] <= t),
+                (max_dc_offset, lambda t: np.abs(qc['dc']) <= t),
+                (max_silence, lambda t: qc['silence'] <= t),
+                (min_rms, lambda t: qc['rms'] >= t)):
+            if threshold is not None:
+                keep &= mask(threshold)
+
+        kept = [qc['utt'][i] for i in np.flatnonzero(keep)
+                if self.corpus.has_utt(qc['utt'][i])]
+        removed = sorted(set(self.corpus.utt2spk).difference(kept))
+        self.log.info(
+            'signal filter: keeping %i utterances, removing %i',
+            len(kept), len(removed))
+
+        return self.corpus.subcorpus(kept, prune=True), removed
+
+    def filter_query(self, query, variables=None, signal_qc=None):
+        """Keep the utterances matching a query
+
+        `query` is a predicate over the utterances, either as a string
+        or as a CorpusQuery instance, `variables` are the collections
+        referenced as '@name' in the query (see
+        abkhazia.corpus.corpus_query). `signal_qc` is the signal QC
+        table of the corpus, required if the query uses the signal
+        columns.
+
+        Return the pair (subcorpus, removed utterances)
+
+        """
+        if not isinstance(query, CorpusQuery):
+            query = CorpusQuery(query, variables=variables)
+
+        utts, mask = query.mask(self.corpus, signal_qc=signal_qc)
+        kept = [utts[i] for i in np.flatnonzero(mask)]
+        removed = [utts[i] for i in np.flatnonzero(~mask)]
+        self.log.info(
+            'query filter: keeping %i utterances, removing %i',
+            len(kept), len(removed))
+
+        return self.corpus.subcorpus(kept, prune=True), removed
+
     def filter_THCHS30(self, names, function, limits):
         """split the THCHS30 corpus without having the same text for some speakers
 
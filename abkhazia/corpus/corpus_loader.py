@@ -14,8 +14,20 @@
 # along with abkhazia. If not, see <http://www.gnu.org/licenses/>.
 """Load an abkhazia corpus from disk"""
 
+import collections
+import functools
 import os
+
+import joblib
+
 import abkhazia.utils as utils
+from abkhazia.corpus import corpus_tables
+from abkhazia.corpus.corpus_snapshot import CorpusSnapshot
+
+
+Utterance = collections.namedtuple(
+    'Utterance', 'utt_id speaker wav start stop text')
+"""An utterance record, as yielded by CorpusLoader.iter_utterances()"""
 
 
 class CorpusLoader(object):
@@ -29,10 +41,24 @@ class CorpusLoader(object):
     """
 
     @classmethod
-    def load(cls, corpus_cls, corpus_dir,
-             validate=False, log=utils.logger.null_logger()):
+    def load(cls, corpus_cls, corpus_dir, validate=False,
+             compact=False, snapshot=True, lazy=False, njobs=None,
+             log=utils.logger.null_logger()):
         """Return a corpus initialized from `corpus_dir`
 
+        If `compact` is True, load segments, text, utt2spk and lexicon
+        in array-backed tables instead of dicts (see Corpus.compact).
+
+        If `snapshot` is True and an up to date binary snapshot of the
+        corpus is found in its cache directory, load the corpus from
+        it instead of parsing the text files. A corpus loaded from a
+        snapshot is always compact (see CorpusSnapshot).
+
+        If `lazy` is True, the corpus attributes are not loaded here
+        but parsed from their file on first access (this has no effect
+        when loading from a snapshot). Else the corpus files are read
+        and parsed concurrently by `njobs` threads.
+
         Raise IOError if corpus_dir if an invalid abkhazia corpus
         directory.
 
@@ -45,19 +71,279 @@ class CorpusLoader(object):
         corpus.log = log
         corpus.meta = data['meta']
         corpus.wav_folder = data['wavs']
-        corpus.lexicon = cls.load_lexicon(data['lexicon'])
-        corpus.segments, corpus.wavs = cls.load_segments(data['segments'])
-        corpus.text = cls.load_text(data['text'])
-        corpus.phones = cls.load_phones(data['phones'])
-        corpus.silences = cls.load_silences(data['silences'])
-        corpus.utt2spk = cls.load_utt2spk(data['utt2spk'])
-        corpus.variants = cls.load_variants(data['variants'])
+        if 'merged_wavs' in data:
+            corpus.merged_wavs = cls.load_merged_wavs(data['merged_wavs'])
+        corpus.cache_dir = cls.cache_dir(corpus_dir)
+        corpus.wav_durations = utils.wav.DurationCache(
+            os.path.join(corpus.cache_dir, 'wav_durations.txt'))
+
+        snapshot_file = os.path.join(corpus.cache_dir, 'corpus.snapshot')
+        if snapshot and CorpusSnapshot.is_valid(snapshot_file, corpus_dir):
+            log.debug('loading corpus from snapshot %s', snapshot_file)
+            CorpusSnapshot.load(corpus, snapshot_file, corpus_dir)
+        elif lazy:
+            for name, loader in cls._loaders(corpus, data, compact).items():
+                corpus.load_on_access(name, loader)
+        else:
+            cls._load_concurrently(corpus, data, compact, njobs)
 
         if validate:
             corpus.validate()
 
         return corpus
 
+    @classmethod
+    def iter_utterances(cls, corpus_dir):
+        """Yield the utterances of the corpus in `corpus_dir`
+
+        The utterances are yielded as Utterance named tuples (utt_id,
+        speaker, wav, start, stop, text), in utterance id order. They
+        are streamed from the segments, utt2spk and text files with a
+        merge-join, so the memory usage does not depend on the corpus
+        size.
+
+        The three files must be sorted by utterance id, as written
+        by CorpusSaver. Utterances not present in all of them are
+        ignored.
+
+        Raise IOError if `corpus_dir` is not a valid corpus directory
+        or if a file is not sorted.
+
+        """
+        data = cls._load_corpus_dir(corpus_dir)
+        entries = [cls._iter_entries(data[name])
+                   for name in ('segments', 'utt2spk', 'text')]
+
+        for utt_id, (segment, speaker, text) in cls._merge_join(entries):
+            wav, start, stop = cls._wav_tuple(segment.split(' '))
+            yield Utterance(utt_id, speaker, wav, start, stop, text)
+
+    @staticmethod
+    def _iter_entries(path):
+        """Yield (first token, rest of line) pairs from the file `path`
+
+        Raise IOError if the lines are not sorted by first token.
+
+        """
+        previous = None
+        for line in utils.open_utf8(path, 'r'):
+            key, _, value = ' '.join(line.split()).partition(' ')
+            if not key:
+                continue
+            if previous is not None and key <= previous:
+                raise IOError('{} is not sorted: {} found after {}'.format(
+                    path, key, previous))
+            previous = key
+            yield key, value
+
+    @staticmethod
+    def _merge_join(iterators):
+        """Yield (key, values) for the keys present in all the `iterators`
+
+        Each iterator yields (key, value) pairs sorted by key. The
+        values are yielded as a list, in the order of `iterators`.
+
+        """
+        heads = [next(it, None) for it in iterators]
+        while None not in heads:
+            key = max(head[0] for head in heads)
+            for i, it in enumerate(iterators):
+                # advance the iterators lagging behind
+                while heads[i] is not None and heads[i][0] < key:
+                    heads[i] = next(it, None)
+
+            if None in heads:
+                return
+            if all(head[0] == key for head in heads):
+                yield key, [head[1] for head in heads]
+                heads = [next(it, None) for it in iterators]
+
+    @staticmethod
+    def cache_dir(corpus_dir):
+        """Return the directory where cached data of a corpus is stored"""
+        return os.path.join(os.path.abspath(corpus_dir), 'cache')
+
+    @classmethod
+    def _parsers(cls, data):
+        """Return a dict of corpus attributes mapped to their parser
+
+        Each parser is a function with no argument returning the
+        attribute value parsed from the `data` files, as a dict or a
+        list. Parsers are independent from each other and can be
+        called concurrently.
+
+        """
+        return {
+            'lexicon': functools.partial(cls.load_lexicon, data['lexicon']),
+            'segments': lambda: cls.load_segments(data['segments'])[0],
+            'text': functools.partial(cls.load_text, data['text']),
+            'utt2spk': functools.partial(cls.load_utt2spk, data['utt2spk']),
+            'phones': functools.partial(cls.load_phones, data['phones']),
+            'silences': functools.partial(
+                cls.load_silences, data['silences']),
+            'variants': functools.partial(
+                cls.load_variants, data['variants'])}
+
+    @staticmethod
+    def _fill_table(table, values):
+        """Populate the compact `table` with the `values` dict"""
+        table.extend(values)
+        return table
+
+    @classmethod
+    def _loaders(cls, corpus, data, compact):
+        """Return a dict of corpus attributes mapped to their loader
+
+        Each loader is a function with no argument returning the
+        attribute value from the `data` files. If `compact` is True,
+        segments, text, utt2spk and lexicon are loaded in compact
+        tables (sharing their string tables).
+
+        """
+        loaders = cls._parsers(data)
+        if compact:
+            for name, table in corpus_tables.new_tables().items():
+                loaders[name] = (
+                    lambda table=table, parser=loaders[name]:
+                    cls._fill_table(table, parser()))
+
+        for name in corpus.tracked:
+            loaders[name] = functools.partial(
+                cls._load_tracked, loaders[name], data[name])
+
+        # the wavs are those referenced in segments
+        loaders['wavs'] = lambda: corpus_tables.wav_ids(corpus.segments)
+        return loaders
+
+    @staticmethod
+    def _stat(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+
+    @classmethod
+    def _load_tracked(cls, loader, path):
+        """Return the table loaded by `loader`, marked as saved in `path`"""
+        stat = cls._stat(path)
+        table = loader()
+        corpus_tables.mark_saved(table, path, stat)
+        return table
+
+    @classmethod
+    def _load_concurrently(cls, corpus, data, compact, njobs=None):
+        """Load all the corpus attributes from the `data` files
+
+        The files are read and parsed concurrently by `njobs` threads
+        (one per file by default), this mainly helps when the files
+        are on a slow or network filesystem. The compact tables share
+        their string tables so they are filled afterwards, from the
+        main thread.
+
+        """
+        stats = {name: cls._stat(data[name]) for name in corpus.tracked}
+
+        parsers = cls._parsers(data)
+        values = joblib.Parallel(
+            n_jobs=njobs or len(parsers), backend='threading')(
+                joblib.delayed(parser)() for parser in parsers.values())
+        values = dict(zip(parsers.keys(), values))
+
+        if compact:
+            for name, table in corpus_tables.new_tables().items():
+                values[name] = cls._fill_table(table, values[name])
+
+        for name, value in values.items():
+            setattr(corpus, name, value)
+        corpus.wavs = corpus_tables.wav_ids(corpus.segments)
+
+        # the tables are not modified since read from their file
+        for name, stat in stats.items():
+            corpus_tables.mark_saved(getattr(corpus, name), data[name], stat)
+
+    @staticmethod
+    def _wav_name(wav):
+        """Return `wav` with the '.wav' extension appended if missing"""
+        return wav if os.path.splitext(wav)[1] == '.wav' else wav + '.wav'
+
+    @classmethod
+    def _wav_tuple(cls, line):
+        """Return a (wav, tbegin, tend) tuple from a splited segment line
+
+        The '.wav' extension is appended to the wav id if missing.
+
+        """
+        wav = cls._wav_name(line[0])
+        return ((wav, None, None) if len(line) == 1
+                else (wav, float(line[1]), float(line[2])))
+
+    @staticmethod
+    def _read(path):
+        """Return the content of the file `path`, read in a single call"""
+        with utils.open_utf8(path, 'r') as stream:
+            return stream.read()
+
+    @staticmethod
+    def _lines(content):
+        """Return the non-empty lines of `content` as a list
+
+        Lines are separated by '\\n' only, as when iterating over a
+        file (str.splitlines also splits on characters such as '\\x0b'
+        or '\\u2028').
+
+        """
+        return [line for line in content.split('\n') if line]
+
+    @staticmethod
+    def _is_regular(content):
+        """Return True if each line of `content` is single-space separated
+
+        This is the format written by CorpusSaver. It allows to parse
+        the lines with a single split.
+
+        """
+        return not (
+            any(s in content for s in ('  ', '\t', '\r', ' \n', '\n '))
+            or content.startswith(' ') or content.endswith(' '))
+
+    @classmethod
+    def _parse_entries(cls, path):
+        """Return a dict of first token mapped to the rest of the line
+
+        The tokens in the rest of the line are separated by a single
+        space.
+
+        """
+        content = cls._read(path)
+        lines = cls._lines(content)
+        if not cls._is_regular(content):
+            lines = [' '.join(line.split()) for line in lines]
+        return corpus_tables.TrackedDict(
+            line.partition(' ')[::2] for line in lines)
+
+    @classmethod
+    def _split_columns(cls, content, *ncolumns):
+        """Return the columns of `content` as lists of tokens
+
+        The whole content is splited at once. Return None if `content`
+        is not regular (see _is_regular) or if its lines do not all
+        have exactly n tokens, for n in `ncolumns`.
+
+        """
+        if not cls._is_regular(content):
+            return None
+
+        lines = content.split('\n')
+        if lines[-1] == '':
+            del lines[-1]
+        if not lines:
+            return None
+
+        counts = set(line.count(' ') for line in lines)
+        for n in ncolumns:
+            if counts == {n - 1}:
+                tokens = ' '.join(lines).split(' ')
+                return [tokens[i::n] for i in range(n)]
+        return None
+
     @staticmethod
     def _load_corpus_dir(corpus_dir):
         """Return path to corpus files as a dictionary
@@ -82,6 +368,11 @@ class CorpusLoader(object):
                 raise IOError('invalid corpus: not found {}'.format(path))
             data[_file] = path
 
+        # merged wavs are optional (see Corpus.merge_wavs)
+        path = os.path.join(corpus_dir, 'merged_wavs.txt')
+        if os.path.isfile(path):
+            data['merged_wavs'] = path
+
         # meta is optional
         meta = os.path.join(corpus_dir, 'meta.txt')
         data['meta'] = (utils.meta.Meta.load(meta) if os.path.isfile(meta)
@@ -89,18 +380,17 @@ class CorpusLoader(object):
 
         return data
 
-    @staticmethod
-    def load_lexicon(path):
+    @classmethod
+    def load_lexicon(cls, path):
         """Return a dict of word to phones entries loaded from `path`
 
         `path` is assumed to be a lexicon file, usually named 'lexicon.txt'
 
         """
-        lines = (line.strip().split() for line in utils.open_utf8(path, 'r'))
-        return {line[0]: ' '.join(line[1:]) for line in lines}
+        return cls._parse_entries(path)
 
-    @staticmethod
-    def load_segments(path):
+    @classmethod
+    def load_segments(cls, path):
         """Return a dict of utterance ids mapped to (wav, tbegin, tend)
         and the set of all required wav files
 
@@ -112,39 +402,49 @@ class CorpusLoader(object):
         are missing.
 
         """
-        def _wav_tuple(l):
-            wav = l[0]
-            if os.path.splitext(wav)[1] != '.wav':
-                wav += '.wav'
+        # most of the time all the segments have timestamps, or none
+        # of them have, so the columns can be splited at once
+        content = cls._read(path)
+        columns = cls._split_columns(content, 4, 2)
+        if columns is None:
+            lines = (line.split() for line in cls._lines(content))
+            segments = corpus_tables.TrackedDict(
+                (line[0], cls._wav_tuple(line[1:])) for line in lines)
+            return segments, {w[0] for w in segments.values()}
+
+        # wav names are resolved once per wav, not once per utterance
+        names = {w: cls._wav_name(w) for w in set(columns[1])}
+        wavs = [names[w] for w in columns[1]]
+        if len(columns) == 4:
+            times = zip(wavs, map(float, columns[2]), map(float, columns[3]))
+        else:
+            times = ((w, None, None) for w in wavs)
+        return (corpus_tables.TrackedDict(zip(columns[0], times)),
+                set(names.values()))
 
-            return ((wav, None, None) if len(l) == 1
-                    else (wav, float(l[1]), float(l[2])))
-
-        lines = (line.strip().split() for line in utils.open_utf8(path, 'r'))
-        segments = {line[0]: _wav_tuple(line[1:]) for line in lines}
-
-        wavs = {w[0] for w in segments.values()}
-        return segments, wavs
-
-    @staticmethod
-    def load_text(path):
+    @classmethod
+    def load_text(cls, path):
         """Return a dict of utterance ids mapped to their textual content
 
         `path` is assumed to be a text file, usually named 'text.txt'.
 
         """
-        lines = (line.strip().split() for line in utils.open_utf8(path, 'r'))
-        return {line[0]: ' '.join(line[1:]) for line in lines}
+        return cls._parse_entries(path)
 
-    @staticmethod
-    def load_phones(path):
+    @classmethod
+    def load_phones(cls, path):
         """Return a dict of phones mapped to their IPA equivalent
 
         `path` is assumed to be a phones file, usually named 'phones.txt'.
 
         """
-        lines = (line.strip().split() for line in utils.open_utf8(path, 'r'))
-        return {line[0]: line[1] for line in lines}
+        content = cls._read(path)
+        columns = cls._split_columns(content, 2)
+        if columns is None:
+            lines = (line.split() for line in cls._lines(content))
+            return corpus_tables.TrackedDict(
+                (line[0], line[1]) for line in lines)
+        return corpus_tables.TrackedDict(zip(*columns))
 
     @staticmethod
     def load_silences(path):
@@ -164,6 +464,25 @@ class CorpusLoader(object):
         """
         return cls.load_phones(path)
 
+    @staticmethod
+    def load_merged_wavs(path):
+        """Return a dict of virtual wavs mapped to the wavs they are made of
+
+        `path` is assumed to be a merged wavs file, usually named
+        'merged_wavs.txt', with lines '<virtual-wav> <wav> <offset>
+        <duration>'. The wavs of each virtual wav are sorted by
+        offset.
+
+        """
+        merged = collections.defaultdict(list)
+        for line in utils.open_utf8(path, 'r'):
+            line = line.split()
+            if line:
+                merged[line[0]].append(
+                    (line[1], float(line[2]), float(line[3])))
+        return {wav: sorted(wavs, key=lambda w: w[1])
+                for wav, wavs in merged.items()}
+
     @staticmethod
     def load_variants(path):
         """Return a list of variant symbols
@@ -25,10 +25,62 @@ Created on Wed Nov  1 04:38:30 2017
 import os
 import wave
 import contextlib
+import collections
+
+import joblib
 import numpy as np
-import array
 
-from abkhazia.utils import logger
+from abkhazia.corpus.corpus_loader import CorpusLoader
+from abkhazia.corpus.corpus_saver import CorpusSaver
+import abkhazia.utils as utils
+
+
+def _merge_speaker(in_wavs, out_wav, padding=0., chunk_size=2**18,
+                   store=None):
+    """Concatenate the `in_wavs` into `out_wav`
+
+    The frames are copied by chunks of `chunk_size` frames so the
+    memory usage does not depend on the wavs duration. `padding`
+    seconds of silence are inserted between two input wavs. If
+    `store` is a utils.wav.WavStore, `out_wav` is placed in the store
+    and linked.
+
+    Return the number of frames written. Raise IOError if the input
+    wavs have different formats.
+
+    """
+    with contextlib.closing(wave.open(out_wav, 'w')) as out:
+        params = None
+        for i, wav in enumerate(in_wavs):
+            with contextlib.closing(wave.open(wav, 'r')) as wav_file:
+                (nchan, b, fs, n, comp_T, comp_N) = wav_file.getparams()
+                if params is None:
+                    params = (nchan, b, fs, comp_T, comp_N)
+                    out.setparams((nchan, b, fs, 0, comp_T, comp_N))
+                elif params != (nchan, b, fs, comp_T, comp_N):
+                    raise IOError(
+                        'cannot merge wavs with different formats: {}'
+                        .format(wav))
+
+                # insert the silence between two wavs, 8 bits wavs are
+                # unsigned so their silence is 128
+                if padding > 0 and i > 0:
+                    silence = b'\x80' if b == 1 else b'\x00'
+                    pad_frames = int(round(fs * padding))
+                    for start in range(0, pad_frames, chunk_size):
+                        out.writeframes(
+                            silence * nchan * b
+                            * min(chunk_size, pad_frames - start))
+
+                # writeframes also updates nbframes
+                for _ in range(0, n, chunk_size):
+                    out.writeframes(wav_file.readframes(chunk_size))
+
+        nframes = out.getnframes()
+
+    if store is not None:
+        store.add(out_wav)
+    return nframes
 
 
 #FIXME: this won't work for corpora with several speakers per wavefile
@@ -45,38 +97,34 @@ class CorpusMergeWavs(object):
 
     log : A logging.Logger instance to send log messages
 
-    function : A string that specifies the cutting function that
-      will be used on the corpus
+    njobs : The number of speakers merged in parallel
 
-    plot : A boolean which, if set to true, enables the plotting
-      of the speech distribution and the cutting function
     """
+    chunk_size = 2**18
+    """The number of frames copied at once when merging wavs"""
 
-
-    def __init__(self, corpus, log=logger.null_logger()):
+    def __init__(self, corpus, log=utils.logger.null_logger(), njobs=1):
         self.log = log
         self.corpus = corpus
-        # read utt2spk from the input corpus
-        utt_ids, utt_speakers = zip(*self.corpus.utt2spk.items())
-        self.utts = zip(utt_ids, utt_speakers)
-        self.size = len(utt_ids)
-        self.speakers = set(utt_speakers)
+        self.njobs = njobs
         self.segments = self.corpus.segments
         self.utt2dur = self.corpus.utt2duration()
+
+        # group the utterances by speaker in a single pass
+        self.spk2utts = collections.defaultdict(list)
+        for utt, spkr in self.corpus.utt2spk.items():
+            self.spk2utts[spkr].append(utt)
+        self.speakers = set(self.spk2utts)
+        self.size = len(self.corpus.utt2spk)
         self.log.debug('loaded %i utterances from %i speakers',
                        self.size, len(self.speakers))
 
-
     def get_wav_duration(self, wav):
-        with contextlib.closing(wave.open(wav, 'r')) as wav_file:
-            frames = wav_file.getnframes()
-            rate = wav_file.getframerate()
-        duration = frames / float(rate)
+        duration = self.corpus.wav_durations.duration(wav)
         self.log.debug('wav file {} has a duration of {}'.format(wav,
                                                                  duration))
         return duration
 
-
     def get_per_spk_data(self):
         # get following corpus info per speaker:
         #   total duration
@@ -84,27 +132,34 @@ class CorpusMergeWavs(object):
         #   list of wav durs
         #   list of utts
         self.spk_data = {'total_dur': {}, 'wavs': {}, 'wav_durs': {}, 'utts': {}}
-        for spkr in self.speakers:
-            spk_utts = [utt_id for utt_id, utt_speaker in self.utts
-                                if utt_speaker == spkr]
-            duration = sum([self.utt2dur[utt_id] for utt_id in spk_utts])
+        for spkr, spk_utts in self.spk2utts.items():
+            duration = sum(self.utt2dur[utt_id] for utt_id in spk_utts)
             self.spk_data['total_dur'][spkr] = duration
             self.spk_data['utts'][spkr] = spk_utts
             self.log.debug('for speaker {}, total duration is {}'.format(
                             spkr, duration/60))
-            wavs = [self.segments[utt][0]
-                        for utt in self.spk_data['utts'][spkr]]
             # we want unique values in the list of wavs:
-            wavs = sorted(list(set(wavs)))
+            wavs = sorted({self.segments[utt][0] for utt in spk_utts})
             self.spk_data['wavs'][spkr] = wavs
-            self.spk_data['wav_durs'][spkr] = []
-            for wav in wavs:
-                wav_path = os.path.join(self.corpus.wav_folder, wav)
-                duration = self.get_wav_duration(wav_path)
-                self.spk_data['wav_durs'][spkr].append(duration)
+            self.spk_data['wav_durs'][spkr] = [
+                self.get_wav_duration(
+                    os.path.join(self.corpus.wav_folder, wav))
+                for wav in wavs]
+        self.corpus.wav_durations.save()
+
+    def _set_output_folder(self, output_dir):
+        """Make the corpus point to the wavs and cache of `output_dir`
+
+        The durations of the merged wavs are thus cached in the output
+        corpus, not in the input one.
 
+        """
+        self.corpus.wav_folder = os.path.join(output_dir, 'wavs')
+        self.corpus.cache_dir = CorpusLoader.cache_dir(output_dir)
+        self.corpus.wav_durations = utils.wav.DurationCache(
+            os.path.join(self.corpus.cache_dir, 'wav_durations.txt'))
 
-    def merge_wavs(self, output_dir, padding=0.):
+    def merge_wavs(self, output_dir, padding=0., virtual=False):
         """
         Merge wav files to have 1 wav per speaker
         and modify accordingly segments to have correct
@@ -114,13 +169,25 @@ class CorpusMergeWavs(object):
 
         padding : duration of silence inserted between merged wave files
                   (in seconds)
+
+        virtual : if True, no audio is written. The merged wavs are
+                  described in corpus.merged_wavs as the list of the
+                  wavs they are made of, with their offsets, and the
+                  wavs folder of the output corpus is a link to the
+                  input one.
+
+        The wavs are streamed by chunks of self.chunk_size frames,
+        the speakers being merged in parallel over self.njobs
+        processes. When a wav store is configured (see
+        utils.wav.WavStore), the merged wavs are linked from the
+        store.
         """
         # get input and output wav dir
         wav_output_dir = os.path.join(output_dir, 'wavs')
         wav_dir = self.corpus.wav_folder
         if not os.path.isdir(wav_dir):
             raise IOError('invalid corpus: {} not found'.format(wav_dir))
-        if not os.path.isdir(wav_output_dir):
+        if not virtual and not os.path.isdir(wav_output_dir):
             os.makedirs(wav_output_dir)
 
         # get some corpus info per speaker
@@ -128,6 +195,7 @@ class CorpusMergeWavs(object):
 
         # generate new segment file
         expected_duration = {}
+        merged_wavs = {}
         for spkr in self.speakers:
             #the name of the final wave file will be spkr.wav (ex s01.wav)
             spk_wav_id = spkr + '.wav'
@@ -136,6 +204,10 @@ class CorpusMergeWavs(object):
             cumdurs = list(np.cumsum(wav_durs))
             expected_duration[spk_wav_id] = cumdurs[-1] - padding
             offsets = {e : f for e, f in zip(self.spk_data['wavs'][spkr], [0]+cumdurs[:-1])}
+            merged_wavs[spk_wav_id] = [
+                (wav, float(offsets[wav]), float(dur)) for wav, dur in zip(
+                    self.spk_data['wavs'][spkr],
+                    self.spk_data['wav_durs'][spkr])]
             for utt in self.spk_data['utts'][spkr]:
                 utt_wav = self.segments[utt][0]
                 offset = offsets[utt_wav]
@@ -152,53 +224,48 @@ class CorpusMergeWavs(object):
         # update segments in original corpus
         self.corpus.segments = self.segments
 
-        #merge the wavs
-        for spkr in self.speakers:
-            # create the list of waves we want to merge
-            wav_name = spkr + '.wav'
-            in_wavs = [os.path.join(self.corpus.wav_folder, wav)
-                        for wav in self.spk_data['wavs'][spkr]]
-            out_wav = os.path.join(wav_output_dir, wav_name)
-            # read in wavs
-            waveforms = []
-            prev_params = None
-            for wav in in_wavs:
-                with contextlib.closing(wave.open(wav, 'r')) as wav_file:
-                    (nchan, b, fs, n, comp_T, comp_N) = wav_file.getparams()
-                    waveform = wav_file.readframes(n)
-                if not(prev_params is None):
-                    assert prev_params == (nchan, b, fs, comp_T, comp_N)
-                prev_params = (nchan, b, fs, comp_T, comp_N)
-                waveforms.append(waveform)
-            # prepare zero padding
-            if padding > 0:
-                pad_frames = int(round(fs*padding))
-                assert b == 2
-                pad = array.array('h', [0]*pad_frames).tostring()
-            # write out wav
-            with contextlib.closing(wave.open(out_wav, 'w')) as wav_file:
-                wav_file.setparams((nchan, b, fs, 0, comp_T, comp_N))
-                for i, waveform in enumerate(waveforms):
-                    # writeframes also updates nbframes
-                    wav_file.writeframes(waveform)
-                    if padding > 0 and i+1 < len(waveforms):
-                        wav_file.writeframes(pad)
+        if virtual:
+            self.log.info(
+                'virtually merging wavs of %i speakers', len(merged_wavs))
+            self.corpus.merged_wavs = merged_wavs
+            self.corpus.wavs = set(merged_wavs)
+            self.corpus.validate()
+
+            # wavs are linked to the input ones
+            self.corpus.save(output_dir, copy_wavs=False)
+            self._set_output_folder(output_dir)
+            return
+
+        # merge the wavs, the longest speakers first to balance the
+        # load over the workers
+        speakers = sorted(
+            self.speakers, key=lambda s: -self.spk_data['total_dur'][s])
+        self.log.info('merging wavs of %i speakers', len(speakers))
+        store = utils.wav.WavStore.from_config()
+        joblib.Parallel(n_jobs=self.njobs)(
+            joblib.delayed(_merge_speaker)(
+                [os.path.join(wav_dir, wav)
+                 for wav in self.spk_data['wavs'][spkr]],
+                os.path.join(wav_output_dir, spkr + '.wav'),
+                padding, self.chunk_size, store)
+            for spkr in speakers)
 
         # update wave set
-        self.corpus.wav_folder = wav_output_dir
+        self._set_output_folder(output_dir)
         self.corpus.wavs = {spkr+'.wav' for spkr in self.speakers}
 
         # check that created file length is what we expect
         for wav in self.corpus.wavs:
             wav_file = os.path.join(self.corpus.wav_folder, wav)
             duration = self.get_wav_duration(wav_file)
-            print(duration)
-            print(expected_duration[wav])
-            assert abs(duration - expected_duration[wav]) < 1e-5, \
-                    "Unexpected merged file duration"
+            if abs(duration - expected_duration[wav]) >= 1e-5:
+                raise IOError(
+                    'unexpected merged file duration for {}: {} instead '
+                    'of {}'.format(wav, duration, expected_duration[wav]))
 
         # validate the corpus
         self.corpus.validate()
 
         # save corpus
-        self.corpus.save(output_dir, no_wavs=True)  # wavs are already there
+        # wavs are already there
+        CorpusSaver.save(self.corpus, output_dir, no_wavs=True)
@@ -0,0 +1,378 @@
+# Copyright 2016 Thomas Schatz, Xuan-Nga Cao, Mathieu Bernard
+#
+# This file is part of abkhazia: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Abkhazia is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with abkhazia. If not, see <http://www.gnu.org/licenses/>.
+"""Provides the CorpusQuery class
+
+A query is a predicate over the utterances of a corpus, such as::
+
+    duration > 0.5 and oov_rate < 0.1 and speaker in @speakers
+
+The predicate is written with a subset of the Python syntax:
+comparisons (possibly chained), the boolean operators 'and', 'or'
+and 'not', the arithmetic operators '+', '-', '*' and '/', numbers
+and quoted strings. The names refer to the columns listed in
+CorpusQuery.columns, the '@name' references are collections given
+with the query and can only be used on the right of 'in' or 'not
+in', as can literal tuples, lists or sets.
+
+The query is compiled once and evaluated as a boolean mask over the
+utterances, computing each referenced column in a single vectorized
+pass over the corpus tables.
+
+"""
+
+import ast
+import functools
+import io
+import operator
+import tokenize
+
+import numpy as np
+
+from abkhazia.corpus import corpus_tables
+from abkhazia.corpus.corpus_validation import CorpusValidation
+
+
+class CorpusQuery(object):
+    """A compiled predicate over the utterances of a corpus
+
+    expression : the predicate, as a string (see the module
+      documentation)
+
+    variables : a dict of collections referenced as '@name' in the
+      expression
+
+    Raise IOError if the expression is not a valid predicate, or if
+    it references an unknown column or variable.
+
+    """
+    columns = dict(
+        [('utt', 'the utterance id'),
+         ('speaker', 'the speaker id'),
+         ('wav', 'the wav file'),
+         ('start', 'the utterance start in the wav, NaN if undefined'),
+         ('stop', 'the utterance stop in the wav, NaN if undefined'),
+         ('duration', 'the utterance duration in seconds'),
+         ('words', 'the number of words in the transcription'),
+         ('oov', 'the number of words not in the lexicon'),
+         ('oov_rate', 'the proportion of words not in the lexicon')] +
+        [(field, 'the signal {} (see "abkhazia validate --signal"), '
+          'NaN if not computed'.format(field))
+         for field in CorpusValidation.signal_qc_fields])
+    """The columns available in a query, with their description"""
+
+    _variable_prefix = '_at_'
+
+    _operators = {
+        ast.Add: np.add, ast.Sub: np.subtract,
+        ast.Mult: np.multiply, ast.Div: np.true_divide,
+        ast.Eq: operator.eq, ast.NotEq: operator.ne,
+        ast.Lt: operator.lt, ast.LtE: operator.le,
+        ast.Gt: operator.gt, ast.GtE: operator.ge,
+        ast.And: np.logical_and, ast.Or: np.logical_or}
+
+    def __init__(self, expression, variables=None):
+        self.expression = expression
+        self.variables = variables or {}
+
+        # the columns referenced by the expression
+        self.used_columns = set()
+
+        try:
+            tree = ast.parse(self._preprocess(expression), mode='eval')
+        except (SyntaxError, tokenize.TokenError) as err:
+            raise IOError('invalid query "{}": {}'.format(expression, err))
+        self._predicate = self._compile(tree.body)
+
+    def needs_signal_qc(self):
+        """Return True if the query uses the signal QC columns"""
+        return bool(self.used_columns.intersection(
+            CorpusValidation.signal_qc_fields))
+
+    def mask(self, corpus, signal_qc=None):
+        """Evaluate the query on the utterances of `corpus`
+
+        `signal_qc` is the signal QC table of the corpus, as returned
+        by CorpusValidation.validate_signal or load_signal_qc, it is
+        required only if the query uses signal columns.
+
+        Return (utts, mask) where `utts` is the list of the corpus
+        utterances and `mask` a boolean array, True for the
+        utterances matching the query.
+
+        """
+        if self.needs_signal_qc() and signal_qc is None:
+            raise IOError(
+                'query "{}" requires the signal QC table'.format(
+                    self.expression))
+
+        utts, columns = _Columns(corpus, signal_qc).compute(
+            self.used_columns)
+        mask = np.asarray(self._predicate(columns))
+        if mask.dtype != bool:
+            raise IOError('query "{}" is not a predicate'.format(
+                self.expression))
+        return utts, np.broadcast_to(mask, (len(utts),))
+
+    @classmethod
+    def _preprocess(cls, expression):
+        """Replace the '@name' references by valid Python names"""
+        tokens = []
+        at = False
+        for token in tokenize.generate_tokens(
+                io.StringIO(expression).readline):
+            if token.type == tokenize.OP and token.string == '@':
+                at = True
+                continue
+            if at:
+                if token.type != tokenize.NAME:
+                    raise IOError(
+                        'invalid query "{}": @ must be followed by a name'
+                        .format(expression))
+                token = (tokenize.NAME, cls._variable_prefix + token.string)
+                at = False
+            tokens.append(token[:2])
+        return tokenize.untokenize(tokens)
+
+    def _error(self, message):
+        return IOError('invalid query "{}": {}'.format(
+            self.expression, message))
+
+    def _compile(self, node):
+        """Return a function of the columns evaluating the AST `node`"""
+        if isinstance(node, ast.BoolOp):
+            operands = [self._compile(value) for value in node.values]
+            func = self._operators[type(node.op)]
+            return lambda columns: functools.reduce(
+                func, (operand(columns) for operand in operands))
+
+        if isinstance(node, ast.UnaryOp):
+            operand = self._compile(node.operand)
+            if isinstance(node.op, ast.Not):
+                return lambda columns: np.logical_not(operand(columns))
+            if isinstance(node.op, ast.USub):
+                return lambda columns: np.negative(operand(columns))
+
+        if isinstance(node, ast.BinOp) and type(node.op) in self._operators:
+            left, right = self._compile(node.left), self._compile(node.right)
+            func = self._operators[type(node.op)]
+            return lambda columns: func(left(columns), right(columns))
+
+        if isinstance(node, ast.Compare):
+            return self._compile_compare(node)
+
+        if isinstance(node, ast.Name):
+            if node.id.startswith(self._variable_prefix):
+                raise self._error(
+                    '@{} can only be used after "in"'.format(
+                        node.id[len(self._variable_prefix):]))
+            if node.id not in self.columns:
+                raise self._error('unknown column {}, must be in {}'.format(
+                    node.id, ', '.join(sorted(self.columns))))
+            self.used_columns.add(node.id)
+            return lambda columns: columns[node.id]
+
+        if isinstance(node, ast.Constant) and isinstance(
+                node.value, (int, float, str)) and not isinstance(
+                    node.value, bool):
+            return lambda columns: node.value
+
+        raise self._error('unsupported expression "{}"'.format(
+            ast.unparse(node)))
+
+    def _compile_compare(self, node):
+        """Compile a possibly chained comparison as a conjunction"""
+        comparisons = []
+        left = self._compile(node.left)
+        for op, comparator in zip(node.ops, node.comparators):
+            if isinstance(op, (ast.In, ast.NotIn)):
+                comparisons.append(self._compile_in(
+                    left, self._collection(comparator),
+                    isinstance(op, ast.NotIn)))
+                # a collection cannot be on the left of a comparison
+                left = None
+                continue
+
+            if left is None:
+                raise self._error('a collection cannot be compared')
+            right = self._compile(comparator)
+            comparisons.append(functools.partial(
+                lambda func, left, right, columns: func(
+                    left(columns), right(columns)),
+                self._operators[type(op)], left, right))
+            left = right
+
+        return lambda columns: functools.reduce(
+            np.logical_and, (compare(columns) for compare in comparisons))
+
+    @staticmethod
+    def _compile_in(left, values, negate):
+        """Compile the membership of `left` to the set `values`"""
+        def func(columns):
+            array = np.asarray(left(columns))
+            if array.dtype == object or array.dtype.kind in 'US':
+                mask = np.fromiter(
+                    map(values.__contains__, array.ravel()),
+                    dtype=bool, count=array.size).reshape(array.shape)
+            else:
+                mask = np.isin(array, list(values))
+            return ~mask if negate else mask
+        return func
+
+    def _collection(self, node):
+        """Return the set of values denoted by the AST `node`"""
+        if isinstance(node, ast.Name) and node.id.startswith(
+                self._variable_prefix):
+            name = node.id[len(self._variable_prefix):]
+            try:
+                return frozenset(self.variables[name])
+            except KeyError:
+                raise self._error('undefined variable @{}'.format(name))
+
+        if isinstance(node, (ast.Tuple, ast.List, ast.Set)) and all(
+                isinstance(elt, ast.Constant) for elt in node.elts):
+            return frozenset(elt.value for elt in node.elts)
+
+        raise self._error(
+            '"in" expects a @variable or a literal collection, got "{}"'
+            .format(ast.unparse(node)))
+
+
+class _Columns(object):
+    """Compute the columns of a query over the utterances of a corpus
+
+    The utterances are the ones in the corpus segments. On a compact
+    corpus, the columns are computed from the arrays of the corpus
+    tables, indexed by utterance codes.
+
+    """
+    def __init__(self, corpus, signal_qc=None):
+        self.corpus = corpus
+        self.signal_qc = signal_qc
+        self.compact = corpus.is_compact()
+
+        if self.compact:
+            self.codes, wavs, self.starts, self.stops = (
+                corpus.segments.columns())
+            self.utts = [corpus.segments.keys_table[c] for c in self.codes]
+            self.wav_codes = wavs
+        else:
+            self.utts = list(corpus.segments.keys())
+
+    def compute(self, names):
+        """Return (utts, columns) with columns a dict of arrays"""
+        columns = {}
+        for name in names:
+            if name not in columns:
+                columns.update(self._compute(name))
+        return self.utts, columns
+
+    def _strings(self, table, codes):
+        """Return an array of the strings at `codes` in `table`"""
+        return np.asarray(table.strings, dtype=object)[codes]
+
+    def _from_dict(self, mapping, func, dtype=np.float64):
+        """Return an array of func(mapping[utt]) for utt in utts"""
+        return np.fromiter(
+            (func(mapping[utt]) for utt in self.utts),
+            dtype=dtype, count=len(self.utts))
+
+    def _align(self, table_codes, values, fill):
+        """Reorder the `values` indexed by `table_codes` on self.codes"""
+        aligned = np.full(len(self.corpus.segments.keys_table), fill,
+                          dtype=np.asarray(values).dtype)
+        aligned[table_codes] = values
+        return aligned[self.codes]
+
+    def _compute(self, name):
+        """Return a dict of the column `name` (and the related ones)"""
+        if name == 'utt':
+            return {'utt': np.asarray(self.utts, dtype=object)}
+
+        if name == 'speaker':
+            utt2spk = self.corpus.utt2spk
+            if self.compact:
+                codes, labels = utt2spk.columns()
+                return {'speaker': self._strings(
+                    utt2spk.labels_table, self._align(codes, labels, 0))}
+            return {'speaker': np.asarray(
+                [utt2spk[utt] for utt in self.utts], dtype=object)}
+
+        if name in ('wav', 'start', 'stop', 'duration'):
+            return self._segments()
+
+        if name in ('words', 'oov', 'oov_rate'):
+            return self._text()
+
+        # signal QC columns, NaN for utterances not in the QC table
+        index = {utt: i for i, utt in enumerate(self.signal_qc['utt'])}
+        rows = np.fromiter(
+            (index.get(utt, -1) for utt in self.utts),
+            dtype=np.int64, count=len(self.utts))
+        column = np.append(
+            np.asarray(self.signal_qc[name], dtype=np.float64), np.nan)
+        return {name: column[rows]}
+
+    def _segments(self):
+        segments = self.corpus.segments
+        if self.compact:
+            wavs = self._strings(segments.wavs_table, self.wav_codes)
+            starts, stops = self.starts, self.stops
+        else:
+            # self.utts are the segments keys, in the same order
+            values = list(segments.values())
+            wavs = np.asarray([v[0] for v in values], dtype=object)
+            # None is converted to NaN
+            starts = np.array([v[1] for v in values], dtype=np.float64)
+            stops = np.array([v[2] for v in values], dtype=np.float64)
+
+        durations = stops - np.nan_to_num(starts)
+        missing = np.isnan(durations)
+        if missing.any():
+            # the stop is the end of the wav, read its duration
+            utt2dur = self.corpus.utt2duration()
+            durations[missing] = [
+                utt2dur[self.utts[i]] for i in np.flatnonzero(missing)]
+
+        return {'wav': wavs, 'start': starts, 'stop': stops,
+                'duration': durations}
+
+    def _text(self):
+        text, lexicon = self.corpus.text, self.corpus.lexicon
+        if self.compact and isinstance(lexicon, corpus_tables.TokensTable):
+            codes, offsets, lengths, tokens = text.columns()
+            in_lexicon = np.zeros(len(text.tokens_table), dtype=bool)
+            in_lexicon[lexicon.codes()] = True
+
+            # cumulated number of oov at each token, so that the oov
+            # in tokens[i:j] is cumsum[j] - cumsum[i]
+            cumsum = np.concatenate(
+                ([0], np.cumsum(~in_lexicon[tokens])))
+            words = self._align(codes, lengths, 0)
+            oov = self._align(
+                codes, cumsum[offsets + lengths] - cumsum[offsets], 0)
+        else:
+            # look up the lexicon on the unique words only, but count
+            # all the oov occurrences as in the compact case
+            tokens = [text[utt].split() for utt in self.utts]
+            oov_words = {w for w in set().union(*tokens) if w not in lexicon}
+            words = np.fromiter(
+                map(len, tokens), dtype=np.int64, count=len(tokens))
+            oov = np.fromiter(
+                (sum(w in oov_words for w in t) if oov_words else 0
+                 for t in tokens), dtype=np.int64, count=len(tokens))
+
+        oov_rate = np.divide(
+            oov, words, out=np.zeros(len(words)), where=words > 0)
+        return {'words': words, 'oov': oov, 'oov_rate': oov_rate}
@@ -14,22 +14,49 @@
 # along with abkhazia. If not, see <http://www.gnu.org/licenses/>.
 """Provides the CorpusSaver class"""
 
+import hashlib
 import os
 import shutil
 
-from abkhazia.utils import open_utf8, append_ext, wav
+from abkhazia.utils import append_ext, remove
+from abkhazia.utils.wav import WavStore
+from abkhazia.corpus import corpus_tables
+from abkhazia.corpus.corpus_snapshot import CorpusSnapshot
 
 
 class CorpusSaver(object):
-    """Save a corpus to a directory"""
+    """Save a corpus to a directory
+
+    The corpus files are saved incrementally: the SHA-1 of each file
+    written is stored in `path`/cache/fingerprints.txt and a file is
+    rewritten only if its content changed. Moreover the tables not
+    modified since they have been loaded from (or saved to) a file
+    are not even serialized (see corpus_tables.is_saved). Files are
+    written to a temporary file then renamed, so an interrupted save
+    never leaves a partially written file.
+
+    """
+    fingerprints_file = os.path.join('cache', 'fingerprints.txt')
+
+    tables = ('lexicon', 'segments', 'text', 'phones',
+              'silences', 'utt2spk', 'variants')
+    """The corpus tables saved as `path`/<table>.txt"""
+
     @classmethod
-    def save(cls, corpus, path, no_wavs=False, copy_wavs=True):
+    def save(cls, corpus, path, no_wavs=False, copy_wavs=True,
+             snapshot=False):
         """Save the `corpus` to the directory `path`
 
-        `path` is assumed to be a non existing directory.
+        `path` is assumed to be a non existing directory, or a
+        directory where a corpus has already been saved. In that
+        case, only the files with a modified content are rewritten.
 
         `corpus` is a instance of Corpus
 
+        If `snapshot` is True, write a binary snapshot of the corpus
+        in `path`/cache, used by CorpusLoader as a fast path (see
+        CorpusSnapshot).
+
         """
         if not os.path.exists(path):
             os.makedirs(path)
@@ -37,25 +64,183 @@ class CorpusSaver(object):
         def _path(f):
             return os.path.join(path, f)
 
-        if not no_wavs:
+        if not no_wavs and not cls.has_wavs(corpus, _path('wavs')):
             cls.save_wavs(corpus, _path('wavs'), copy_wavs)
-        cls.save_lexicon(corpus, _path('lexicon.txt'))
-        cls.save_segments(corpus, _path('segments.txt'))
-        cls.save_text(corpus, _path('text.txt'))
-        cls.save_phones(corpus, _path('phones.txt'))
-        cls.save_silences(corpus, _path('silences.txt'))
-        cls.save_utt2spk(corpus, _path('utt2spk.txt'))
-        cls.save_variants(corpus, _path('variants.txt'))
+
+        fingerprints = cls.load_fingerprints(path)
+        for name in cls.tables:
+            # skip the tables not modified since they have been loaded
+            # from (or saved to) the file
+            filename = _path(name + '.txt')
+            table = getattr(corpus, name)
+            if corpus_tables.is_saved(table, filename):
+                continue
+
+            getattr(cls, 'save_' + name)(
+                corpus, filename, fingerprints=fingerprints)
+            corpus_tables.mark_saved(table, filename)
+
+        # the merged wavs file is optional
+        if set(corpus.merged_wavs).intersection(corpus.wavs):
+            cls.save_merged_wavs(
+                corpus, _path('merged_wavs.txt'), fingerprints=fingerprints)
+        elif os.path.exists(_path('merged_wavs.txt')):
+            os.remove(_path('merged_wavs.txt'))
+            fingerprints.pop('merged_wavs.txt', None)
+
+        cls.save_fingerprints(path, fingerprints)
         corpus.meta.save(_path('meta.txt'))
 
+        if snapshot:
+            CorpusSnapshot.save(
+                corpus, os.path.join(_path('cache'), 'corpus.snapshot'), path)
+
+        # persist the known wav durations along with the corpus
+        if len(corpus.wav_durations):
+            corpus.wav_durations.save(
+                os.path.join(_path('cache'), 'wav_durations.txt'))
+
+    @classmethod
+    def clean(cls, corpus, path, no_wavs=False):
+        """Delete the files in `path` not written by save()
+
+        `path` is a directory where a corpus has already been saved
+        and is about to be overwritten by `corpus`. The corpus files
+        and their fingerprints are kept so they are rewritten
+        incrementally, any other file is deleted: the signal QC
+        table, the cached data (validation, snapshot, wav durations)
+        and the wavs folder if `no_wavs` is True or if it does not
+        point to the corpus wavs.
+
+        """
+        keep = {name + '.txt' for name in cls.tables}
+        keep.update(('merged_wavs.txt', 'meta.txt', 'cache'))
+        if not no_wavs and cls.has_wavs(corpus, os.path.join(path, 'wavs')):
+            keep.add('wavs')
+
+        for name in os.listdir(path):
+            if name not in keep:
+                remove(os.path.join(path, name), safe=True)
+
+        cache = os.path.join(path, 'cache')
+        if os.path.isdir(cache):
+            for name in os.listdir(cache):
+                if os.path.join('cache', name) != cls.fingerprints_file:
+                    remove(os.path.join(cache, name), safe=True)
+
+    @classmethod
+    def load_fingerprints(cls, path):
+        """Return the fingerprints of the files saved in `path`
+
+        Return a dict of filenames mapped to (sha1, size, mtime). The
+        dict is empty if no fingerprints are found.
+
+        """
+        fingerprints = {}
+        try:
+            with open(os.path.join(path, cls.fingerprints_file), 'r') as fin:
+                for line in fin:
+                    try:
+                        name, sha1, size, mtime = line.split()
+                        fingerprints[name] = (sha1, int(size), int(mtime))
+                    except ValueError:  # ignore corrupted lines
+                        continue
+        except (OSError, IOError):
+            pass
+        return fingerprints
+
+    @classmethod
+    def save_fingerprints(cls, path, fingerprints):
+        """Write the `fingerprints` of the files saved in `path`"""
+        filename = os.path.join(path, cls.fingerprints_file)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+
+        cls._write(filename, (
+            u'{} {} {} {}\n'.format(name, *value)
+            for name, value in sorted(fingerprints.items())))
+
+    @staticmethod
+    def file_sha1(path, fingerprints):
+        """Return the hash of the content of the file `path`
+
+        The hash is read from `fingerprints` (as returned by
+        load_fingerprints) when the file did not change since the
+        fingerprint was taken, else it is computed from the file and
+        `fingerprints` is updated.
+
+        Raise OSError if `path` cannot be read.
+
+        """
+        stat = os.stat(path)
+        name = os.path.basename(path)
+
+        fingerprint = fingerprints.get(name)
+        if (fingerprint is not None and
+                fingerprint[1:] == (stat.st_size, stat.st_mtime_ns)):
+            return fingerprint[0]
+
+        with open(path, 'rb') as fin:
+            sha1 = hashlib.sha1(fin.read()).hexdigest()
+        fingerprints[name] = (sha1, stat.st_size, stat.st_mtime_ns)
+        return sha1
+
+    @classmethod
+    def _is_saved(cls, path, sha1, fingerprints):
+        """Return True if the file `path` has the content hash `sha1`"""
+        try:
+            return cls.file_sha1(path, fingerprints) == sha1
+        except OSError:
+            return False
+
+    @staticmethod
+    def _write(path, lines, fingerprints=None):
+        """Write the text `lines` to the file `path`
+
+        The file is written to a temporary file, then renamed to
+        `path`. If `fingerprints` is specified (as returned by
+        load_fingerprints), the file is written only if its content
+        changed, and its fingerprint is updated.
+
+        Return True if the file has been written, False otherwise.
+
+        """
+        data = u''.join(lines).encode('utf-8')
+        if fingerprints is not None:
+            sha1 = hashlib.sha1(data).hexdigest()
+            if CorpusSaver._is_saved(path, sha1, fingerprints):
+                return False
+
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as out:
+            out.write(data)
+        os.replace(tmp, path)
+
+        if fingerprints is not None:
+            stat = os.stat(path)
+            fingerprints[os.path.basename(path)] = (
+                sha1, stat.st_size, stat.st_mtime_ns)
+        return True
+
+    @staticmethod
+    def has_wavs(corpus, path):
+        """Return True if `path` already points to the corpus wavs
+
+        This is the case when the corpus is saved in its own directory.
+
+        """
+        return (os.path.exists(path) and
+                os.path.realpath(path) == os.path.realpath(corpus.wav_folder))
+
     @staticmethod
     def save_wavs(corpus, path, copy_wavs=False):
         """Save the corpus wavs in `path`
 
         `path` is assumed to be a non existing directory
 
-        If `copy_wavs` is True, copy the wavs in `path` else make
-        symlinks
+        If `copy_wavs` is True, copy the wavs in `path` (or link them
+        from the wav store configured in abkhazia.conf, see
+        utils.wav.WavStore) else make symlinks
 
         :raise IOError: if `path` already exists
 
@@ -68,29 +253,36 @@ class CorpusSaver(object):
 
         if copy_wavs:
             os.makedirs(path)
-            for w in corpus.wavs:
-                wav = os.path.realpath(os.path.join(corpus.wav_folder, w))
-                shutil.copy(wav, os.path.join(path, w))
+            store = WavStore.from_config()
+            for w in corpus.wav_files():
+                wav = os.path.join(corpus.wav_folder, w)
+                if store is None:
+                    shutil.copy(os.path.realpath(wav), os.path.join(path, w))
+                else:
+                    store.put(wav, os.path.join(path, w))
         else:
             source = os.path.realpath(corpus.wav_folder)
             link_name = path
             os.symlink(source, link_name)
 
-    @staticmethod
-    def save_lexicon(corpus, path):
-        with open_utf8(path, 'w') as out:
-            for k, v in sorted(corpus.lexicon.items()):
-                out.write(u'{} {}\n'.format(k, v))
+    @classmethod
+    def save_lexicon(cls, corpus, path, fingerprints=None):
+        cls._write(path, (
+            u'{} {}\n'.format(k, v)
+            for k, v in sorted(corpus.lexicon.items())), fingerprints)
 
-    @staticmethod
-    def save_segments(corpus, path, force_timestamps=False):
+    @classmethod
+    def save_segments(cls, corpus, path, force_timestamps=False,
+                      fingerprints=None):
         """Save the corpus segments in `path`
 
         If force_timestamps is True and segments are without
         timestamps, create them with the value (0, wav_duration).
 
         """
-        with open_utf8(path, 'w') as out:
+        wav_folder = os.path.realpath(corpus.wav_folder)
+
+        def _lines():
             for k, v in sorted(corpus.segments.items()):
                 # make sure we have the '.wav' extension
                 v = (append_ext(v[0], '.wav'), v[1], v[2])
@@ -98,42 +290,57 @@ class CorpusSaver(object):
                 if v[1] is None:
                     if force_timestamps is True:
                         # abs path to the wav file
-                        w = os.path.join(corpus.wav_folder, v[0])
-                        v = u'{} 0.0 {}'.format(v[0], wav.duration(w))
+                        w = os.path.join(wav_folder, v[0])
+                        v = u'{} 0.0 {}'.format(
+                            v[0], corpus.wav_durations.duration(w))
                     else:
                         v = v[0]
 
                 else:  # we have timestamps
                     v = u'{} {} {}'.format(v[0], v[1], v[2])
 
-                out.write(u'{} {}\n'.format(k, v))
+                yield u'{} {}\n'.format(k, v)
 
-    @staticmethod
-    def save_text(corpus, path):
-        with open_utf8(path, 'w') as out:
-            for k, v in sorted(corpus.text.items()):
-                out.write(u'{} {}\n'.format(k, v))
+        cls._write(path, _lines(), fingerprints)
 
-    @staticmethod
-    def save_phones(corpus, path):
-        with open_utf8(path, 'w') as out:
-            for k, v in sorted(corpus.phones.items()):
-                out.write(u'{} {}\n'.format(k, v))
+    @classmethod
+    def save_text(cls, corpus, path, fingerprints=None):
+        cls._write(path, (
+            u'{} {}\n'.format(k, v)
+            for k, v in sorted(corpus.text.items())), fingerprints)
 
-    @staticmethod
-    def save_silences(corpus, path):
-        with open_utf8(path, 'w') as out:
-            for s in sorted(corpus.silences):
-                out.write(u'{}\n'.format(s))
+    @classmethod
+    def save_phones(cls, corpus, path, fingerprints=None):
+        cls._write(path, (
+            u'{} {}\n'.format(k, v)
+            for k, v in sorted(corpus.phones.items())), fingerprints)
 
-    @staticmethod
-    def save_utt2spk(corpus, path):
-        with open_utf8(path, 'w') as out:
-            for utt, spk in sorted(corpus.utt2spk.items()):
-                out.write(u'{} {}\n'.format(utt, spk))
+    @classmethod
+    def save_silences(cls, corpus, path, fingerprints=None):
+        cls._write(path, (
+            u'{}\n'.format(s) for s in sorted(corpus.silences)), fingerprints)
 
-    @staticmethod
-    def save_variants(corpus, path):
-        with open_utf8(path, 'w') as out:
-            for v in sorted(corpus.variants):
-                out.write(u'{}\n'.format(v))
+    @classmethod
+    def save_utt2spk(cls, corpus, path, fingerprints=None):
+        cls._write(path, (
+            u'{} {}\n'.format(utt, spk)
+            for utt, spk in sorted(corpus.utt2spk.items())), fingerprints)
+
+    @classmethod
+    def save_merged_wavs(cls, corpus, path, fingerprints=None):
+        """Save the merged wavs of the corpus in `path`
+
+        Only the virtual wavs in corpus.wavs are saved, as lines
+        '<virtual-wav> <wav> <offset> <duration>'
+
+        """
+        cls._write(path, (
+            u'{} {} {} {}\n'.format(wav, w, offset, duration)
+            for wav, wavs in sorted(corpus.merged_wavs.items())
+            if wav in corpus.wavs
+            for w, offset, duration in wavs), fingerprints)
+
+    @classmethod
+    def save_variants(cls, corpus, path, fingerprints=None):
+        cls._write(path, (
+            u'{}\n'.format(v) for v in sorted(corpus.variants)), fingerprints)
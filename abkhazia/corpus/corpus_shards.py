@@ -0,0 +1,239 @@
+# Copyright 2016 Thomas Schatz, Xuan-Nga Cao, Mathieu Bernard
+#
+# This file is part of abkhazia: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Abkhazia is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with abkhazia. If not, see <http://www.gnu.org/licenses/>.
+"""Provides the CorpusShards class
+
+A sharded corpus is a directory containing N shards, each one being a
+valid abkhazia corpus in <shards-dir>/shard-<i>/data, and a manifest
+<shards-dir>/shards.json describing them. The shards can be processed
+independently (e.g. on different machines) and merged back in a
+single corpus.
+
+The speakers are never splitted across shards, so that per-speaker
+processing (such as CMVN or speaker adaptation in Kaldi) gives the
+same result on the shards and on the whole corpus.
+
+"""
+
+import heapq
+import json
+import os
+import shutil
+
+from abkhazia.corpus.corpus_loader import CorpusLoader
+import abkhazia.utils as utils
+
+
+class CorpusShards(object):
+    """A class for sharding an abkhazia corpus and merging it back
+
+    corpus : The abkhazia corpus to shard. The corpus is assumed
+      to be valid.
+
+    log : a logging.Logger instance to send log messages
+
+    """
+    manifest_file = 'shards.json'
+    """The name of the manifest in a shards directory"""
+
+    def __init__(self, corpus, log=utils.logger.null_logger()):
+        self.corpus = corpus
+        self.log = log
+
+    def shard(self, nshards, by='speakers'):
+        """Return a list of `nshards` subcorpora partitioning the corpus
+
+        The speakers are distributed over the shards so that each
+        shard gets approximately the same amount of data. If `by` is
+        'speakers' the shards are balanced in number of utterances,
+        if `by` is 'duration` they are balanced in speech duration.
+
+        Raise IOError if `by` is not 'speakers' or 'duration', or if
+        `nshards` is not in [1, number of speakers].
+
+        """
+        spk2utt = self.corpus.spk2utt()
+        if not 0 < nshards <= len(spk2utt):
+            raise IOError(
+                'number of shards must be in [1, {}], it is {}'.format(
+                    len(spk2utt), nshards))
+
+        if by == 'speakers':
+            weights = {spk: len(utts) for spk, utts in spk2utt.items()}
+        elif by == 'duration':
+            utt2dur = self.corpus.utt2duration()
+            weights = {spk: sum(utt2dur[utt] for utt in utts)
+                       for spk, utts in spk2utt.items()}
+        else:
+            raise IOError(
+                'shard by must be "speakers" or "duration", it is {}'
+                .format(by))
+
+        # greedy assignment of the heaviest speakers first to the
+        # lightest shard, the heap contains (weight, shard index)
+        speakers = [[] for _ in range(nshards)]
+        heap = [(0, i) for i in range(nshards)]
+        for spk in sorted(weights, key=lambda s: (-weights[s], s)):
+            weight, i = heapq.heappop(heap)
+            speakers[i].append(spk)
+            heapq.heappush(heap, (weight + weights[spk], i))
+
+        shards = []
+        for i, spks in enumerate(speakers):
+            self.log.debug(
+                'shard %i: %i speakers, %s %s', i, len(spks),
+                sum(weights[spk] for spk in spks),
+                'utterances' if by == 'speakers' else 'seconds')
+            shards.append(self.corpus.subcorpus(
+                [utt for spk in spks for utt in spk2utt[spk]],
+                name='shard {} of {}'.format(i, nshards)))
+        return shards
+
+    @classmethod
+    def shard_dir(cls, path, index):
+        """Return the corpus directory of the shard `index` in `path`"""
+        return os.path.join(path, 'shard-{:03d}'.format(index), 'data')
+
+    @classmethod
+    def save(cls, shards, path, by='speakers', copy_wavs=False):
+        """Save the `shards` and their manifest in the directory `path`
+
+        `path` is assumed to be a non existing directory. The shard i
+        is saved in `path`/shard-<i>/data (see shard_dir), the wavs
+        are linked to the ones of the sharded corpus unless
+        `copy_wavs` is True.
+
+        """
+        manifest = {'by': by, 'shards': []}
+        for i, shard in enumerate(shards):
+            corpus_dir = cls.shard_dir(path, i)
+            shard.save(corpus_dir, copy_wavs=copy_wavs)
+
+            manifest['shards'].append({
+                'path': os.path.relpath(corpus_dir, path),
+                'utterances': len(shard.utt2spk),
+                'speakers': len(shard.spks()),
+                'wavs': len(shard.wavs)})
+            if by == 'duration':
+                manifest['shards'][-1]['duration'] = shard.duration()
+
+        with open(os.path.join(path, cls.manifest_file), 'w') as stream:
+            json.dump(manifest, stream, indent=2, sort_keys=True)
+
+    @classmethod
+    def load_manifest(cls, path):
+        """Return the manifest of the shards directory `path` as a dict
+
+        Raise IOError if the manifest is not found
+
+        """
+        manifest = os.path.join(path, cls.manifest_file)
+        if not os.path.isfile(manifest):
+            raise IOError('invalid shards: not found {}'.format(manifest))
+
+        with open(manifest, 'r') as stream:
+            return json.load(stream)
+
+    @staticmethod
+    def _tagged_entries(path, tag):
+        """Yield (key, tag, value) from the sorted file `path`"""
+        for key, value in CorpusLoader._iter_entries(path):
+            yield key, tag, value
+
+    @classmethod
+    def merge(cls, path, output_dir, log=utils.logger.null_logger()):
+        """Merge the shards in `path` into the corpus directory `output_dir`
+
+        The shards are merged directly from the files: the
+        utterances indexed files (segments, text and utt2spk) are
+        merge-sorted line by line, the other files are copied from
+        the first shard (they are shared by all the shards). The
+        wavs are symbolic links to the ones of the shards. The shards
+        are thus never loaded in memory.
+
+        `output_dir` is assumed to be a non existing directory.
+
+        Raise IOError if the shards are not valid corpus directories,
+        or if an utterance is in several shards.
+
+        """
+        shards = [os.path.join(path, shard['path'])
+                  for shard in cls.load_manifest(path)['shards']]
+        log.info('merging %i shards from %s', len(shards), path)
+
+        data = [CorpusLoader._load_corpus_dir(shard) for shard in shards]
+        os.makedirs(output_dir)
+
+        # the origin shard of each wav
+        wavs = {}
+
+        for name in ('segments', 'text', 'utt2spk'):
+            entries = heapq.merge(*(
+                cls._tagged_entries(d[name], i) for i, d in enumerate(data)))
+
+            with utils.open_utf8(
+                    os.path.join(output_dir, name + '.txt'), 'w') as out:
+                previous = None
+                for key, i, value in entries:
+                    if key == previous:
+                        raise IOError(
+                            'utterance {} found in several shards'
+                            .format(key))
+                    previous = key
+                    out.write(u'{} {}\n'.format(key, value))
+
+                    if name == 'segments':
+                        wavs.setdefault(value.split(' ')[0], i)
+
+        for name in ('lexicon', 'phones', 'silences', 'variants'):
+            shutil.copyfile(
+                data[0][name], os.path.join(output_dir, name + '.txt'))
+
+        # the virtual merged wavs (if any) are described per shard,
+        # they are replaced by the wavs they are made of in `wavs`
+        merged = []
+        for i, d in enumerate(data):
+            if 'merged_wavs' not in d:
+                continue
+            for line in utils.open_utf8(d['merged_wavs'], 'r'):
+                if line.strip():
+                    merged.append(line)
+                    wav, source = line.split()[:2]
+                    wavs.pop(wav, None)
+                    wavs[source] = i
+        if merged:
+            merged.sort()
+            with utils.open_utf8(
+                    os.path.join(output_dir, 'merged_wavs.txt'), 'w') as out:
+                out.write(u''.join(merged))
+
+        # link the wavs: if all the shards point to the same wavs
+        # directory (they have been saved without copy), link that
+        # directory, else link each wav individually
+        wav_folders = [os.path.realpath(d['wavs']) for d in data]
+        if len(set(wav_folders)) == 1:
+            os.symlink(wav_folders[0], os.path.join(output_dir, 'wavs'))
+        else:
+            os.makedirs(os.path.join(output_dir, 'wavs'))
+            for wav, i in wavs.items():
+                wav = utils.append_ext(wav, '.wav')
+                os.symlink(
+                    os.path.realpath(os.path.join(wav_folders[i], wav)),
+                    os.path.join(output_dir, 'wavs', wav))
+
+        utils.meta.Meta(
+            name='merged shards', source=data[0]['meta'].source,
+            comment='merged from {} shards in {}'.format(
+                len(shards), path)).save(
+                    os.path.join(output_dir, 'meta.txt'))
@@ -0,0 +1,232 @@
+# Copyright 2016 Thomas Schatz, Xuan-Nga Cao, Mathieu Bernard
+#
+# This file is part of abkhazia: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Abkhazia is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with abkhazia. If not, see <http://www.gnu.org/licenses/>.
+"""Provides the CorpusSnapshot class
+
+A snapshot is a single binary file storing a whole corpus in its
+compact representation (see corpus_tables). It is written along with
+the text files of a corpus and used by CorpusLoader as a fast path.
+
+The file is made of a magic string, the length of a JSON header
+(as a little-endian uint64), the header itself and the data blocks,
+each aligned on 64 bytes. The header stores the size and
+modification time of the corpus text files the snapshot has been
+built from, the small corpus attributes (phones, silences, variants)
+and the location of the data blocks. Data blocks are the numpy arrays
+of the tables and the string tables, encoded as newline separated
+UTF-8 strings.
+
+At loading, the file is memory-mapped (in copy-on-write mode) and the
+tables are built over the mapped arrays without copy.
+
+"""
+
+import json
+import os
+import struct
+
+import numpy as np
+
+from abkhazia.corpus import corpus_tables
+
+
+class CorpusSnapshot(object):
+    """Save and load a corpus as a single memory-mappable binary file"""
+    magic = b'abkhazia-snapshot-1\n'
+
+    alignment = 64
+    """Alignment of the data blocks in the file (in bytes)"""
+
+    sources = ('lexicon', 'phones', 'segments', 'silences',
+               'text', 'utt2spk', 'variants')
+    """The corpus text files a snapshot must be consistent with"""
+
+    @classmethod
+    def _stat_sources(cls, corpus_dir):
+        """Return (size, mtime) of the corpus text files as a dict"""
+        stats = {}
+        for name in cls.sources:
+            stat = os.stat(os.path.join(corpus_dir, name + '.txt'))
+            stats[name] = [stat.st_size, stat.st_mtime_ns]
+        return stats
+
+    @staticmethod
+    def _tables(corpus):
+        """Return the compact tables of the corpus as a dict
+
+        If the corpus is not compact, or if it shares its string
+        tables with a larger corpus (as a subcorpus does), the tables
+        are built from the corpus data.
+
+        """
+        names = ('segments', 'text', 'utt2spk', 'lexicon')
+        if (corpus.is_compact() and
+                len(corpus.segments.keys_table) == len(corpus.segments)):
+            return {name: getattr(corpus, name) for name in names}
+
+        tables = corpus_tables.new_tables()
+        for name in names:
+            tables[name].extend(getattr(corpus, name))
+        return tables
+
+    @classmethod
+    def save(cls, corpus, filename, corpus_dir):
+        """Write a snapshot of `corpus` in `filename`
+
+        `corpus_dir` is the directory where the text files of the
+        corpus have been saved. They must be written before the
+        snapshot, their size and modification time are stored in it.
+
+        The file is first written to a temporary file, then renamed
+        to `filename`.
+
+        """
+        tables = cls._tables(corpus)
+
+        # list the data blocks to write
+        blocks = []
+        for name, strings in corpus_tables.string_tables(tables).items():
+            blocks.append(('strings/' + name, np.frombuffer(
+                '\n'.join(strings.strings).encode('utf-8'), dtype=np.uint8),
+                           len(strings)))
+        for name, table in tables.items():
+            for column, array in sorted(table.dump().items()):
+                blocks.append(('{}/{}'.format(name, column), array, None))
+
+        # build the header, offsets are relative to the data section
+        header = {
+            'sources': cls._stat_sources(corpus_dir),
+            'phones': sorted(corpus.phones.items()),
+            'silences': list(corpus.silences),
+            'variants': list(corpus.variants),
+            'blocks': {}}
+        offset = 0
+        for name, array, count in blocks:
+            header['blocks'][name] = {
+                'offset': offset,
+                'dtype': array.dtype.str,
+                'shape': list(array.shape),
+                'count': count}
+            offset = cls._align(offset + array.nbytes)
+        header = json.dumps(header).encode('utf-8')
+
+        # write the file
+        directory = os.path.dirname(os.path.abspath(filename))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as stream:
+            stream.write(cls.magic)
+            stream.write(struct.pack('<Q', len(header)))
+            stream.write(header)
+            cls._pad(stream)
+            start = stream.tell()
+            for _, array, _ in blocks:
+                stream.write(np.ascontiguousarray(array).tobytes())
+                cls._pad(stream, start)
+        os.replace(tmp, filename)
+
+    @classmethod
+    def _align(cls, offset):
+        return (offset + cls.alignment - 1) // cls.alignment * cls.alignment
+
+    @classmethod
+    def _pad(cls, stream, start=0):
+        """Write zeros in `stream` up to the next aligned position"""
+        position = stream.tell() - start
+        stream.write(b'\0' * (cls._align(position) - position))
+
+    @classmethod
+    def _read_header(cls, filename):
+        """Return the header and the offset of data in the snapshot
+
+        Raise IOError if the file is not a valid snapshot
+
+        """
+        with open(filename, 'rb') as stream:
+            if stream.read(len(cls.magic)) != cls.magic:
+                raise IOError('invalid snapshot: {}'.format(filename))
+            try:
+                size = struct.unpack('<Q', stream.read(8))[0]
+                header = json.loads(stream.read(size).decode('utf-8'))
+            except (struct.error, ValueError):
+                raise IOError('invalid snapshot: {}'.format(filename))
+            return header, cls._align(stream.tell())
+
+    @classmethod
+    def is_valid(cls, filename, corpus_dir):
+        """Return True if `filename` is a snapshot up to date with `corpus_dir`
+
+        The snapshot is up to date if the size and modification time
+        of the corpus text files did not change since the snapshot
+        has been written.
+
+        """
+        try:
+            header, _ = cls._read_header(filename)
+            return header['sources'] == cls._stat_sources(corpus_dir)
+        except (IOError, OSError, KeyError):
+            return False
+
+    @classmethod
+    def load(cls, corpus, filename, corpus_dir=None):
+        """Load the snapshot `filename` into `corpus`
+
+        Initialize the corpus segments, text, utt2spk, lexicon,
+        wavs, phones, silences and variants. The loaded corpus is
+        compact. The snapshot is assumed to be valid (see is_valid).
+
+        If `corpus_dir` is specified, the loaded tables are marked as
+        saved in the corpus files of that directory (see
+        corpus_tables.mark_saved).
+
+        """
+        header, start = cls._read_header(filename)
+        data = np.memmap(filename, dtype=np.uint8, mode='c')
+
+        def _block(name):
+            block = header['blocks'][name]
+            dtype = np.dtype(block['dtype'])
+            offset = start + block['offset']
+            size = int(np.prod(block['shape'])) * dtype.itemsize
+            return (data[offset:offset + size]
+                    .view(dtype).reshape(block['shape']), block)
+
+        strings = {}
+        for name in ('utts', 'words', 'wavs', 'speakers', 'phones'):
+            array, block = _block('strings/' + name)
+            strings[name] = corpus_tables.StringTable.from_list(
+                array.tobytes().decode('utf-8').split('\n')
+                if block['count'] else [])
+
+        tables = corpus_tables.new_tables(strings)
+        for name, table in tables.items():
+            prefix = name + '/'
+            table.restore({
+                key[len(prefix):]: _block(key)[0]
+                for key in header['blocks'] if key.startswith(prefix)})
+            setattr(corpus, name, table)
+
+            # the snapshot is up to date with the corpus files
+            if corpus_dir is not None:
+                corpus_tables.mark_saved(
+                    table, os.path.join(corpus_dir, name + '.txt'),
+                    header['sources'][name])
+
+        corpus.wavs = corpus_tables.wav_ids(corpus.segments)
+        corpus.phones = dict(header['phones'])
+        corpus.silences = header['silences']
+        corpus.variants = header['variants']
+        return corpus
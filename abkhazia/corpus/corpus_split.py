@@ -14,6 +14,7 @@
 # along with abkhazia. If not, see <http://www.gnu.org/licenses/>.
 """Provides the CorpusSplit class"""
 
+import collections
 import configparser
 import random
 from abkhazia.utils import logger, config
@@ -32,6 +33,9 @@ class CorpusSplit(object):
 
     prune : If True the train and testing corpora are pruned (default is True)
 
+    validate : If True the train and testing corpora are validated
+      (default is True)
+
     In the split and split_by_speakers methods, arguments are as follow:
 
         test_prop : float, should be between 0.0 and 1.0 and
@@ -45,12 +49,17 @@ class CorpusSplit(object):
           train split. If None, the value is automatically set to the
           complement of the test size. (default is None)
 
+    The utterances are grouped by speakers once at construction, so
+    the splits are computed in linear time. Use the kfold and
+    repeated_split generators to compute several splits from the
+    same CorpusSplit instance.
 
     """
     def __init__(self, corpus, log=logger.null_logger(),
-                 random_seed=None, prune=True):
+                 random_seed=None, prune=True, validate=True):
         self.log = log
         self.prune = prune
+        self.validate = validate
         self.corpus = corpus
 
         # seed the random generator
@@ -58,11 +67,12 @@ class CorpusSplit(object):
             self.log.debug('random seed is %i', random_seed)
         random.seed(random_seed)
 
-        # read utt2spk from the input corpus
-        utt_ids, utt_speakers = zip(*self.corpus.utt2spk.items())
-        self.utts = list(zip(utt_ids, utt_speakers))
-        self.size = len(utt_ids)
-        self.speakers = set(utt_speakers)
+        # group the utterances by speaker in a single pass, speakers
+        # are sorted so that the splits depend only on the seed
+        self.spk2utt = {spk: sorted(utts) for spk, utts
+                        in sorted(self.corpus.spk2utt().items())}
+        self.size = sum(len(utts) for utts in self.spk2utt.values())
+        self.speakers = set(self.spk2utt)
         self.log.debug('loaded %i utterances from %i speakers',
                        self.size, len(self.speakers))
 
@@ -94,9 +104,8 @@ class CorpusSplit(object):
 
         train_utt_ids = []
         test_utt_ids = []
-        for speaker in self.speakers:
-            spk_utts = [utt_id for utt_id, utt_speaker in self.utts
-                        if utt_speaker == speaker]
+        for speaker, spk_utts in self.spk2utt.items():
+            spk_utts = list(spk_utts)
 
             # if len(spk_utts) <= 1:
             #     self.log.warning(
@@ -120,8 +129,7 @@ class CorpusSplit(object):
             train_utt_ids += train_utts
             test_utt_ids += test_utts
 
-        return (self.corpus.subcorpus(train_utt_ids, prune=self.prune),
-                self.corpus.subcorpus(test_utt_ids, prune=self.prune))
+        return self._subcorpora(train_utt_ids, test_utt_ids)
 
     def split_by_speakers(self, train_prop=None, test_prop=None):
         """Split the corpus by speakers
@@ -139,7 +147,7 @@ class CorpusSplit(object):
         train_prop, test_prop = self._proportions(train_prop, test_prop)
 
         # randomize the speakers
-        speakers = list(self.speakers)
+        speakers = list(self.spk2utt)
         random.shuffle(speakers)
 
         # split from a subpart of the randomized speakers
@@ -161,19 +169,19 @@ class CorpusSplit(object):
         # assert we have no unknown speakers
         for speakers, message in (
                 (train_speakers, 'train_speakers'),
-                (train_speakers, 'train_speakers')):
+                (test_speakers, 'test_speakers')):
             unknown = [spk for spk in speakers if spk not in self.speakers]
             if unknown != []:
                 raise RuntimeError(
                     "The following speakers specified in {} "
                     "are not found in the corpus: {}".format(message, unknown))
 
+        train_speakers = set(train_speakers)
+        test_speakers = set(test_speakers)
+
         train_utt_ids = []
         test_utt_ids = []
-        for speaker in self.speakers:
-            spk_utts = [utt_id for utt_id, utt_speaker in self.utts
-                        if utt_speaker == speaker]
-
+        for speaker, spk_utts in self.spk2utt.items():
             if speaker in train_speakers:
                 train_utt_ids += spk_utts
                 msg = 'train'
@@ -188,8 +196,177 @@ class CorpusSplit(object):
                     '%i utterances from speaker %s -> %s',
                     len(spk_utts), speaker, msg)
 
-        return (self.corpus.subcorpus(train_utt_ids, prune=self.prune),
-                self.corpus.subcorpus(test_utt_ids, prune=self.prune))
+        return self._subcorpora(train_utt_ids, test_utt_ids)
+
+    def split_by_duration(self, test_duration, train_duration=None,
+                          by_speakers=True, strata=None):
+        """Split the corpus in subsets of given durations
+
+        test_duration : float, the duration of the test set in
+          seconds.
+
+        train_duration : float, the duration of the train set in
+          seconds. If None, the train set is made of all the data not
+          in the test set (default is None).
+
+        by_speakers : bool, if True the data for each speaker is
+          attributed either to the test or train set as a whole, else
+          each speaker contributes to the sets proportionally to its
+          speech duration (default is True).
+
+        strata : dict, mapping each speaker to a stratum (e.g. its
+          gender). When specified, each stratum contributes to the
+          sets proportionally to its speech duration. Requires
+          `by_speakers` to be True (default is None).
+
+        The speakers (or utterances) are visited in a random order and
+        greedily attributed to a set while its target duration is not
+        exceeded, so the sets durations are as close as possible to
+        their target without exceeding it. This is linear in the
+        number of utterances.
+
+        Return a pair (train, testing) of Corpus instances
+
+        """
+        utt2dur = self.corpus.utt2duration()
+        spk2dur = {spk: sum(utt2dur[utt] for utt in utts)
+                   for spk, utts in self.spk2utt.items()}
+        total = sum(spk2dur.values())
+
+        if test_duration < 0 or (train_duration or 0) < 0:
+            raise RuntimeError('durations must be positive')
+        if strata is not None and not by_speakers:
+            raise RuntimeError('strata requires a split by speakers')
+        if test_duration + (train_duration or 0) > total * (1 + 1e-9):
+            raise RuntimeError(
+                'sum of test and train durations is > {} s'.format(total))
+
+        # the groups of items to split, items are speakers or
+        # utterances, each group gets its share of the durations
+        if not by_speakers:
+            groups = [(utts, utt2dur) for utts in self.spk2utt.values()]
+        elif strata is None:
+            groups = [(list(self.spk2utt), spk2dur)]
+        else:
+            unknown = self.speakers.difference(strata)
+            if unknown:
+                raise RuntimeError(
+                    'the following speakers are not in strata: {}'
+                    .format(sorted(unknown)))
+            spk2stratum = collections.defaultdict(list)
+            for spk in self.spk2utt:
+                spk2stratum[strata[spk]].append(spk)
+            groups = [(spks, spk2dur) for _, spks
+                      in sorted(spk2stratum.items())]
+
+        # the duration a group cannot fill is reported on the next one
+        test, train = [], []
+        test_left, train_left = 0, 0
+        for items, durations in groups:
+            share = sum(durations[item] for item in items) / total
+            items = list(items)
+            random.shuffle(items)
+
+            _test, _train, test_left = self._fill(
+                items, durations, share * test_duration + test_left)
+            if train_duration is not None:
+                _train, _, train_left = self._fill(
+                    _train, durations, share * train_duration + train_left)
+            test += _test
+            train += _train
+
+        if by_speakers:
+            test = [utt for spk in test for utt in self.spk2utt[spk]]
+            train = [utt for spk in train for utt in self.spk2utt[spk]]
+
+        self.log.debug(
+            'split by duration: %.2f s for train, %.2f s for test',
+            sum(utt2dur[utt] for utt in train),
+            sum(utt2dur[utt] for utt in test))
+        return self._subcorpora(train, test)
+
+    @staticmethod
+    def _fill(items, durations, target):
+        """Select `items` up to a total duration of `target`
+
+        Each item is selected if it fits in the remaining duration,
+        rounding errors below 1 ms are tolerated.
+
+        Return (selected, others, remaining duration)
+
+        """
+        selected, others = [], []
+        for item in items:
+            if durations[item] <= target + 1e-3:
+                selected.append(item)
+                target -= durations[item]
+            else:
+                others.append(item)
+        return selected, others, max(target, 0)
+
+    def kfold(self, k, by_speakers=True):
+        """Yield the `k` (train, testing) pairs of a k-fold split
+
+        The corpus is partitioned in `k` folds, each fold being the
+        testing set of one split, the `k` - 1 other folds being the
+        train set.
+
+        If `by_speakers` is True, the data for each speaker is
+        attributed to a single fold, else the utterances of each
+        speaker are distributed over all the folds.
+
+        Raise RuntimeError if `k` is not in [2, number of speakers]
+        (or number of utterances if `by_speakers` is False).
+
+        """
+        nitems = len(self.spk2utt) if by_speakers else self.size
+        if not 2 <= k <= nitems:
+            raise RuntimeError(
+                'k must be in [2, {}], it is {}'.format(nitems, k))
+
+        folds = [[] for _ in range(k)]
+        if by_speakers:
+            speakers = list(self.spk2utt)
+            random.shuffle(speakers)
+            for i, speaker in enumerate(speakers):
+                folds[i % k].extend(self.spk2utt[speaker])
+        else:
+            # consecutive utterances of a speaker go in different
+            # folds, so each fold get speech from all the speakers
+            i = 0
+            for spk_utts in self.spk2utt.values():
+                spk_utts = list(spk_utts)
+                random.shuffle(spk_utts)
+                for utt in spk_utts:
+                    folds[i % k].append(utt)
+                    i += 1
+
+        for i, test_utt_ids in enumerate(folds):
+            self.log.debug(
+                'fold %i: %i utterances for test', i, len(test_utt_ids))
+            train_utt_ids = [
+                utt for j, fold in enumerate(folds) if j != i for utt in fold]
+            yield self._subcorpora(train_utt_ids, test_utt_ids)
+
+    def repeated_split(self, n, train_prop=None, test_prop=None,
+                       by_speakers=True):
+        """Yield `n` random (train, testing) pairs
+
+        Each pair is computed as in split_by_speakers (if
+        `by_speakers` is True) or split, see those methods for
+        details on the arguments.
+
+        """
+        split = self.split_by_speakers if by_speakers else self.split
+        for _ in range(n):
+            yield split(train_prop, test_prop)
+
+    def _subcorpora(self, train_utt_ids, test_utt_ids):
+        """Return the pair of (train, testing) subcorpora"""
+        return tuple(
+            self.corpus.subcorpus(
+                utt_ids, prune=self.prune, validate=self.validate)
+            for utt_ids in (train_utt_ids, test_utt_ids))
 
     def _proportions(self, train_prop, test_prop):
         """Return 'regularized' proportions of test and train data
@@ -201,7 +378,7 @@ class CorpusSplit(object):
         """
         # set default proportion values
         if test_prop is None:
-            test_prop = (self.default_test_prop
+            test_prop = (self.default_test_prop()
                          if train_prop is None else 1 - train_prop)
         if train_prop is None:
             train_prop = 1 - test_prop
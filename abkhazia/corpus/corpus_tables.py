@@ -0,0 +1,815 @@
+# Copyright 2016 Thomas Schatz, Xuan-Nga Cao, Mathieu Bernard
+#
+# This file is part of abkhazia: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Abkhazia is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with abkhazia. If not, see <http://www.gnu.org/licenses/>.
+"""Provides array-backed tables for a compact Corpus representation
+
+On large corpora, storing segments, text, utt2spk and lexicon as
+dicts of Python strings and tuples is very memory consuming. The
+tables defined here are drop-in replacements for those dicts: they
+implement the same mapping interface but intern utterance, speaker,
+wav and word ids to integer codes and store the values in numpy
+arrays.
+
+Tables built with new_tables() share their string tables, so an
+utterance id is stored once for segments, text and utt2spk, and a
+word is stored once for text and lexicon.
+
+The view() function returns a copy-on-write view on a subset of a
+table (a compact table or a dict), used to build subcorpora without
+copying the data.
+
+All the tables defined here count their modifications in a `version`
+attribute. For dicts, this is done by TrackedDict. This allows to
+cache data derived from a table until it is modified (see
+Corpus.spk2utt for instance).
+
+Exemple:
+--------
+
+  tables = new_tables()
+  segments = tables['segments']
+  segments['s01u01'] = ('s01.wav', 0, 0.75)
+  assert segments['s01u01'] == ('s01.wav', 0.0, 0.75)
+
+"""
+
+import collections.abc
+import copy
+import itertools
+import os
+import weakref
+
+import numpy as np
+
+
+class StringTable(object):
+    """Intern strings as integer codes
+
+    The codes are allocated in insertion order, starting from 0. A
+    string is never removed from the table so its code is stable.
+
+    """
+    def __init__(self, strings=()):
+        self.strings = []
+        self.codes = {}
+        for string in strings:
+            self.add(string)
+
+    @classmethod
+    def from_list(cls, strings):
+        """Return a table from a list of unique strings, in code order"""
+        table = cls()
+        table.strings = strings
+        table.codes = {string: code for code, string in enumerate(strings)}
+        return table
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __contains__(self, string):
+        return string in self.codes
+
+    def __getitem__(self, code):
+        return self.strings[code]
+
+    def add(self, string):
+        """Return the code of `string`, registering it if needed"""
+        try:
+            return self.codes[string]
+        except KeyError:
+            code = len(self.strings)
+            self.strings.append(string)
+            self.codes[string] = code
+            return code
+
+    def add_many(self, strings):
+        """Return the codes of `strings` as an array, registering them
+
+        This is equivalent to calling add() on each string, but faster
+        on large lists.
+
+        """
+        codes = self.codes
+        new = [s for s in dict.fromkeys(strings) if s not in codes]
+        codes.update(zip(new, range(len(self.strings), len(codes) + len(new))))
+        self.strings.extend(new)
+        return np.fromiter(
+            map(codes.__getitem__, strings), dtype=np.int64, count=len(strings))
+
+    def code(self, string, default=None):
+        """Return the code of `string` or `default` if not registered"""
+        return self.codes.get(string, default)
+
+
+class _Column(object):
+    """A numpy array growing on demand, unused cells are `fill`"""
+    def __init__(self, dtype, fill):
+        self.fill = fill
+        self.data = np.empty(0, dtype=dtype)
+
+    def head(self, size):
+        """Return the `size` first elements of the column"""
+        if size > self.data.shape[0]:
+            self.reserve(size)
+        return self.data[:size]
+
+    def copy(self):
+        """Return a copy of the column"""
+        column = _Column(self.data.dtype, self.fill)
+        column.data = self.data.copy()
+        return column
+
+    def reserve(self, size):
+        """Ensure the column can store at least `size` elements"""
+        if size > self.data.shape[0]:
+            data = np.full(
+                max(size, 2 * self.data.shape[0], 16),
+                self.fill, dtype=self.data.dtype)
+            data[:self.data.shape[0]] = self.data
+            self.data = data
+
+
+class AbstractTable(collections.abc.MutableMapping):
+    """Base class of the array-backed tables
+
+    A table maps keys interned in `keys` (a StringTable) to values
+    stored in columns indexed by the key codes. Child classes must
+    implement the _get() and _set() methods.
+
+    """
+    def __init__(self, keys):
+        self.keys_table = keys
+        self._mask = _Column(bool, False)
+        self._size = 0
+
+        # True when the columns are shared with a view (see view())
+        self._shared = False
+
+        # incremented on each modification of the table
+        self.version = 0
+
+    def _get(self, code):
+        """Return the value stored at `code`"""
+        raise NotImplementedError
+
+    def _set(self, code, value):
+        """Store `value` at `code`, columns are already reserved"""
+        raise NotImplementedError
+
+    def _set_many(self, codes, values):
+        """Store `values` at `codes`, columns are already reserved
+
+        Child classes can override this method for a vectorized
+        implementation.
+
+        """
+        for code, value in zip(codes, values):
+            self._set(code, value)
+
+    def _reserve(self, size):
+        """Reserve space for `size` keys in all the columns"""
+        self._mask.reserve(size)
+
+    def _columns(self):
+        """Return the columns indexed by key codes as a dict"""
+        return {'mask': self._mask}
+
+    def dump(self):
+        """Return the content of the table as a dict of numpy arrays
+
+        The string tables are not included. The table can be restored
+        with restore(), on an empty table with the same string tables.
+
+        """
+        size = len(self.keys_table)
+        return {name: column.head(size)
+                for name, column in self._columns().items()}
+
+    def restore(self, arrays):
+        """Restore the table from arrays returned by dump()
+
+        The arrays are used as is (not copied), they can be
+        memory-mapped.
+
+        """
+        for name, column in self._columns().items():
+            column.data = arrays[name]
+        self._size = int(np.count_nonzero(self._mask.data))
+        self.version += 1
+
+    def empty_like(self):
+        """Return an empty table sharing the string tables of this one"""
+        raise NotImplementedError
+
+    def view(self, keys):
+        """Return a copy-on-write view of the table restricted to `keys`
+
+        The view is a table sharing the columns of this one, only its
+        mask is allocated. The columns are copied when the view (or
+        this table) is modified for the first time.
+
+        Raise KeyError if a key is not in the table.
+
+        """
+        keys = list(keys)
+        codes = np.fromiter(
+            map(self._code, keys), dtype=np.int64, count=len(keys))
+
+        view = copy.copy(self)
+        view._mask = _Column(bool, False)
+        view._mask.reserve(self._mask.data.shape[0])
+        view._mask.data[codes] = True
+        view._size = int(np.count_nonzero(view._mask.data))
+        view.version = 0
+        view.__dict__.pop('saved', None)
+
+        self._shared = view._shared = True
+        return view
+
+    def _unshare(self):
+        """Copy the columns shared with a view, if any"""
+        if self._shared:
+            for name, value in list(vars(self).items()):
+                if isinstance(value, _Column) and name != '_mask':
+                    setattr(self, name, value.copy())
+            self._shared = False
+
+    def _code(self, key):
+        """Return the code of `key` in the table, raise KeyError if absent"""
+        code = self.keys_table.code(key)
+        if code is None or code >= self._mask.data.shape[0] \
+           or not self._mask.data[code]:
+            raise KeyError(key)
+        return code
+
+    def codes(self):
+        """Return the codes of the keys stored in the table as an array"""
+        return np.flatnonzero(self._mask.data)
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        strings = self.keys_table.strings
+        for code in self.codes():
+            yield strings[code]
+
+    def __contains__(self, key):
+        try:
+            self._code(key)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, key):
+        return self._get(self._code(key))
+
+    def __setitem__(self, key, value):
+        self._unshare()
+        code = self.keys_table.add(key)
+        self._reserve(code + 1)
+        self._set(code, value)
+        if not self._mask.data[code]:
+            self._mask.data[code] = True
+            self._size += 1
+        self.version += 1
+
+    def __delitem__(self, key):
+        self._mask.data[self._code(key)] = False
+        self._size -= 1
+        self.version += 1
+
+    def extend(self, mapping):
+        """Insert all the items of `mapping` in the table
+
+        This is equivalent to update() but much faster on large
+        mappings as the values are stored in bulk.
+
+        """
+        codes = self.keys_table.add_many(list(mapping))
+        if not codes.shape[0]:
+            return
+        self._unshare()
+        self._reserve(int(codes.max()) + 1)
+        self._set_many(codes, list(mapping.values()))
+        self._size += int(np.count_nonzero(~self._mask.data[codes]))
+        self._mask.data[codes] = True
+        self.version += 1
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, dict(self.items()))
+
+
+class SegmentsTable(AbstractTable):
+    """Utterances mapped to (wav_id, tbegin, tend)
+
+    Timestamps are stored as float64, None is stored as NaN.
+
+    """
+    def __init__(self, utts, wavs):
+        super(SegmentsTable, self).__init__(utts)
+        self.wavs_table = wavs
+        self._wav = _Column(np.int32, -1)
+        self._start = _Column(np.float64, np.nan)
+        self._stop = _Column(np.float64, np.nan)
+
+    def empty_like(self):
+        return SegmentsTable(self.keys_table, self.wavs_table)
+
+    def _reserve(self, size):
+        super(SegmentsTable, self)._reserve(size)
+        for column in (self._wav, self._start, self._stop):
+            column.reserve(size)
+
+    def _columns(self):
+        columns = super(SegmentsTable, self)._columns()
+        columns.update(wav=self._wav, start=self._start, stop=self._stop)
+        return columns
+
+    @staticmethod
+    def _time(t):
+        return None if np.isnan(t) else float(t)
+
+    def _get(self, code):
+        return (self.wavs_table[self._wav.data[code]],
+                self._time(self._start.data[code]),
+                self._time(self._stop.data[code]))
+
+    def _set(self, code, value):
+        wav, start, stop = value
+        self._wav.data[code] = self.wavs_table.add(wav)
+        self._start.data[code] = np.nan if start is None else start
+        self._stop.data[code] = np.nan if stop is None else stop
+
+    def _set_many(self, codes, values):
+        self._wav.data[codes] = self.wavs_table.add_many(
+            [value[0] for value in values])
+        # None is converted to NaN
+        self._start.data[codes] = np.array(
+            [value[1] for value in values], dtype=np.float64)
+        self._stop.data[codes] = np.array(
+            [value[2] for value in values], dtype=np.float64)
+
+    def columns(self):
+        """Return the arrays (utt codes, wav codes, starts, stops)"""
+        codes = self.codes()
+        return (codes, self._wav.data[codes],
+                self._start.data[codes], self._stop.data[codes])
+
+
+class LabelsTable(AbstractTable):
+    """Keys mapped to a single string label, as in utt2spk"""
+    def __init__(self, keys, labels):
+        super(LabelsTable, self).__init__(keys)
+        self.labels_table = labels
+        self._label = _Column(np.int32, -1)
+
+    def empty_like(self):
+        return LabelsTable(self.keys_table, self.labels_table)
+
+    def _reserve(self, size):
+        super(LabelsTable, self)._reserve(size)
+        self._label.reserve(size)
+
+    def _columns(self):
+        columns = super(LabelsTable, self)._columns()
+        columns.update(label=self._label)
+        return columns
+
+    def _get(self, code):
+        return self.labels_table[self._label.data[code]]
+
+    def _set(self, code, value):
+        self._label.data[code] = self.labels_table.add(value)
+
+    def _set_many(self, codes, values):
+        self._label.data[codes] = self.labels_table.add_many(values)
+
+    def columns(self):
+        """Return the arrays (key codes, label codes)"""
+        codes = self.codes()
+        return codes, self._label.data[codes]
+
+
+class TokensTable(AbstractTable):
+    """Keys mapped to a sequence of space separated tokens
+
+    Used for text (utterances mapped to words) and lexicon (words
+    mapped to phones). The tokens of all the entries are stored in a
+    single array, each entry being an (offset, length) slice of it.
+
+    """
+    def __init__(self, keys, tokens):
+        super(TokensTable, self).__init__(keys)
+        self.tokens_table = tokens
+        self._tokens = _Column(np.int32, -1)
+        self._ntokens = 0
+        self._offset = _Column(np.int64, 0)
+        self._length = _Column(np.int32, 0)
+
+    def empty_like(self):
+        return TokensTable(self.keys_table, self.tokens_table)
+
+    def _reserve(self, size):
+        super(TokensTable, self)._reserve(size)
+        self._offset.reserve(size)
+        self._length.reserve(size)
+
+    def _columns(self):
+        columns = super(TokensTable, self)._columns()
+        columns.update(offset=self._offset, length=self._length)
+        return columns
+
+    def dump(self):
+        arrays = super(TokensTable, self).dump()
+        arrays['tokens'] = self._tokens.head(self._ntokens)
+        return arrays
+
+    def restore(self, arrays):
+        super(TokensTable, self).restore(arrays)
+        self._tokens.data = arrays['tokens']
+        self._ntokens = arrays['tokens'].shape[0]
+
+    def _get(self, code):
+        strings = self.tokens_table.strings
+        return ' '.join(strings[t] for t in self.tokens(code))
+
+    def _set(self, code, value):
+        tokens = [self.tokens_table.add(t) for t in value.split()]
+        self._tokens.reserve(self._ntokens + len(tokens))
+        self._tokens.data[self._ntokens:self._ntokens + len(tokens)] = tokens
+        self._offset.data[code] = self._ntokens
+        self._length.data[code] = len(tokens)
+        self._ntokens += len(tokens)
+
+    def _set_many(self, codes, values):
+        # when the tokens are separated by a single space (as in the
+        # files written by CorpusSaver), split all the values at once
+        # and count the spaces to get the length of each value. This
+        # holds only if splitting on single spaces gives the same
+        # tokens than splitting on any whitespace (no empty values,
+        # no consecutive spaces, tabs, etc...), else split each value.
+        joined = ' '.join(values)
+        tokens = joined.split(' ')
+        length = np.fromiter(
+            (value.count(' ') + 1 for value in values),
+            dtype=np.int64, count=len(values))
+        if length.sum() != len(tokens) or tokens != joined.split():
+            tokens = [value.split() for value in values]
+            length = np.fromiter(
+                map(len, tokens), dtype=np.int64, count=len(tokens))
+            tokens = list(itertools.chain.from_iterable(tokens))
+        ntokens = len(tokens)
+
+        self._tokens.reserve(self._ntokens + ntokens)
+        self._tokens.data[self._ntokens:self._ntokens + ntokens] = (
+            self.tokens_table.add_many(tokens))
+        self._offset.data[codes] = self._ntokens + np.cumsum(length) - length
+        self._length.data[codes] = length
+        self._ntokens += ntokens
+
+    def columns(self):
+        """Return the arrays (key codes, offsets, lengths, tokens)
+
+        The tokens of the entry at codes[i] are
+        tokens[offsets[i]:offsets[i] + lengths[i]]
+
+        """
+        codes = self.codes()
+        return (codes, self._offset.data[codes], self._length.data[codes],
+                self._tokens.head(self._ntokens))
+
+    def tokens(self, code):
+        """Return the token codes of the entry at `code` as an array"""
+        offset = self._offset.data[code]
+        return self._tokens.data[offset:offset + self._length.data[code]]
+
+
+def new_tables(strings=None):
+    """Return empty segments, text, utt2spk and lexicon tables
+
+    The returned tables are in a dict indexed by the name of the
+    Corpus attribute they implement. They share the string tables of
+    utterances (segments, text, utt2spk) and words (text, lexicon).
+
+    `strings` is an optional dict of StringTable to use, as returned
+    by string_tables(), new string tables are created if not
+    specified.
+
+    """
+    if strings is None:
+        strings = {name: StringTable() for name in (
+            'utts', 'words', 'wavs', 'speakers', 'phones')}
+
+    return {
+        'segments': SegmentsTable(strings['utts'], strings['wavs']),
+        'text': TokensTable(strings['utts'], strings['words']),
+        'utt2spk': LabelsTable(strings['utts'], strings['speakers']),
+        'lexicon': TokensTable(strings['words'], strings['phones'])}
+
+
+def string_tables(tables):
+    """Return the string tables used by `tables` as a dict
+
+    `tables` is a dict of tables as returned by new_tables(), this is
+    the reverse operation.
+
+    """
+    return {'utts': tables['segments'].keys_table,
+            'words': tables['text'].tokens_table,
+            'wavs': tables['segments'].wavs_table,
+            'speakers': tables['utt2spk'].labels_table,
+            'phones': tables['lexicon'].tokens_table}
+
+
+def wav_ids(segments):
+    """Return the set of wav ids referenced in `segments`"""
+    if isinstance(segments, SegmentsTable):
+        _, wavs, _, _ = segments.columns()
+        return {segments.wavs_table[code] for code in np.unique(wavs)}
+    return {wav for wav, _, _ in segments.values()}
+
+
+class _Viewed(object):
+    """A mapping that can be viewed by DictView instances
+
+    Before the mapping is modified, its views copy their values so
+    they are not affected by the modification.
+
+    """
+    def _add_view(self, view):
+        # views are mappings, so not hashable: index them by id
+        views = self.__dict__.get('_views')
+        if views is None:
+            views = self.__dict__['_views'] = weakref.WeakValueDictionary()
+        views[id(view)] = view
+
+    def _detach_views(self):
+        """Make the views copy their values, call before any modification"""
+        views = self.__dict__.pop('_views', None)
+        for view in list(views.values()) if views else ():
+            view._data()
+
+
+class DictView(_Viewed, collections.abc.MutableMapping):
+    """A copy-on-write view on a subset of a dict
+
+    The view stores only its keys and reads the values from the
+    viewed dict. When the view or the viewed dict is modified for the
+    first time, the values are copied in a dict owned by the view, so
+    the view and the viewed dict never see the modifications of each
+    other. Deleting a key of the view does not trigger a copy.
+
+    Only TrackedDict and DictView notify their views before being
+    modified, other dicts are copied when the view is created.
+
+    Raise KeyError if a key is not in the viewed dict.
+
+    """
+    def __init__(self, table, keys):
+        self._table = table
+        self._keys = dict.fromkeys(keys)
+        self._copy = None
+        self.version = 0
+
+        for key in self._keys:
+            if key not in table:
+                raise KeyError(key)
+
+        if isinstance(table, _Viewed):
+            table._add_view(self)
+        else:
+            self._data()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('_views', None)
+        return state
+
+    def _data(self):
+        """Return a dict owned by the view, copying the values if needed"""
+        if self._copy is None:
+            self._copy = {key: self._table[key] for key in self._keys}
+            self._table = self._keys = None
+        return self._copy
+
+    def __len__(self):
+        return len(self._keys if self._copy is None else self._copy)
+
+    def __iter__(self):
+        return iter(self._keys if self._copy is None else self._copy)
+
+    def __contains__(self, key):
+        return key in (self._keys if self._copy is None else self._copy)
+
+    def __getitem__(self, key):
+        if self._copy is not None:
+            return self._copy[key]
+        if key not in self._keys:
+            raise KeyError(key)
+        return self._table[key]
+
+    def __setitem__(self, key, value):
+        self._detach_views()
+        self._data()[key] = value
+        self.version += 1
+
+    def __delitem__(self, key):
+        self._detach_views()
+        del (self._keys if self._copy is None else self._copy)[key]
+        self.version += 1
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, dict(self.items()))
+
+
+class TrackedDict(_Viewed, dict):
+    """A dict counting its modifications in its `version` attribute
+
+    The views on the dict (see DictView) are detached before any
+    modification.
+
+    """
+    version = 0
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),), {'version': self.version})
+
+    def _modified(self):
+        self.version += 1
+
+    def __setitem__(self, key, value):
+        self._detach_views()
+        super(TrackedDict, self).__setitem__(key, value)
+        self._modified()
+
+    def __delitem__(self, key):
+        self._detach_views()
+        super(TrackedDict, self).__delitem__(key)
+        self._modified()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        self._detach_views()
+        super(TrackedDict, self).clear()
+        self._modified()
+
+    def pop(self, *args):
+        self._detach_views()
+        value = super(TrackedDict, self).pop(*args)
+        self._modified()
+        return value
+
+    def popitem(self):
+        self._detach_views()
+        item = super(TrackedDict, self).popitem()
+        self._modified()
+        return item
+
+    def setdefault(self, key, default=None):
+        self._detach_views()
+        value = super(TrackedDict, self).setdefault(key, default)
+        self._modified()
+        return value
+
+    def update(self, *args, **kwargs):
+        self._detach_views()
+        super(TrackedDict, self).update(*args, **kwargs)
+        self._modified()
+
+
+class KeyList(list):
+    """A list of unique keys with O(1) membership tests
+
+    The membership tests use a set built with the list, or shared
+    with it by `index`. Once the list is modified, they fall back to
+    the linear search of a list.
+
+    """
+    def __init__(self, keys=(), index=None):
+        super(KeyList, self).__init__(keys)
+        self._index = frozenset(self) if index is None else index
+
+    def copy(self):
+        return KeyList(self, self._index)
+
+    def __contains__(self, key):
+        if self._index is None:
+            return super(KeyList, self).__contains__(key)
+        return key in self._index
+
+    def _modified(self):
+        self._index = None
+
+    def __setitem__(self, index, value):
+        self._modified()
+        super(KeyList, self).__setitem__(index, value)
+
+    def __delitem__(self, index):
+        self._modified()
+        super(KeyList, self).__delitem__(index)
+
+    def __iadd__(self, other):
+        self._modified()
+        return super(KeyList, self).__iadd__(other)
+
+    def append(self, key):
+        self._modified()
+        super(KeyList, self).append(key)
+
+    def extend(self, keys):
+        self._modified()
+        super(KeyList, self).extend(keys)
+
+    def insert(self, index, key):
+        self._modified()
+        super(KeyList, self).insert(index, key)
+
+    def pop(self, *args):
+        self._modified()
+        return super(KeyList, self).pop(*args)
+
+    def remove(self, key):
+        self._modified()
+        super(KeyList, self).remove(key)
+
+    def clear(self):
+        self._modified()
+        super(KeyList, self).clear()
+
+
+def version(table):
+    """Return the version of `table`, None if modifications are not tracked
+
+    Tables defined in this module are tracked, plain dicts are not.
+
+    """
+    return getattr(table, 'version', None)
+
+
+def mark_saved(table, path, stat=None):
+    """Record in `table` that its current content is stored in `path`
+
+    `stat` is the (size, mtime in ns) of the file `path`, taken
+    before it has been read, default to the current stat of `path`.
+    Does nothing if the modifications of `table` are not tracked.
+
+    """
+    if version(table) is None:
+        return
+    if stat is None:
+        stat = os.stat(path)
+        stat = (stat.st_size, stat.st_mtime_ns)
+    table.saved = (os.path.realpath(path), stat[0], stat[1], version(table))
+
+
+def is_saved(table, path):
+    """Return True if the content of `table` is stored in `path`
+
+    That is `table` is not modified since it has been loaded from,
+    or saved to, `path` (see mark_saved) and `path` did not change
+    since.
+
+    """
+    saved = getattr(table, 'saved', None)
+    if saved is None:
+        return False
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return saved == (os.path.realpath(path), stat.st_size,
+                     stat.st_mtime_ns, version(table))
+
+
+def view(table, keys):
+    """Return a copy-on-write view of `table` restricted to `keys`
+
+    `table` is either a compact table or a dict (in that case the
+    view is a DictView). Raise KeyError if a key is not in `table`.
+
+    """
+    if isinstance(table, AbstractTable):
+        return table.view(keys)
+    return DictView(table, keys)
+
+
+def empty_like(table):
+    """Return an empty mapping of the same kind as `table`"""
+    if isinstance(table, AbstractTable):
+        return table.empty_like()
+    return dict()
@@ -14,10 +14,19 @@
 # along with abkhazia. If not, see <http://www.gnu.org/licenses/>.
 """Provides the CorpusValidation class"""
 
+import bisect
 import collections
+import hashlib
+import json
 import os
+import struct
 
-from abkhazia.utils import duplicates, logger, wav, default_njobs
+import joblib
+import numpy as np
+
+from abkhazia.corpus import corpus_tables
+from abkhazia.corpus.corpus_saver import CorpusSaver
+from abkhazia.utils import duplicates, logger, wav, default_njobs, open_utf8
 
 
 def resume_list(l, n=10):
@@ -28,6 +37,98 @@ def resume_list(l, n=10):
         ' ... and {} more.'.format(len(l) - n))
 
 
+def _signal_stats(path, segments, silence_threshold):
+    """Return wav.signal_stats on `path`, None if the wav is not readable
+
+    This function is executed in worker processes and never raises.
+
+    """
+    try:
+        return wav.signal_stats(
+            path, segments, silence_threshold=silence_threshold)
+    except (IOError, OSError, ValueError, struct.error):
+        return None
+
+
+class ValidationCache(object):
+    """Persist the results of a corpus validation
+
+    The cache stores the metadata of the scanned wavs, keyed by the
+    wav name and validated against the size and modification time of
+    the files, and a key for each check passed by the corpus (see
+    CorpusValidation._check). It is persisted to a JSON file
+    `filename`.
+
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.wavs = {}
+        self.checks = {}
+        self._dirty = False
+
+        if filename is not None and os.path.isfile(filename):
+            try:
+                with open(filename, 'r') as stream:
+                    data = json.load(stream)
+                self.wavs = {
+                    w: (size, mtime, wav._metawav(*meta))
+                    for w, (size, mtime, meta) in data['wavs'].items()}
+                self.checks = data['checks']
+            except (ValueError, KeyError, TypeError):  # corrupted cache
+                self.wavs, self.checks = {}, {}
+
+    def get_wav(self, name, stat):
+        """Return the cached metadata of the wav `name`, None if unknown
+
+        `stat` is the (size, mtime in ns) of the wav file, the cached
+        metadata is returned only if it has been read from the same
+        file.
+
+        """
+        try:
+            size, mtime, meta = self.wavs[name]
+        except KeyError:
+            return None
+        return meta if (size, mtime) == stat else None
+
+    def set_wav(self, name, stat, meta):
+        self.wavs[name] = (stat[0], stat[1], meta)
+        self._dirty = True
+
+    def set_check(self, name, key):
+        if self.checks.get(name) != key:
+            self.checks[name] = key
+            self._dirty = True
+
+    def save(self):
+        """Write the cache to its file if it has been modified
+
+        Errors on writing are ignored (the cache is only an
+        optimization), in that case return False, else return True.
+
+        """
+        if self.filename is None or not self._dirty:
+            return True
+
+        try:
+            directory = os.path.dirname(self.filename)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'w') as stream:
+                json.dump({
+                    'wavs': {w: (size, mtime, list(meta))
+                             for w, (size, mtime, meta) in self.wavs.items()},
+                    'checks': self.checks}, stream)
+            os.replace(tmp, self.filename)
+        except (OSError, IOError):
+            return False
+
+        self._dirty = False
+        return True
+
+
 class CorpusValidation(object):
     """Check and correct a speech corpus
 
@@ -39,6 +140,9 @@ class CorpusValidation(object):
     log (logging.Logger): the logging instance to send messages, by
       default disable logging.
 
+    full (bool): when False (default), the checks already passed by
+      the corpus are skipped, when True the whole corpus is checked.
+
     Beware that it automatically corrects some basics problems and
     thus it can modify the original corpus. For example it add default
     values to phone inventories when they are missing.
@@ -50,7 +154,38 @@ class CorpusValidation(object):
     validate(). If you want a fine-grained validation, use the
     specialized validate_SOMETHING() methods.
 
+    Validation cache
+    ----------------
+
+    When the corpus has a cache directory (i.e. it has been loaded
+    from disk), the results of the validation are persisted in
+    `cache_file` in that directory (see ValidationCache). The wavs are
+    scanned only when they are new or modified, and the other checks
+    are skipped when their inputs did not change since they passed:
+    the inputs are identified by the hashes of the corpus files they
+    are loaded from (or by their content for the small phones,
+    silences and variants). Checks on corpus data modified in memory
+    are never skipped.
+
     """
+    cache_file = 'validation.json'
+    """The file storing the validation cache in the corpus cache_dir"""
+
+    signal_qc_file = 'signal_qc.txt'
+    """The file storing the signal QC table in the corpus directory"""
+
+    signal_qc_fields = wav._signal_stats._fields
+    """The columns of the signal QC table, after the utterance ids"""
+
+    max_clipping = 0.001
+    """maximal proportion of clipped samples in an utterance"""
+
+    max_dc_offset = 0.01
+    """maximal DC offset (mean amplitude) of an utterance"""
+
+    max_silence = 0.99
+    """maximal proportion of silent frames in an utterance"""
+
     wav_min_duration = 0.1
     """minimal duration for utterances
 
@@ -60,10 +195,21 @@ class CorpusValidation(object):
     """
 
     def __init__(self, corpus, njobs=default_njobs(),
-                 log=logger.null_logger()):
+                 log=logger.null_logger(), full=False):
         self.corpus = corpus
         self.njobs = njobs
         self.log = log
+        self.full = full
+
+        self.cache = ValidationCache(
+            None if corpus.cache_dir is None
+            else os.path.join(corpus.cache_dir, self.cache_file))
+
+        # fingerprints of the corpus files, loaded on demand by _key()
+        self._fingerprints = None
+
+        # key of the wavs metadata, computed by validate_wavs()
+        self._wavs_key = None
 
     def validate(self, meta=None):
         """Validate the whole corpus
@@ -81,23 +227,32 @@ class CorpusValidation(object):
 
         """
         self.log.info('validating corpus')
-        if not self.corpus.utts():
+        if not self.corpus.utt2spk:
             raise IOError('corpus is empty')
 
         if meta is None:
             meta = self.validate_wavs()
-        self.validate_segments(meta)
+        self._check('segments', lambda: self.validate_segments(meta),
+                    'wavs', 'segments')
 
-        self.validate_speakers()
-        self.validate_transcription()
+        self._check('speakers', self.validate_speakers,
+                    'segments', 'utt2spk')
+        self._check('transcription', self.validate_transcription,
+                    'segments', 'text')
 
+        # phones are always checked, this is cheap and may fix the
+        # silences in place
         inventory = self.validate_phones()
-        self.validate_lexicon(inventory)
+        self._check('lexicon', lambda: self.validate_lexicon(inventory),
+                    'lexicon', 'text', 'phones', 'silences', 'variants')
+
+        if self.corpus.cache_dir is not None:
+            self.cache.save()
 
         self.log.debug("corpus validated: ready for use with abkhazia")
         self.log.info(
             "corpus of %d utterances from %s speakers, total duration: %s",
-            len(self.corpus.utts()), len(self.corpus.spks()),
+            len(self.corpus.utt2spk), len(self.corpus.spks()),
             self.corpus.duration(format='datetime'))
         return meta
 
@@ -109,26 +264,68 @@ class CorpusValidation(object):
         if not(os.path.isdir(wav_folder)):
             raise IOError(
                 "Wav folder {} does not exist".format(wav_folder))
-        wavs = [os.path.join(wav_folder, w) for w in self.corpus.wavs]
+        # the virtual merged wavs are validated from the files they
+        # are made of
+        wavs = [os.path.join(wav_folder, w) for w in self.corpus.wav_files()]
 
         # ensure all the files have the wav extension
-        wrong_extensions = [w for w in wavs if not w.endswith(".wav")]
+        wrong_extensions = [
+            w for w in wavs + list(self.corpus.wavs) if not w.endswith(".wav")]
         if wrong_extensions:
             raise IOError(
                 "The following wavs do not have a '.wav' extension: {}"
                 .format(resume_list(wrong_extensions)))
 
         # ensure all the wavs are here
-        not_here = [
-            w for w in wavs if not os.path.isfile(w)]
+        stats = {}
+        for w in wavs:
+            if os.path.isfile(w):
+                stat = os.stat(w)
+                stats[os.path.basename(w)] = (stat.st_size, stat.st_mtime_ns)
+        not_here = [w for w in wavs if os.path.basename(w) not in stats]
         if not_here:
             raise IOError(
                 "The following wavs do not exist: {}".format(
                     resume_list(not_here)))
 
-        # get meta information on the wavs
-        meta = wav.scan(wavs, njobs=self.njobs)
-        meta = {os.path.basename(k): v for k, v in meta.items()}
+        # get meta information on the wavs, reusing the one cached in
+        # the corpus by a previous validation (as when validating a
+        # subcorpus after its parent) or in the validation cache
+        meta = {}
+        if not self.full:
+            cached = self.corpus.wavs_meta
+            for w, stat in stats.items():
+                try:
+                    cached_stat, value = cached[w]
+                    if cached_stat != stat:
+                        value = self.cache.get_wav(w, stat)
+                except KeyError:
+                    value = self.cache.get_wav(w, stat)
+                if value is not None:
+                    meta[w] = value
+
+        wavs = [w for w in wavs if os.path.basename(w) not in meta]
+        self.log.debug(
+            'scanning %i wavs (%i cached)', len(wavs), len(meta))
+        scanned = wav.scan(wavs, njobs=self.njobs) if wavs else {}
+        for w, value in scanned.items():
+            w = os.path.basename(w)
+            meta[w] = value
+            self.cache.set_wav(w, stats[w], value)
+
+        # cache the metadata in the corpus for further validations
+        # (shared with the subcorpora)
+        self.corpus.wavs_meta.update(
+            (w, (stat, meta[w])) for w, stat in stats.items())
+
+        merged = self._merged_wavs_meta(meta)
+        meta.update(merged)
+
+        self._wavs_key = hashlib.sha1((''.join(
+            '{} {} {}\n'.format(w, *stats[w])
+            for w in sorted(stats)) + ''.join(
+                '{} {}\n'.format(w, self.corpus.merged_wavs[w])
+                for w in sorted(merged))).encode('utf-8')).hexdigest()
 
         missing_meta = set.difference(self.corpus.wavs, meta.keys())
         if missing_meta:
@@ -172,52 +369,140 @@ class CorpusValidation(object):
 
         return meta
 
+    def _merged_wavs_meta(self, meta):
+        """Return the metadata of the virtual merged wavs
+
+        `meta` is the metadata of the wav files. The wavs a virtual
+        wav is made of must have the same format and fit in the
+        virtual wav, raise IOError otherwise.
+
+        """
+        merged = {}
+        for wav in self.corpus.wavs:
+            if wav not in self.corpus.merged_wavs:
+                continue
+
+            files = self.corpus.merged_wavs[wav]
+            if any(w not in meta for w, _, _ in files):
+                # missing files are reported later
+                continue
+
+            first = meta[files[0][0]]
+            formats = {meta[w][:3] + meta[w][4:6] for w, _, _ in files}
+            if len(formats) != 1:
+                raise IOError(
+                    'the wavs merged in {} have different formats'
+                    .format(wav))
+
+            end = 0
+            for w, offset, duration in files:
+                if offset < end or abs(duration - meta[w].duration) > 1e-3:
+                    raise IOError(
+                        'invalid merged wav {}: {} at {} lasts {}s, '
+                        'it overlaps the previous one or has a wrong '
+                        'duration'.format(wav, w, offset, duration))
+                end = offset + duration
+
+            merged[wav] = first._replace(
+                nframes=int(round(end * first.rate)), duration=end)
+        return merged
+
+    def _key(self, *names):
+        """Return a key identifying the content of the corpus `names`
+
+        `names` are corpus attributes or 'wavs'. The key is a hash of
+        the corpus files the attributes are loaded from, or of their
+        content for the untracked attributes (phones, silences and
+        variants). Return None if the key cannot be computed, as when
+        an attribute has been modified since loaded.
+
+        """
+        if self.corpus.cache_dir is None:
+            return None
+        corpus_dir = os.path.dirname(self.corpus.cache_dir)
+        if self._fingerprints is None:
+            self._fingerprints = CorpusSaver.load_fingerprints(corpus_dir)
+
+        hashes = []
+        for name in names:
+            if name == 'wavs':
+                if self._wavs_key is None:
+                    return None
+                hashes.append(self._wavs_key)
+                continue
+
+            table = getattr(self.corpus, name)
+            path = os.path.join(corpus_dir, name + '.txt')
+            if corpus_tables.version(table) is None:
+                items = table.items() if isinstance(table, dict) else table
+                hashes.append(hashlib.sha1(
+                    repr(sorted(items)).encode('utf-8')).hexdigest())
+            elif corpus_tables.is_saved(table, path):
+                hashes.append(CorpusSaver.file_sha1(path, self._fingerprints))
+            else:
+                return None
+
+        return hashlib.sha1(' '.join(hashes).encode('utf-8')).hexdigest()
+
+    def _check(self, name, check, *inputs):
+        """Call `check` unless it already passed on the same `inputs`
+
+        `inputs` are names of the corpus attributes the check depends
+        on (see _key). The check is skipped if it is cached with the
+        same key, unless self.full is True.
+
+        """
+        key = self._key(*inputs)
+        if key is not None and not self.full and \
+                self.cache.checks.get(name) == key:
+            self.log.debug('skipping %s check (cached)', name)
+            return
+
+        check()
+
+        # the check may correct the corpus (e.g. by adding <unk> to
+        # the lexicon), in that case the result is not cached
+        if key is not None and key == self._key(*inputs):
+            self.cache.set_check(name, key)
+
     def validate_segments(self, meta):
         """Checking utterances list in segments"""
         self.log.debug("checking segments")
-        segments = self.corpus.segments
-        utt_ids = segments.keys()
-        utt_wavs = [w[0] for w in segments.values()]
-        starts = [w[1] for w in segments.values()]
-        stops = [w[2] for w in segments.values()]
+        utt_ids, wavs, wav_codes, starts, stops = self._segments_arrays()
 
         # wav extension in segments
-        _no_wavs_extension = [w for w in utt_wavs if not w.endswith('.wav')]
+        _no_wavs_extension = [w for w in wavs if not w.endswith('.wav')]
         if _no_wavs_extension:
             raise IOError(
                 'There is wav-ids in segmetns without .wav extension: {}'
                 .format(resume_list(_no_wavs_extension)))
 
-        # unique utterance-ids
-        _duplicates = duplicates(utt_ids)
-        if _duplicates:
-            raise IOError(
-                "There is utterance-ids in segments used several times: {}"
-                .format(_duplicates))
-
         # all referenced wavs are in wav folder
-        ref_wavs = set(utt_wavs)
-        missing_wavefiles = set.difference(ref_wavs, self.corpus.wavs)
+        missing_wavefiles = set.difference(set(wavs), self.corpus.wavs)
         if missing_wavefiles:
             raise IOError(
                 "The following wavefiles are referenced "
                 "in segments but are not in wavs {}"
                 .format(missing_wavefiles))
 
-        if(len(ref_wavs) == len(utt_wavs) and
-           all([e is None for e in starts]) and
-           all([e is None for e in stops])):
+        # duration of the wav of each utterance
+        durations = np.array(
+            [meta[w].duration for w in wavs],
+            dtype=np.float64)[wav_codes]
+
+        if (len(wavs) == len(utt_ids) and
+                np.isnan(starts).all() and np.isnan(stops).all()):
             # simple case, with one utterance per file and no explicit
             # timestamps provided just get list of files that are very
             # short (less than 0.1s)
-            short_wavs = [utt_id for utt_id, w in zip(utt_ids, utt_wavs)
-                          if meta[w].duration < self.wav_min_duration]
+            short_wavs = [utt_ids[i] for i in np.flatnonzero(
+                durations < self.wav_min_duration)]
         else:
-            # more complicated case :find all utterances (plus
-            # timestamps) associated to each wavefile and for each
-            # wavefile, check consistency of the timestamps of all
-            # utterances inside it
-            warning, short_wavs = self._check_timestamps(meta)
+            # more complicated case: check consistency of the
+            # timestamps of all utterances within each wavefile
+            warning, short_wavs = self._check_timestamps(
+                utt_ids, wavs, wav_codes,
+                starts, stops, durations)
             if warning:
                 self.log.warning(
                     "Some utterances are overlapping in time, "
@@ -591,82 +876,271 @@ class CorpusValidation(object):
                 "The following phones are never found "
                 "in the transcriptions: {}".format(unused_phones))
 
-    def _check_timestamps(self, meta):
-        """Check for utterances overlap and timestamps consistency"""
-        self.log.debug("checking timestamps consistency")
+    def _segments_arrays(self):
+        """Return the corpus segments as arrays
 
-        short_utts = []
-        warning = False
-        for _wav, utts in self.corpus.wav2utt().items():
-            duration = meta[_wav].duration
+        Return (utt_ids, wavs, wav_codes, starts, stops) where
+        `utt_ids` and `wavs` are lists of the utterances and wavs in
+        segments, `wav_codes` is the array of the index in `wavs` of
+        the wav of each utterance, `starts` and `stops` are arrays of
+        timestamps, NaN when missing.
 
-            # check all utterances are within wav boundaries
-            for utt_id, start, stop in utts:
-                if start == stop:
-                    raise IOError(
-                        'utterance {} have a duration of 0'.format(utt_id))
+        """
+        segments = self.corpus.segments
+        if isinstance(segments, corpus_tables.SegmentsTable):
+            # compact tables already store the segments as arrays
+            codes, wav_codes, starts, stops = segments.columns()
+            wav_codes, inverse = np.unique(wav_codes, return_inverse=True)
+            return ([segments.keys_table[c] for c in codes],
+                    [segments.wavs_table[c] for c in wav_codes],
+                    inverse, starts, stops)
+
+        utt_ids = list(segments.keys())
+        values = list(segments.values())
+        wav_list = [v[0] for v in values]
+        wavs = list(set(wav_list))
+        wav_index = {w: i for i, w in enumerate(wavs)}
+        wav_codes = np.fromiter(
+            map(wav_index.__getitem__, wav_list),
+            dtype=np.int64, count=len(wav_list))
+
+        # None is converted to NaN
+        starts = np.array([v[1] for v in values], dtype=np.float64)
+        stops = np.array([v[2] for v in values], dtype=np.float64)
+        return utt_ids, wavs, wav_codes, starts, stops
+
+    def validate_signal(self, filename=None, silence_threshold=0.001):
+        """Compute signal statistics on the utterances, return a QC table
+
+        This optional stage reads the audio samples of the utterances
+        (see utils.wav.signal_stats) to detect clipped, DC-offset or
+        silent utterances. The wavs are assumed to be valid (see
+        validate_wavs), they are memory-mapped and processed in a
+        pool of self.njobs processes.
+
+        Issue warnings on suspicious utterances but never raise. The
+        utterances in unreadable wavs are ignored.
+
+        Return the QC table as a dict with the list of utterances ids
+        in 'utt', and the arrays of their statistics in 'peak', 'rms',
+        'dc', 'clipping' and 'silence'. The table is written to
+        `filename` if specified, default to `signal_qc_file` in the
+        corpus directory if the corpus has one (see
+        save_signal_qc).
 
-                if not (start >= 0 and stop >= 0 and start <= stop and
-                        start <= duration + (1.0/16000) and
-                        stop <= duration + (1.0/16000)):
-                    raise IOError(
-                        "utterance {} is not whithin boudaries in wav {} "
-                        "({} not in {})"
-                        .format(utt_id, _wav,
-                                '[{}, {}]'.format(start, stop),
-                                '[0, {}]'.format(duration)))
-
-                if stop - start < self.wav_min_duration:  # .015:
-                    short_utts.append(utt_id)
-
-            # then check if there is overlap in time between the
-            # different utterances and if there is, issue a
-            # warning (not an error)
-            wav_starts = [start for _, start, _ in utts]
-            counts = collections.Counter(wav_starts)
-            same_start = {}
-            for start in counts:
-                if counts[start] > 1:
-                    same_start[start] = [
-                        utt for utt, sta, _ in utts if sta == start]
-
-            wav_stops = [stop for _, _, stop in utts]
-            counts = collections.Counter(wav_stops)
-            same_stop = {}
-            for stop in counts:
-                if counts[stop] > 1:
-                    same_stop[stop] = [
-                        utt for utt, _, sto in utts if sto == stop]
-
-            if same_start:
-                warning = True
+        """
+        self.log.info('computing signal statistics')
+        wav2utt = self._signal_segments()
+        wavs = sorted(wav2utt)
+        wav_folder = os.path.realpath(self.corpus.wav_folder)
+
+        results = joblib.Parallel(n_jobs=self.njobs)(
+            joblib.delayed(_signal_stats)(
+                os.path.join(wav_folder, w),
+                [(start, stop) for _, start, stop in wav2utt[w]],
+                silence_threshold)
+            for w in wavs)
+
+        utts, stats = [], []
+        for w, result in zip(wavs, results):
+            if result is None:
+                self.log.warning('cannot read signal from %s', w)
+                continue
+            utts.extend(utt for utt, _, _ in wav2utt[w])
+            stats.extend(result)
+
+        table = {'utt': utts}
+        for i, field in enumerate(self.signal_qc_fields):
+            table[field] = np.array(
+                [stat[i] for stat in stats], dtype=np.float64)
+
+        for name, mask in (
+                ('clipped', table['clipping'] > self.max_clipping),
+                ('DC-offset', np.abs(table['dc']) > self.max_dc_offset),
+                ('silent', table['silence'] > self.max_silence)):
+            if mask.any():
                 self.log.warning(
-                    "The following utterances start at the same time "
-                    "in wavefile {}: {}".format(_wav, sorted(same_start)))
+                    '%i utterances are %s', np.count_nonzero(mask), name)
+                self.log.debug(
+                    '%s utterances: %s', name,
+                    resume_list(utts[i] for i in np.flatnonzero(mask)))
+
+        if filename is None and self.corpus.cache_dir is not None:
+            filename = self.signal_qc_path(
+                os.path.dirname(self.corpus.cache_dir))
+        if filename is not None:
+            self.log.debug('writing signal QC table to %s', filename)
+            self.save_signal_qc(table, filename)
+
+        return table
 
-            if same_stop:
+    @classmethod
+    def signal_qc_path(cls, corpus_dir):
+        """Return the default signal QC file of the corpus in `corpus_dir`"""
+        return os.path.join(corpus_dir, cls.signal_qc_file)
+
+    def _signal_segments(self):
+        """Return the utterances of each wav file to compute QC on
+
+        Return a dict of the files in the wav folder mapped to a list
+        of (utt-id, tstart, tend). The utterances of a virtual merged
+        wav are attributed to the file they start in, their
+        timestamps being shifted to that file.
+
+        """
+        wav2utt = self.corpus.wav2utt()
+        segments = collections.defaultdict(list)
+        for wav, utts in wav2utt.items():
+            if wav not in self.corpus.merged_wavs:
+                segments[wav].extend(utts)
+                continue
+
+            files = self.corpus.merged_wavs[wav]
+            offsets = [offset for _, offset, _ in files]
+            for utt, start, stop in utts:
+                index = max(0, bisect.bisect_right(
+                    offsets, 0. if start is None else start) - 1)
+                w, offset, duration = files[index]
+                segments[w].append((
+                    utt,
+                    None if start is None else max(0., start - offset),
+                    None if stop is None else min(duration, stop - offset)))
+        return segments
+
+    @classmethod
+    def save_signal_qc(cls, table, filename):
+        """Write the signal QC `table` to `filename`
+
+        Each line of the file is made of an utterance id followed by
+        its statistics, in the order of `signal_qc_fields`.
+
+        """
+        columns = [table[field] for field in cls.signal_qc_fields]
+        with open_utf8(filename, 'w') as out:
+            for i, utt in enumerate(table['utt']):
+                out.write(u'{} {}\n'.format(utt, ' '.join(
+                    '{:.6g}'.format(column[i]) for column in columns)))
+
+    @classmethod
+    def load_signal_qc(cls, filename):
+        """Return the signal QC table read from `filename`
+
+        Raise IOError if the file is not a valid QC table
+
+        """
+        utts, values = [], []
+        for n, line in enumerate(open_utf8(filename, 'r'), start=1):
+            line = line.split()
+            if len(line) != len(cls.signal_qc_fields) + 1:
+                raise IOError('{}: invalid line {}'.format(filename, n))
+            utts.append(line[0])
+            values.append(line[1:])
+
+        values = np.array(values, dtype=np.float64).reshape(
+            len(utts), len(cls.signal_qc_fields))
+        table = {'utt': utts}
+        for i, field in enumerate(cls.signal_qc_fields):
+            table[field] = values[:, i]
+        return table
+
+    def _check_timestamps(self, utt_ids, wavs, wav_codes,
+                          starts, stops, durations):
+        """Check for utterances overlap and timestamps consistency
+
+        `utt_ids` and `wavs` are lists of utterances and wav ids,
+        `wav_codes` are the index in `wavs` of the wav of each
+        utterance. `starts`, `stops` and `durations` are arrays of
+        the utterances timestamps (NaN when missing) and of the
+        duration of their wav.
+
+        Return (warning, short_utts) where warning is True if some
+        utterances are overlapping in time and short_utts is the list
+        of utterances shorter than self.wav_min_duration.
+
+        """
+        self.log.debug("checking timestamps consistency")
+
+        # missing timestamps stand for the begin/end of the wav
+        starts = np.where(np.isnan(starts), 0, starts)
+        stops = np.where(np.isnan(stops), durations, stops)
+
+        # check all utterances are within wav boundaries
+        null = np.flatnonzero(starts == stops)
+        if null.size:
+            raise IOError(
+                'utterance {} have a duration of 0'.format(utt_ids[null[0]]))
+
+        limit = durations + 1.0 / 16000
+        invalid = np.flatnonzero(~(
+            (starts >= 0) & (stops >= 0) & (starts <= stops) &
+            (starts <= limit) & (stops <= limit)))
+        if invalid.size:
+            i = invalid[0]
+            raise IOError(
+                "utterance {} is not whithin boudaries in wav {} "
+                "({} not in {})"
+                .format(utt_ids[i], wavs[wav_codes[i]],
+                        '[{}, {}]'.format(starts[i], stops[i]),
+                        '[0, {}]'.format(durations[i])))
+
+        short_utts = [utt_ids[i] for i in np.flatnonzero(
+            stops - starts < self.wav_min_duration)]
+
+        # then check if there is overlap in time between the
+        # different utterances and if there is, issue a warning (not
+        # an error). Utterances starting (or stopping) at the same
+        # time are contiguous once sorted by (wav, time).
+        warning = False
+        for name, times in (('start', starts), ('stop', stops)):
+            same = self._same_time(wav_codes, times)
+            for code in sorted(same, key=lambda c: wavs[c]):
                 warning = True
                 self.log.warning(
-                    "The following utterances stop at the same time "
-                    "in wavefile {}: {}".format(_wav, sorted(same_stop)))
-
-            # TODO overlap checking is buggy
-            # timestamps = list(set(wav_starts)) + list(set(wav_stops))
-            # timestamps.sort()
-            #
-            # overlapped = [
-            #     (utt, timestamps.index(stop) - timestamps.index(start))
-            #     for utt, start, stop in utts
-            #     if timestamps.index(stop) - timestamps.index(start) > 2]
-            #
-            # if overlapped:
-            #     warning = True
-            #     self.log.warning(
-            #         "The following utterances from file {} are "
-            #         "overlapping in time: {}".format(wav, overlapped))
+                    "The following utterances %s at the same time "
+                    "in wavefile %s: %s", name, wavs[code],
+                    sorted(utt_ids[i] for i in same[code]))
+
+        # an utterance overlaps a previous one in the same wav if it
+        # starts before the maximal stop of the previous ones. The
+        # wavs are shifted on a single time axis so that the running
+        # maximum does not need to be reset on each wav
+        order = np.lexsort((starts, wav_codes))
+        offsets = wav_codes[order] * (np.max(stops) + 1)
+        stops_max = np.maximum.accumulate(stops[order] + offsets)
+        overlapped = np.flatnonzero(
+            starts[order][1:] + offsets[1:] < stops_max[:-1]) + 1
+        if overlapped.size:
+            warning = True
+            self.log.debug(
+                "The following utterances are overlapping in time "
+                "with a previous one in their wavefile: %s",
+                resume_list(utt_ids[i] for i in order[overlapped]))
 
         return warning, short_utts
 
+    @staticmethod
+    def _same_time(wav_codes, times):
+        """Return utterances with the same time in a wav
+
+        Return a dict wav code -> utterances indices, listing the
+        utterances sharing a time with another one in the same wav.
+
+        """
+        order = np.lexsort((times, wav_codes))
+        equal = ((wav_codes[order][1:] == wav_codes[order][:-1]) &
+                 (times[order][1:] == times[order][:-1]))
+
+        # an utterance is reported if it equals its predecessor or
+        # its successor
+        index = np.flatnonzero(
+            np.concatenate(([False], equal)) |
+            np.concatenate((equal, [False])))
+
+        same = {}
+        for i in order[index]:
+            same.setdefault(wav_codes[i], []).append(i)
+        return same
+
     @staticmethod
     def _strcounts2unicode(strcounts):
         """Return a str representing strcounts"""
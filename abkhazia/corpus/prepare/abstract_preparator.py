@@ -15,13 +15,130 @@
 """Provides a base class for corpus preparation in the abkhazia format"""
 
 import configparser
+import datetime
 import os
 import pkg_resources
+import time
 
 import abkhazia.utils as utils
 import abkhazia.corpus
 
 
+class WavsManifest(object):
+    """Record the wav files prepared from the raw audio files
+
+    The manifest maps each prepared wav (a basename in the wavs
+    directory) to its input audio file, the size and modification
+    time (in ns) of the wav and of the input when prepared and the
+    SHA1 checksum of the prepared wav ('-' for wavs linked to their
+    input, '?' if unknown). It is stored in the text file `filename`,
+    each line being formatted as:
+
+        <wav> <sha1> <size> <mtime> <input-size> <input-mtime> <input>
+
+    New entries are appended to the file, so the conversions done
+    before an interruption are kept. The last entry of a wav prevails.
+
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.exists = os.path.isfile(filename)
+        self._entries = {}
+
+        if self.exists:
+            with open(filename, 'r') as stream:
+                for line in stream:
+                    try:
+                        wav, sha1, wsize, wmtime, size, mtime, audio = \
+                            line.rstrip('\n').split(' ', 6)
+                        self._entries[wav] = (
+                            audio, int(size), int(mtime), sha1,
+                            int(wsize), int(wmtime))
+                    except ValueError:  # ignore corrupted lines
+                        continue
+
+    def __len__(self):
+        return len(self._entries)
+
+    def is_valid(self, wav, audio):
+        """Return True if the file `wav` is up to date with `audio`
+
+        `wav` is valid if it has been prepared from `audio`, if
+        `audio` did not change since and if the content of `wav` is
+        the recorded one (for links to the inputs, if `wav` points to
+        `audio`). The content of `wav` is checked by its size and
+        modification time, its checksum being computed only if the
+        modification time changed.
+
+        """
+        name = os.path.basename(wav)
+        try:
+            entry_audio, size, mtime, sha1, wsize, wmtime = \
+                self._entries[name]
+            stat = os.stat(audio)
+            wstat = os.stat(wav)
+        except (KeyError, OSError):
+            return False
+
+        if (entry_audio != audio or size != stat.st_size
+                or mtime != stat.st_mtime_ns):
+            return False
+        if sha1 == '-':
+            return os.path.islink(wav) and os.readlink(wav) == audio
+        if wsize != wstat.st_size:
+            return False
+        if wmtime == wstat.st_mtime_ns:
+            return True
+        if sha1 == '?' or utils.checksum(wav) != sha1:
+            return False
+
+        # the wav has been touched but not modified
+        self._entries[name] = (
+            audio, size, mtime, sha1, wstat.st_size, wstat.st_mtime_ns)
+        return True
+
+    def update(self, wavs, inputs, checksums=None):
+        """Record the prepared `wavs` from their `inputs` audio files
+
+        The `checksums` of the `wavs` are computed if not specified
+
+        """
+        if checksums is None:
+            checksums = [
+                '-' if os.path.islink(wav) else utils.checksum(wav)
+                for wav in wavs]
+
+        lines = []
+        for wav, audio, sha1 in zip(wavs, inputs, checksums):
+            stat = os.stat(audio)
+            wstat = os.stat(wav)
+            entry = (audio, stat.st_size, stat.st_mtime_ns, sha1,
+                     wstat.st_size, wstat.st_mtime_ns)
+            self._entries[os.path.basename(wav)] = entry
+            lines.append(self._format(os.path.basename(wav), entry))
+
+        with open(self.filename, 'a') as stream:
+            stream.write(''.join(lines))
+
+    def save(self, wavs):
+        """Rewrite the manifest with only the entries of `wavs`"""
+        wavs = set(wavs)
+        self._entries = {
+            w: e for w, e in self._entries.items() if w in wavs}
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as stream:
+            for wav, entry in sorted(self._entries.items()):
+                stream.write(self._format(wav, entry))
+        os.replace(tmp, self.filename)
+        self.exists = True
+
+    @staticmethod
+    def _format(wav, entry):
+        audio, size, mtime, sha1, wsize, wmtime = entry
+        return '{} {} {} {} {} {} {}\n'.format(
+            wav, sha1, wsize, wmtime, size, mtime, audio)
+
+
 class AbstractPreparator(object):
     """This class is a common wrapper to all the corpus preparators
 
@@ -130,54 +247,140 @@ class AbstractPreparator(object):
         self.log.debug("prepared %s utterances", len(c.utts()))
         return c
 
-    def _broken_wav(self, wav):
+    def _broken_wav(self, wav, store=None):
         """Return True if the wav needs to be copied again
 
         wav : absolute path to a file in wavs_dir
 
+        store : the wav store (see utils.wav.WavStore), if any
+
         A wav file is broken if:
+          - the file is a broken link
           - the file is empty
-          - the file is a link and self.copy_wavs is True
+          - the file is a link (not to the store) and self.copy_wavs
+            is True
 
         """
-        if utils.is_empty_file(wav):
+        if not os.path.exists(wav) or utils.is_empty_file(wav):
             return True
-        if os.path.islink(wav) and self.copy_wavs:
+        if os.path.islink(wav) and self.copy_wavs and not (
+                store is not None and store.is_link(wav)):
             return True
         return False
 
-    def _prepare_wavs_dir(self, wavs_dir, inputs, outputs):
-        """Detect outputs already present and delete any undesired file"""
+    def _prepare_wavs_dir(self, wavs_dir, inputs, outputs, manifest,
+                          store=None):
+        """Detect outputs already present and delete any undesired file
+
+        An output is kept only if it is up to date in the `manifest`,
+        so the missing, stale or truncated outputs are prepared again.
+        If there is no manifest yet (the wavs were prepared by an older
+        version of abkhazia), the non-empty outputs are kept and
+        recorded in the manifest.
+
+        """
         self.log.debug('scanning %s', wavs_dir)
 
         target = dict((o, i) for i, o in zip(inputs, outputs))
+        target_inputs = dict(target)
         found = 0
         deleted = 0
+        adopted = []
         for wav in os.listdir(wavs_dir):
-            # the complete path to the wav file
-            path = os.path.realpath(os.path.join(wavs_dir, wav))
+            # the manifest itself is not a prepared file
+            if wav == os.path.basename(manifest.filename):
+                continue
+
+            # the complete path to the wav file (links are not
+            # resolved, we don't want to remove the input files)
+            path = os.path.join(wavs_dir, wav)
 
             # the target file is found in the directory, delete it if
-            # it is empty, delete it it's a link and we force copying
-            if wav in target and not self._broken_wav(path):
+            # it is empty, delete it it's a link and we force copying,
+            # or if it is not up to date with its input
+            keep = wav in target and not self._broken_wav(path, store)
+            if keep and manifest.exists:
+                keep = manifest.is_valid(path, target[wav])
+            elif keep:
+                adopted.append(wav)
+
+            if keep:
                 del target[wav]
                 found += 1
             else:
                 utils.remove(path)
                 deleted += 1
 
+        if adopted:
+            self.log.debug(
+                'no manifest found, recording %s existing files', len(adopted))
+            inputs = [target_inputs[wav] for wav in adopted]
+            adopted = [os.path.join(wavs_dir, wav) for wav in adopted]
+            manifest.update(adopted, inputs, checksums=[
+                '-' if os.path.islink(wav) and os.readlink(wav) == audio
+                else '?' for wav, audio in zip(adopted, inputs)])
+
         self.log.debug(
             'found %s files, deleted %s undesired files', found, deleted)
 
         # return the updated inputs and outputs
-        return target.values(), target.keys()
+        return list(target.values()), list(target.keys())
+
+    def _convert_wavs(self, inputs, outputs, manifest, store=None):
+        """Convert `inputs` to `outputs`, reporting progress and ETA
+
+        The files are converted by chunks, the converted files of each
+        chunk being recorded in the `manifest`, and moved to the wav
+        `store` if any. Raise IOError once all the chunks are done if
+        some files failed to convert.
+
+        """
+        nwavs = len(inputs)
+        chunk_size = max(100 * self.njobs, nwavs // 100)
+        failed = {}
+        tstart = time.time()
+        for start in range(0, nwavs, chunk_size):
+            stop = min(nwavs, start + chunk_size)
+            chunk_failed = utils.wav.convert(
+                inputs[start:stop], outputs[start:stop], self.audio_format,
+                self.njobs, copy=self.copy_wavs, log=self.log)
+            failed.update(chunk_failed)
+            done = [n for n in range(start, stop)
+                    if inputs[n] not in chunk_failed]
+
+            # the copied or converted wavs are moved to the store, the
+            # links to the input wavs are kept as is
+            checksums = None if store is None else [
+                '-' if os.path.islink(outputs[n])
+                else store.add(outputs[n]) for n in done]
+            manifest.update(
+                [outputs[n] for n in done], [inputs[n] for n in done],
+                checksums)
+
+            elapsed = max(time.time() - tstart, 1e-6)
+            self.log.info(
+                'prepared %s/%s wavs (%.1f files/s, ETA %s)',
+                stop, nwavs, stop / elapsed, datetime.timedelta(
+                    seconds=int(elapsed * (nwavs - stop) / stop)))
+
+        if failed:
+            raise IOError(
+                'failed to prepare {} wavs, re-run the preparation to '
+                'retry them:\n{}'.format(
+                    len(failed), '\n'.join(sorted(failed))))
 
     def make_wavs(self, wavs_dir):
         """Convert to wav and copy/link the corpus audio files
 
         Because converting thousands of files can be heavy, only the
         files that are not already present in wavs_dir are
-        converted.
+        converted. The prepared files are recorded in the manifest
+        `wavs_dir`/.manifest.txt (see WavsManifest) and are prepared
+        again only if missing or if the input file or the prepared
+        file has changed since. The files are written atomically, so
+        re-running an interrupted preparation resumes it. When a wav
+        store is configured in abkhazia.conf (see utils.wav.WavStore),
+        the copied or converted wavs are linked from the store.
 
         Moreover any file present in wavs_dir but not listed as a
         desired wav file will be deleted.
@@ -207,12 +410,17 @@ class AbstractPreparator(object):
 
         self.log.info('preparing %s wav files', len(inputs))
 
-        if os.path.isdir(wavs_dir):
-            # the wavs directory already exists, clean it and prepare
-            # it for copy/link of wav files
-            inputs, outputs = self._prepare_wavs_dir(wavs_dir, inputs, outputs)
-        else:  # wavs_dir does not exist
+        if not os.path.isdir(wavs_dir):
             os.makedirs(wavs_dir)
+        manifest = WavsManifest(os.path.join(wavs_dir, '.manifest.txt'))
+        store = utils.wav.WavStore.from_config()
+
+        # clean the wavs directory and prepare it for copy/link of wav
+        # files, the manifest is compacted to the desired files
+        all_outputs = outputs
+        inputs, outputs = self._prepare_wavs_dir(
+            wavs_dir, inputs, outputs, manifest, store)
+        manifest.save(set(all_outputs) - set(outputs))
 
         # the job is done if all the files are already here, else
         # we continue the preparation
@@ -228,9 +436,7 @@ class AbstractPreparator(object):
             # are not at 16 kHz are resampled.
             self.log.debug('converting %s %s files to 16kHz mono wav...',
                            len(inputs), self.audio_format)
-            utils.wav.convert(
-                inputs, outputs, self.audio_format,
-                self.njobs, verbose=5, copy=self.copy_wavs)
+            self._convert_wavs(inputs, outputs, manifest, store)
             self.log.debug('finished converting wavs')
 
         # finally return the wav folder path
@@ -190,8 +190,10 @@ class Features(abstract_recipe.AbstractRecipe):
                 utils.remove(infile)
 
         # export wav.scp, correct paths to be relative to corpus
-        # instead of recipe_dir. TODO Do we really need a reference to
-        # wavs as they are already referenced in the corpus ?
+        # instead of recipe_dir, the virtual merged wavs are exported
+        # as the commands concatenating their wavs. TODO Do we really
+        # need a reference to wavs as they are already referenced in
+        # the corpus ?
         origin = os.path.join(self.recipe_dir, 'data', self.name, 'wav.scp')
         if not os.path.isfile(origin):
             raise IOError('{} not found'.format(origin))
@@ -200,8 +202,7 @@ class Features(abstract_recipe.AbstractRecipe):
             for line in open(origin, 'r'):
                 key = line.strip().split(' ')[0]
                 assert key in self.corpus.wavs
-                wav = os.path.join(self.corpus.wav_folder, key)
-                scp.write('{} {}\n'.format(key, wav))
+                scp.write('{} {}\n'.format(key, self.a2k.wav_path(key)))
 
 
 def _delta_joblib_fnc(scp, instance):
@@ -165,14 +165,49 @@ class Abkhazia2Kaldi(object):
         # tstart/tstop in the segment file
         CorpusSaver.save_segments(self.corpus, target, force_timestamps=True)
 
+    def _merged_wav_pipe(self, wav):
+        """Return a command concatenating the wavs merged in `wav`
+
+        The returned command is a Kaldi pipe ending with '|'. A
+        silence is inserted between two wavs separated by a padding
+        (the wavs are 16 kHz mono 16 bit, see CorpusValidation).
+
+        """
+        inputs = []
+        end = 0
+        for w, offset, duration in self.corpus.merged_wavs[wav]:
+            if offset - end > 1e-6:
+                inputs.append(
+                    "'|sox -n -r 16000 -c 1 -b 16 -t wav - trim 0 {}'"
+                    .format(offset - end))
+            inputs.append(os.path.join(self.corpus.wav_folder, w))
+            end = offset + duration
+        return u'sox {} -t wav - |'.format(' '.join(inputs))
+
+    def wav_path(self, wav):
+        """Return the wav.scp entry of `wav`
+
+        This is the path to `wav` in the corpus wav folder, or a
+        command concatenating the wavs merged in `wav` if it is a
+        virtual merged wav (see Corpus.merge_wavs).
+
+        """
+        if wav in self.corpus.merged_wavs:
+            return self._merged_wav_pipe(wav)
+        return os.path.join(self.corpus.wav_folder, wav)
+
     def setup_wav(self):
-        """Create wav.scp in data directory"""
+        """Create wav.scp in data directory
+
+        The virtual merged wavs (see Corpus.merge_wavs) are
+        concatenated on the fly with sox, no audio is written.
+
+        """
         target = os.path.join(self._output_path(), 'wav.scp')
         wavs = set(w for w, _, _ in self.corpus.segments.values())
         with open_utf8(target, 'w') as out:
             for wav in sorted(wavs):
-                wav_path = os.path.join(self.corpus.wav_folder, wav)
-                out.write(u'{} {}\n'.format(wav, wav_path))
+                out.write(u'{} {}\n'.format(wav, self.wav_path(wav)))
 
     def setup_wav_folder(self):
         """using a symbolic link to avoid copying voluminous data"""
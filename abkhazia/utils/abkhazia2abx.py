@@ -121,7 +121,7 @@ def _utt2item(utt_id, corpus, lines, segment_extension, exclude_phones,
     items = []
 
     # ensure the utterance is registered in the corpus
-    if utt_id not in corpus.utts():
+    if utt_id not in corpus.utt2spk:
         return items
 
     # get back the utterance's speaker
@@ -14,6 +14,7 @@
 # along with abkhazia. If not, see <http://www.gnu.org/licenses/>.
 """Provides path/files related functions usefull to abkhazia"""
 
+import hashlib
 import os
 import re
 import shutil
@@ -87,6 +88,15 @@ def is_empty_file(path):
     return os.stat(path).st_size == 0
 
 
+def checksum(path, chunk_size=2**20):
+    """Return the SHA1 hexdigest of the content of the file `path`"""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
 def check_directory(dir, files, name='directory'):
     """Raise OSError any of the `files` is not present in `dir`"""
     if not os.path.isdir(dir):
@@ -21,44 +21,81 @@ that is 16 bits, 16 kHz mono wav files.
 
 import collections
 import contextlib
+import functools
+import math
 import os
 import shlex
 import shutil
+import struct
 import subprocess
+import time
 import wave
 
 import joblib
-from . import config
+import numpy as np
+from .config import config
+from . import logger
+from .path import checksum
 
 
 def wav2wav(wav_in, wav_out, copy=True):
     """Copy/link an input wav file
 
     If the input wav if not 16 bit, 16 kHz or mono it will be
-    converted, else if `copy` is True, copy the file, else symlink it.
+    converted (see native2wav, with a fallback on sox for the
+    encodings it does not support), else if `copy` is True, copy the
+    file, else symlink it.
+
+    Return the method used: 'native', 'sox', 'copy' or 'link'.
 
     """
     info = _scan_one(wav_in)
-    if info.rate != 16000 or info.nbc != 1 or info.width != 2:
-        # convert the file to the desired audio format
-        command = ('sox -c 1 -b 16 {} -t wav {} rate 16k'
-                   .format(wav_in, wav_out))
+    if (info.rate != 16000 or info.nbc != 1 or info.width != 2
+            or info.comptype != 'NONE'):
+        try:
+            native2wav(wav_in, wav_out)
+            return 'native'
+        except ValueError:
+            # convert the file to the desired audio format
+            _require('sox')
+            command = ('sox -c 1 -b 16 {} -t wav {} rate 16k'
+                       .format(wav_in, wav_out))
 
-        subprocess.call(shlex.split(command))
+            subprocess.check_call(shlex.split(command))
+            return 'sox'
 
     elif copy:
         shutil.copy(wav_in, wav_out)
+        return 'copy'
     else:
         os.symlink(wav_in, wav_out)
+        return 'link'
+
+
+@functools.lru_cache(maxsize=None)
+def _which(command):
+    """Return the path to `command`, or None if it is not installed
 
+    The result is memoized so the system is looked up only once per
+    command and process.
+
+    """
+    return shutil.which(command)
 
-# a little trick to send wav2wav to joblib
-def _wav2wav_link(i, o):
-    return wav2wav(i, o, copy=False)
 
+def _require(*commands):
+    """Raise OSError if one of the `commands` is not installed"""
+    for command in commands:
+        if _which(command) is None:
+            raise OSError('{} is not installed on your system'.format(
+                os.path.basename(command)))
 
-def _wav2wav_copy(i, o):
-    return wav2wav(i, o, copy=True)
+
+def _sph2pipe():
+    """Return the path to sph2pipe in the Kaldi installation"""
+    return os.path.join(
+        config.get('kaldi', 'kaldi-directory'),
+        'tools/sph2pipe_v2.5/sph2pipe')
 
 
 def flac2wav(flac, wav):
@@ -68,15 +105,11 @@ def flac2wav(flac, wav):
     'wav' is the filename of the created file
 
     """
-    try:
-        subprocess.check_output(shlex.split('which sox'))
-    except:
-        raise OSError('sox is not installed on your system')
-
+    _require('sox')
     command = ('sox -c 1 -b 16 {} -t wav {} rate 16k'
                .format(flac, wav))
 
-    subprocess.call(shlex.split(command))
+    subprocess.check_call(shlex.split(command))
 
 
 def sph2wav(sph, wav):
@@ -89,15 +122,11 @@ def sph2wav(sph, wav):
     at it in the abkhazia configuration file.
 
     """
-    sph2pipe = os.path.join(
-        config.config.get('kaldi', 'kaldi-directory'),
-        'tools/sph2pipe_v2.5/sph2pipe')
-
-    if not os.path.isfile(sph2pipe):
-        raise OSError('sph2pipe not found on your system')
+    sph2pipe = _sph2pipe()
+    _require(sph2pipe)
 
     command = sph2pipe + ' -f wav {} {}'.format(sph, wav)
-    subprocess.call(shlex.split(command))
+    subprocess.check_call(shlex.split(command))
 
 
 def shn2wav(shn, wav):
@@ -116,11 +145,7 @@ def shn2wav(shn, wav):
 
     """
     # check shorten and sox commands are available
-    for cmd in ['shorten', 'sox']:
-        try:
-            subprocess.check_output(shlex.split('which {}'.format(cmd)))
-        except:
-            raise OSError('{} is not installed on your system'.format(cmd))
+    _require('shorten', 'sox')
 
     command1 = 'shorten -x {} -'.format(shn)
     command2 = ('sox -t raw -r 16000 -e signed-integer -b 16 - -t wav {}'
@@ -128,10 +153,288 @@ def shn2wav(shn, wav):
 
     ps = subprocess.Popen(shlex.split(command1), stdout=subprocess.PIPE)
     subprocess.check_output(shlex.split(command2), stdin=ps.stdout)
-    ps.wait()
+    if ps.wait():
+        raise subprocess.CalledProcessError(ps.returncode, command1)
+
+
+def _mulaw_decode(data):
+    """Return the G.711 mu-law encoded bytes `data` as int16 samples"""
+    data = ~data.astype(np.int32) & 0xFF
+    exponent = (data >> 4) & 0x07
+    magnitude = ((((data & 0x0F) << 3) + 0x84) << exponent) - 0x84
+    return np.where(data & 0x80, -magnitude, magnitude).astype(np.int16)
+
+
+def _decode_pcm(path, offset, nframes, nbc, width, big_endian=False):
+    """Return the PCM samples of `path` as a float array in [-1, 1]
+
+    The returned array has the shape (nframes, nbc).
+
+    """
+    endian = '>' if big_endian else '<'
+    count = nframes * nbc
+    if width == 1:
+        data = np.fromfile(path, dtype='u1', count=count, offset=offset)
+        data = (data.astype(np.float64) - 128) / 128
+    elif width == 3:
+        # no numpy dtype for 24 bits, read the bytes and shift them
+        # in the upper bytes of an int32
+        raw = np.fromfile(
+            path, dtype='u1', count=3 * count, offset=offset).reshape(-1, 3)
+        if big_endian:
+            raw = raw[:, ::-1]
+        data = ((raw[:, 0].astype(np.int32) << 8)
+                | (raw[:, 1].astype(np.int32) << 16)
+                | (raw[:, 2].astype(np.int32) << 24))
+        data = data.astype(np.float64) / 2 ** 31
+    elif width in (2, 4):
+        data = np.fromfile(
+            path, dtype='{}i{}'.format(endian, width),
+            count=count, offset=offset)
+        data = data.astype(np.float64) / 2 ** (8 * width - 1)
+    else:
+        raise ValueError('unsupported sample width: {}'.format(width))
+    return data[:data.size // nbc * nbc].reshape(-1, nbc)
+
+
+def _decode_wav(path):
+    """Return (samples, rate) from the RIFF/WAVE file `path`
+
+    Supported encodings are integer PCM (8, 16, 24 and 32 bits), IEEE
+    float (32 and 64 bits) and G.711 mu-law. Raise ValueError on
+    other encodings.
+
+    """
+    with open(path, 'rb') as stream:
+        meta, offset = _parse_header(stream)
+
+    if meta.comptype == 'NONE':
+        data = _decode_pcm(path, offset, meta.nframes, meta.nbc, meta.width)
+    elif meta.comptype == '0x0003' and meta.width in (4, 8):
+        data = np.fromfile(
+            path, dtype='<f{}'.format(meta.width),
+            count=meta.nframes * meta.nbc,
+            offset=offset).astype(np.float64).reshape(-1, meta.nbc)
+    elif meta.comptype == '0x0007' and meta.width == 1:
+        data = _mulaw_decode(np.fromfile(
+            path, dtype='u1', count=meta.nframes * meta.nbc, offset=offset))
+        data = data.astype(np.float64).reshape(-1, meta.nbc) / 32768
+    else:
+        raise ValueError('unsupported wav encoding: {}'.format(meta.comptype))
+    return data, meta.rate
+
+
+def _decode_sph(path):
+    """Return (samples, rate) from the NIST SPHERE file `path`
+
+    Supported encodings are PCM and mu-law. Raise ValueError on other
+    encodings (as shorten compressed sph files).
+
+    """
+    with open(path, 'rb') as stream:
+        head = stream.read(16)
+        if not head.startswith(b'NIST_1A'):
+            raise ValueError('not a NIST SPHERE file')
+        offset = int(head[8:].strip())
+        header = (head + stream.read(offset - 16)).decode('ascii', 'replace')
+
+    # each line of the header is formatted as '<name> -<type> <value>'
+    fields = {}
+    for line in header.split('\n')[2:]:
+        line = line.strip().split(None, 2)
+        if not line or line[0] == 'end_head':
+            break
+        if len(line) == 3:
+            fields[line[0]] = line[2]
+
+    try:
+        rate = int(fields['sample_rate'])
+        nbc = int(fields.get('channel_count', 1))
+        width = int(fields.get('sample_n_bytes', 2))
+    except (KeyError, ValueError):
+        raise ValueError('invalid NIST SPHERE header')
+
+    coding = fields.get('sample_coding', 'pcm')
+    nframes = int(fields.get('sample_count', 0)) or (
+        (os.path.getsize(path) - offset) // (nbc * width))
+    if coding == 'pcm':
+        data = _decode_pcm(
+            path, offset, nframes, nbc, width,
+            big_endian=fields.get('sample_byte_format') == '10')
+    elif coding in ('ulaw', 'mu-law') and width == 1:
+        data = _mulaw_decode(np.fromfile(
+            path, dtype='u1', count=nframes * nbc, offset=offset))
+        data = data.astype(np.float64).reshape(-1, nbc) / 32768
+    else:
+        raise ValueError('unsupported sph encoding: {}'.format(coding))
+    return data, rate
+
+
+@functools.lru_cache(maxsize=None)
+def _polyphase_filter(up, down, beta=5.0):
+    """Return the low-pass filter used to resample by `up`/`down`
+
+    The filter is a Kaiser windowed sinc with unit gain at DC, of
+    cutoff 1 / max(up, down) and delay `half`. It is splitted in `up`
+    phases of `ntaps` coefficients, phases[p, k] being the
+    coefficient applied to the sample ntaps - 1 - k of a window of
+    ntaps input samples. Return (phases, half).
+
+    """
+    half = 10 * max(up, down)
+    taps = np.sinc((np.arange(2 * half + 1) - half) / float(max(up, down)))
+    taps *= np.kaiser(2 * half + 1, beta)
+    taps *= up / taps.sum()
+
+    ntaps = -(-taps.size // up)
+    phases = np.zeros(ntaps * up)
+    phases[:taps.size] = taps
+    phases = np.ascontiguousarray(phases.reshape(ntaps, up).T[:, ::-1])
+    phases.flags.writeable = False
+    return phases, half
+
+
+def resample(signal, rate_in, rate_out=16000, chunk_size=2**14):
+    """Return the 1D `signal` resampled from `rate_in` to `rate_out`
+
+    The signal is upsampled by `up`, low-pass filtered and
+    downsampled by `down`, with up/down = rate_out/rate_in. As in the
+    polyphase implementations, only the non-zero samples of the
+    upsampled signal and the retained samples of the output are
+    computed: the output samples n, n + up, n + 2 * up, ... are the
+    dot products of a same phase of the filter by windows of input
+    samples regularly spaced by `down`. The outputs are processed by
+    chunks of `chunk_size` samples to bound the memory.
+
+    """
+    gcd = math.gcd(int(rate_in), int(rate_out))
+    up, down = int(rate_out) // gcd, int(rate_in) // gcd
+    signal = np.asarray(signal, dtype=np.float64)
+    if up == down:
+        return signal
+
+    phases, half = _polyphase_filter(up, down)
+    ntaps = phases.shape[1]
+
+    # windows[j] are the input samples j - ntaps + 1 to j
+    windows = np.lib.stride_tricks.sliding_window_view(
+        np.concatenate((np.zeros(ntaps - 1), signal, np.zeros(ntaps))),
+        ntaps)
+
+    nout = -(-signal.size * up // down)
+    output = np.empty(nout)
+    for first in range(min(up, nout)):
+        # the output sample first + m * up is computed from the phase
+        # t % up and the window t // up + m * down
+        t = first * down + half
+        count = len(range(first, nout, up))
+        for start in range(0, count, chunk_size):
+            stop = min(count, start + chunk_size)
+            j = t // up + start * down
+            output[first + start * up:first + stop * up:up] = windows[
+                j:j + (stop - start) * down:down].dot(phases[t % up])
+    return output
+
+
+def native2wav(audio, wav):
+    """Convert a wav or sph file to a 16 kHz, 16 bits, mono wav
+
+    'audio' must be an existing wav or sph file
+    'wav' is the filename of the created file
+
+    The conversion is done in Python, without calling sox: the channels
+    are averaged, the signal is resampled to 16 kHz (see resample) and
+    converted to 16 bits. Raise ValueError if the encoding of `audio`
+    is not supported (see _decode_wav and _decode_sph).
+
+    """
+    with open(audio, 'rb') as stream:
+        magic = stream.read(4)
+    data, rate = (_decode_sph if magic == b'NIST' else _decode_wav)(audio)
+
+    data = resample(data.mean(axis=1), rate, 16000)
+    data = np.clip(np.round(data * 32768), -32768, 32767).astype('<i2')
+
+    with contextlib.closing(wave.open(wav, 'w')) as out:
+        out.setparams((1, 2, 16000, 0, 'NONE', 'not compressed'))
+        out.writeframes(data.tobytes())
+
+
+_native_formats = {'wav', 'sph'}
+"""Input formats converted by native2wav, others rely on subprocesses"""
+
+_batch_bytes = 2**26
+"""Maximal size of the input files in a single conversion job"""
+
+_conversion = collections.namedtuple(
+    '_conversion', 'audio method size time error')
+
+
+def _convert_to(audio, wav, fileformat, copy):
+    """Convert `audio` to `wav` with a fallback on subprocesses
+
+    Return the conversion method used (see wav2wav).
+
+    """
+    if fileformat == 'wav':
+        return wav2wav(audio, wav, copy=copy)
+
+    if fileformat in _native_formats:
+        try:
+            native2wav(audio, wav)
+            return 'native'
+        except ValueError:
+            pass
+
+    {'flac': flac2wav, 'sph': sph2wav, 'shn': shn2wav}[fileformat](audio, wav)
+    return {'flac': 'sox', 'sph': 'sph2pipe', 'shn': 'shorten'}[fileformat]
+
+
+def _convert_one(audio, wav, fileformat, copy):
+    """Convert `audio` to `wav` in a temporary file renamed once done
 
+    An interrupted conversion thus never leaves a truncated `wav`.
+    Raise IOError if the conversion produced no file, return the
+    conversion method used.
 
-def convert(inputs, outputs, fileformat, njobs=1, verbose=0, copy=False):
+    """
+    tmp = wav + '.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+
+    try:
+        method = _convert_to(audio, tmp, fileformat, copy)
+        if not os.path.lexists(tmp):
+            raise IOError('failed to convert {}'.format(audio))
+        os.replace(tmp, wav)
+        return method
+    finally:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+
+
+def _convert_batch(inputs, outputs, sizes, fileformat, copy):
+    """Convert a batch of audio files to wav
+
+    Return a list of _conversion tuples, one per input file. The
+    errors are reported instead of raised, so a single failure does
+    not abort the whole conversion.
+
+    """
+    res = []
+    for audio, wav, size in zip(inputs, outputs, sizes):
+        t0 = time.time()
+        try:
+            method, error = _convert_one(audio, wav, fileformat, copy), None
+        except Exception as err:  # report any error on that file
+            method, error = 'failed', '{}: {}'.format(
+                type(err).__name__, err)
+        res.append(_conversion(audio, method, size, time.time() - t0, error))
+    return res
+
+
+def convert(inputs, outputs, fileformat, njobs=1, verbose=0, copy=False,
+            batch_size=None, log=logger.null_logger()):
     """Convert a range of audio files to the wav format
 
     inputs: list of input files to convert
@@ -145,20 +448,30 @@ def convert(inputs, outputs, fileformat, njobs=1, verbose=0, copy=False):
 
     copy: only for wavs input, see wav2wav
 
+    batch_size: the maximal number of files converted by a single
+        job, default is between 1 and 100 depending on the number of
+        files. The batches are also limited to 64 MB of input files.
+
+    log: where to report the throughput per conversion method and
+        the failed files
+
     We must have len(inputs) == len(wavs), all files in inputs must
     exist. For details on the verbose level, please refeer to the
     joblib documentation.
 
+    The wav and sph files are converted in Python (see native2wav),
+    with a fallback on sox or sph2pipe for the encodings it does not
+    support, flac and shn files are converted by sox and shorten. The
+    availability of those tools is checked once before
+    conversion. The files are splitted in batches converted in a pool
+    of `njobs` processes. Each file is written in `<output>.tmp` and
+    renamed to `<output>` once converted.
+
+    A failed conversion does not abort the others. Return a dict
+    mapping the failed input files to their error message.
+
     """
-    # mapping from file format to conversion function
-    try:
-        fnc = {
-            'flac': flac2wav,
-            'sph': sph2wav,
-            'shn': shn2wav,
-            'wav': _wav2wav_copy if copy else _wav2wav_link
-        }[fileformat]
-    except KeyError:
+    if fileformat not in ('flac', 'sph', 'shn', 'wav'):
         raise IOError('{} is not a supported format'.format(fileformat))
 
     # assert inputs and outputs have the same size
@@ -166,37 +479,179 @@ def convert(inputs, outputs, fileformat, njobs=1, verbose=0, copy=False):
         raise IOError('inputs and outputs have a different size')
 
     # assert all input files exist
+    inputs, outputs = list(inputs), list(outputs)
     for i in inputs:
         if not os.path.isfile(i):
             raise IOError('input file does not exist: {}'.format(i))
+    sizes = [os.path.getsize(i) for i in inputs]
+
+    # flac and shn cannot be converted at all without their tools,
+    # for wav and sph they are only used as fallbacks
+    if fileformat == 'flac':
+        _require('sox')
+    elif fileformat == 'shn':
+        _require('shorten', 'sox')
+
+    # small files are grouped in batches to amortize the inter-process
+    # communication, the batches being small enough to balance the
+    # load between jobs
+    if batch_size is None:
+        batch_size = max(1, min(100, len(inputs) // (4 * njobs)))
+    batches = [[]]
+    batch_bytes = 0
+    for index, size in enumerate(sizes):
+        if batches[-1] and (len(batches[-1]) >= batch_size
+                            or batch_bytes + size > _batch_bytes):
+            batches.append([])
+            batch_bytes = 0
+        batches[-1].append(index)
+        batch_bytes += size
+
+    def _args(batch):
+        return ([inputs[i] for i in batch], [outputs[i] for i in batch],
+                [sizes[i] for i in batch], fileformat, copy)
 
     # convert files in parallel
-    joblib.Parallel(
-        n_jobs=njobs, verbose=verbose, backend='threading')(
-            joblib.delayed(fnc)(i, o) for i, o in zip(inputs, outputs))
+    t0 = time.time()
+    if njobs == 1 or len(batches) <= 1:
+        res = [_convert_batch(*_args(batch)) for batch in batches if batch]
+    else:
+        res = joblib.Parallel(n_jobs=njobs, verbose=verbose)(
+            joblib.delayed(_convert_batch)(*_args(batch))
+            for batch in batches)
+    res = [conversion for batch in res for conversion in batch]
+    elapsed = time.time() - t0
+
+    # report the throughput of each conversion method (on the time
+    # spent by the jobs) and the failed files
+    for method in sorted({r.method for r in res} - {'failed'}):
+        conversions = [r for r in res if r.method == method]
+        duration = sum(r.time for r in conversions)
+        log.info(
+            '%s (%s): %s files, %.1f MB in %.1fs (%.1f files/s per job)',
+            fileformat, method, len(conversions),
+            sum(r.size for r in conversions) / 2.**20, duration,
+            len(conversions) / max(duration, 1e-6))
+
+    failed = {r.audio: r.error for r in res if r.error is not None}
+    for audio, error in sorted(failed.items()):
+        log.warning('failed to convert %s: %s', audio, error)
+    if res:
+        log.info('converted %s files in %.1fs (%.1f files/s), %s failed',
+                 len(res) - len(failed), elapsed,
+                 len(res) / max(elapsed, 1e-6),
+                 len(failed))
+    return failed
 
 
 _metawav = collections.namedtuple(
     '_metawav', 'nbc width rate nframes comptype compname duration')
 
 
+_invalid_metawav = _metawav(None, None, None, 0, None, None, 0.0)
+"""The metadata returned for unreadable or malformed wav files"""
+
+_header_size = 512
+"""Number of bytes read at once when parsing a wav header"""
+
+
+def _parse_header(stream):
+    """Return (metawav, data offset) of the RIFF/WAVE file `stream`
+
+    Only the chunk headers are read, the audio data is skipped. The
+    data offset is the position of the first sample in the file.
+    Raise ValueError if the file is not a valid wav.
+
+    """
+    buf = stream.read(_header_size)
+    if len(buf) < 12 or buf[:4] != b'RIFF' or buf[8:12] != b'WAVE':
+        raise ValueError('not a RIFF/WAVE file')
+
+    # buf holds the bytes of the file from the position `base`
+    base = 0
+
+    def _read(start, size):
+        """Return `size` bytes from `start`, refilling buf if needed"""
+        nonlocal buf, base
+        if start < base or start + size > base + len(buf):
+            # happens when big chunks precede the data
+            stream.seek(start)
+            buf, base = stream.read(max(size, _header_size)), start
+        return buf[start - base:start - base + size]
+
+    fmt = None
+    offset = 12
+    while True:
+        header = _read(offset, 8)
+        if len(header) < 8:
+            raise ValueError('data chunk not found')
+
+        name = header[:4]
+        size = struct.unpack('<I', header[4:])[0]
+        if name == b'fmt ':
+            fmt = _read(offset + 8, min(size, 40))
+        elif name == b'data':
+            if fmt is None:
+                raise ValueError('data chunk before fmt chunk')
+            break
+
+        # chunks are word aligned
+        offset += 8 + size + (size % 2)
+
+    tag, nbc, rate, _, align, bits = struct.unpack('<HHIIHH', fmt[:16])
+    width = (bits + 7) // 8
+    if not (nbc and rate and width):
+        raise ValueError('invalid fmt chunk')
+
+    # for WAVE_FORMAT_EXTENSIBLE the actual format is given by the
+    # first two bytes of the SubFormat GUID in the fmt extension
+    if tag == 0xFFFE:
+        if len(fmt) < 40:
+            raise ValueError('invalid extensible fmt chunk')
+        tag = struct.unpack('<H', fmt[24:26])[0]
+
+    # only WAVE_FORMAT_PCM is not compressed
+    comptype, compname = (
+        ('NONE', 'not compressed') if tag == 0x0001
+        else ('0x{:04X}'.format(tag), 'compressed'))
+
+    # a truncated file can declare more data than it actually holds
+    stream.seek(0, os.SEEK_END)
+    size = min(size, stream.tell() - offset - 8)
+    nframes = size // (align or nbc * width)
+
+    return _metawav(
+        nbc, width, rate, nframes, comptype, compname,
+        nframes / float(rate)), offset + 8
+
+
 def _scan_one(wav):
-    """scan a single wav file and return a metawav tuple"""
+    """scan a single wav file and return a metawav tuple
+
+    The RIFF header of the file is parsed directly, the wav data is
+    not read. Never raise: unreadable or malformed files have the
+    metadata `_invalid_metawav` (with nframes=0)
+
+    """
     try:
-        param = wave.open(wav, 'r').getparams()
-        return _metawav(
-            param[0], param[1], param[2],
-            param[3], param[4], param[5],
-            param[3]/float(param[2]))  # duration
-    except EOFError:
-        return _metawav(nframes=0)
+        with open(wav, 'rb') as stream:
+            return _parse_header(stream)[0]
+    except (IOError, OSError, ValueError, struct.error):
+        return _invalid_metawav
 
 
-def scan(wavs, njobs=1, verbose=0):
+def _scan_batch(wavs):
+    """Return the list of metawav tuples of the files in `wavs`"""
+    return [_scan_one(wav) for wav in wavs]
+
+
+def scan(wavs, njobs=1, verbose=0, batch_size=None):
     """Return meta information on the input `wavs` files
 
     wavs : a list of absolute paths to wav files
     njobs : the number of parallel scans
+    batch_size : the number of wavs scanned by a single job, default
+      is between 100 and 1000 depending on the number of wavs
 
     The returned dict 'metainfo' have wavs for keys and the following
     named tuple as value:
@@ -208,17 +663,362 @@ def scan(wavs, njobs=1, verbose=0):
         metainfo = scan(wavs)
         d = metainfo[wavs[2]].duration
 
-    See the documentation of wave.getparams() for details.
+    See the documentation of wave.getparams() for details. The files
+    that are not valid wavs have nframes=0 and None for the other
+    fields.
+
+    Only the headers of the files are read. The wavs are splitted in
+    batches scanned in a pool of `njobs` processes, so the scan is
+    bounded by the disk, not by the Python interpreter.
 
     """
-    res = joblib.Parallel(
-        n_jobs=njobs, verbose=verbose, backend="threading")(
-            joblib.delayed(_scan_one)(wav) for wav in wavs)
+    wavs = list(wavs)
 
-    return dict(zip(wavs, res))
+    # by default, batches small enough to use all the jobs but large
+    # enough to amortize the inter-process communication
+    if batch_size is None:
+        batch_size = max(100, min(1000, len(wavs) // (4 * njobs)))
+    batches = [wavs[i:i + batch_size]
+               for i in range(0, len(wavs), batch_size)]
+
+    if njobs == 1 or len(batches) <= 1:
+        res = [_scan_batch(batch) for batch in batches]
+    else:
+        res = joblib.Parallel(n_jobs=njobs, verbose=verbose)(
+            joblib.delayed(_scan_batch)(batch) for batch in batches)
+
+    return dict(zip(wavs, (meta for batch in res for meta in batch)))
+
+
+_signal_stats = collections.namedtuple(
+    '_signal_stats', 'peak rms dc clipping silence')
+
+
+def signal_stats(wav, segments, silence_threshold=0.001,
+                 frame_duration=0.01):
+    """Return signal statistics on segments of a 16 bits PCM wav file
+
+    wav : path to a 16 bits PCM wav file (only the first channel is
+      considered)
+    segments : a list of (start, stop) in seconds, None stands for the
+      begin or the end of the file
+    silence_threshold : RMS amplitude below which a frame is silent
+    frame_duration : duration of a frame in seconds
+
+    The file is memory-mapped so only the samples in `segments` are
+    read. Return a list of named tuples, one per segment, with the
+    following fields (amplitudes are in [0, 1]):
+
+        peak : maximal absolute amplitude
+        rms : root mean square amplitude
+        dc : mean amplitude (DC offset)
+        clipping : proportion of samples at the maximal amplitude
+        silence : proportion of frames with a RMS below the threshold
+
+    Raise ValueError if the file is not a 16 bits PCM wav.
+
+    """
+    with open(wav, 'rb') as stream:
+        meta, offset = _parse_header(stream)
+    if meta.width != 2 or meta.comptype != 'NONE':
+        raise ValueError('{} is not a 16 bits PCM wav'.format(wav))
+
+    stats = []
+    if meta.nframes == 0:
+        return [_signal_stats(0., 0., 0., 0., 1.) for _ in segments]
+
+    data = np.memmap(
+        wav, dtype='<i2', mode='r', offset=offset,
+        shape=(meta.nframes, meta.nbc))[:, 0]
+    frame = max(1, int(frame_duration * meta.rate))
+
+    for start, stop in segments:
+        start = 0 if start is None else int(start * meta.rate)
+        stop = meta.nframes if stop is None else int(stop * meta.rate)
+        signal = data[start:stop].astype(np.float64) / 32768
+        if not signal.size:
+            stats.append(_signal_stats(0., 0., 0., 0., 1.))
+            continue
+
+        power = signal ** 2
+        nframes = max(1, signal.size // frame)
+        frames_rms = np.sqrt(
+            power[:nframes * frame].reshape(nframes, -1).mean(axis=1))
+
+        stats.append(_signal_stats(
+            float(np.abs(signal).max()),
+            float(np.sqrt(power.mean())),
+            float(signal.mean()),
+            float(np.mean(np.abs(signal) >= 32767 / 32768)),
+            float(np.mean(frames_rms < silence_threshold))))
+    return stats
+
+
+def trim(wav, output, segments):
+    """Write `output` as a copy of `wav` without the given `segments`
+
+    wav : path to a 16 bits PCM wav file
+    output : path to the wav file to write
+    segments : a list of (start, stop) in seconds to remove from the
+      wav, they can overlap. None stands for the begin or the end of
+      the file
+
+    The file is memory-mapped and the kept samples are written by
+    slices, so the memory usage does not depend on the file size.
+    Return the number of frames written in `output`.
+
+    Raise ValueError if the file is not a 16 bits PCM wav.
+
+    """
+    with open(wav, 'rb') as stream:
+        meta, offset = _parse_header(stream)
+    if meta.width != 2 or meta.comptype != 'NONE':
+        raise ValueError('{} is not a 16 bits PCM wav'.format(wav))
+
+    # the removed segments as sorted arrays of frame indices
+    removed = np.asarray(
+        [(0 if start is None else start * meta.rate,
+          meta.nframes if stop is None else stop * meta.rate)
+         for start, stop in segments], dtype=np.float64).reshape(-1, 2)
+    removed = np.clip(
+        np.round(removed), 0, meta.nframes).astype(np.int64)
+    removed = removed[np.argsort(removed[:, 0])]
+
+    # the kept ranges are between the end of a removed segment (or
+    # the begin of the file) and the start of the next one
+    ends = np.maximum.accumulate(removed[:, 1])
+    starts = np.concatenate(([0], ends))
+    stops = np.concatenate((removed[:, 0], [meta.nframes]))
+    kept = stops > starts
+
+    nframes = 0
+    with contextlib.closing(wave.open(output, 'w')) as out:
+        out.setparams((meta.nbc, meta.width, meta.rate, 0, 'NONE',
+                       'not compressed'))
+        if meta.nframes:
+            data = np.memmap(
+                wav, dtype='<i2', mode='r', offset=offset,
+                shape=(meta.nframes, meta.nbc))
+            for start, stop in zip(starts[kept], stops[kept]):
+                out.writeframes(data[start:stop].tobytes())
+                nframes += stop - start
+    return int(nframes)
 
 
 def duration(wav):
-    """Return the duration of a wav file in seconds"""
-    with contextlib.closing(wave.open(wav, 'r')) as w:
-        return w.getnframes() / float(w.getframerate())
+    """Return the duration of a wav file in seconds
+
+    Only the RIFF header of the file is parsed (see scan), so the
+    WAVE_FORMAT_EXTENSIBLE files are supported. Raise ValueError if
+    the file is not a valid wav.
+
+    """
+    with open(wav, 'rb') as stream:
+        return _parse_header(stream)[0].duration
+
+
+class DurationCache(object):
+    """Memoize the duration of wav files
+
+    The durations are keyed by the absolute path of the wav files and
+    validated against their size and modification time, so a modified
+    file is read again. The cache can be persisted to a text file
+    `filename`, each line being formatted as:
+
+        <wav-path> <size> <mtime-ns> <duration>
+
+    with <wav-path> relative to the directory of `filename`.
+
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._entries = {}
+        self._dirty = False
+
+        if filename is not None and os.path.isfile(filename):
+            root = os.path.dirname(os.path.realpath(filename))
+            with open(filename, 'r') as stream:
+                for line in stream:
+                    try:
+                        path, size, mtime, dur = line.rstrip('\n').rsplit(
+                            ' ', 3)
+                        self._entries[os.path.normpath(
+                            os.path.join(root, path))] = (
+                                int(size), int(mtime), float(dur))
+                    except ValueError:  # ignore corrupted lines
+                        continue
+
+    def __len__(self):
+        return len(self._entries)
+
+    def duration(self, wav):
+        """Return the duration of the wav file `wav` in seconds
+
+        The file is opened only if its duration is not cached or if
+        it has been modified since.
+
+        """
+        path = os.path.abspath(wav)
+        stat = os.stat(path)
+        try:
+            size, mtime, dur = self._entries[path]
+            if size == stat.st_size and mtime == stat.st_mtime_ns:
+                return dur
+        except KeyError:
+            pass
+
+        dur = duration(path)
+        self._entries[path] = (stat.st_size, stat.st_mtime_ns, dur)
+        self._dirty = True
+        return dur
+
+    def save(self, filename=None):
+        """Write the cache to `filename` (default to self.filename)
+
+        When `filename` is not specified, the cache is written only if
+        new durations have been computed since loading. Errors on
+        writing are ignored (the cache is only an optimization), in
+        that case return False, else return True.
+
+        """
+        if filename is None:
+            if self.filename is None or not self._dirty:
+                return True
+            filename = self.filename
+
+        try:
+            root = os.path.dirname(os.path.realpath(filename))
+            if not os.path.isdir(root):
+                os.makedirs(root)
+            with open(filename, 'w') as stream:
+                for path, (size, mtime, dur) in sorted(self._entries.items()):
+                    stream.write('{} {} {} {}\n'.format(
+                        os.path.relpath(path, root), size, mtime, repr(dur)))
+        except (OSError, IOError):
+            return False
+
+        if filename == self.filename:
+            self._dirty = False
+        return True
+
+
+class WavStore(object):
+    """A content-addressed store of wav files shared between corpora
+
+    The wavs are stored in `directory` by their SHA1 checksum, as
+    <directory>/<sha1[:2]>/<sha1>.wav, and are placed in the corpora
+    as links to the stored file: hard links if `link` is 'hardlink'
+    (with a fallback on symbolic links when the corpus and the store
+    are on different filesystems), or symbolic links if `link` is
+    'symlink'. A wav shared by several corpora is thus stored once.
+
+    The stored files must not be modified in place: abkhazia always
+    writes new wavs to new files.
+
+    """
+    def __init__(self, directory, link='hardlink'):
+        if link not in ('hardlink', 'symlink'):
+            raise IOError(
+                'wav store link must be hardlink or symlink, it is {}'
+                .format(link))
+        self.directory = os.path.abspath(directory)
+        self.link = link
+
+    @classmethod
+    def from_config(cls):
+        """Return the store configured in abkhazia.conf, or None
+
+        The store is defined by the 'wav-store' and 'wav-store-link'
+        options of the 'abkhazia' section, it is disabled if
+        'wav-store' is empty or not defined.
+
+        """
+        directory = config.get(
+            'abkhazia', 'wav-store', fallback='').strip()
+        if not directory:
+            return None
+        return cls(directory, config.get(
+            'abkhazia', 'wav-store-link', fallback='hardlink').strip())
+
+    def path(self, sha1):
+        """Return the path to the stored wav of checksum `sha1`"""
+        return os.path.join(self.directory, sha1[:2], sha1 + '.wav')
+
+    def is_link(self, wav):
+        """Return True if `wav` is a symbolic link to a stored file"""
+        return os.path.islink(wav) and os.path.realpath(wav).startswith(
+            os.path.join(os.path.realpath(self.directory), ''))
+
+    def _checksum(self, wav):
+        """Return the SHA1 of `wav`, read from its name when stored"""
+        if self.is_link(wav):
+            return os.path.splitext(
+                os.path.basename(os.path.realpath(wav)))[0]
+        return checksum(wav)
+
+    def _store(self, wav, sha1, move):
+        """Place `wav` in the store under `sha1` if not already there
+
+        If `move` is True, `wav` is hard linked in the store when
+        possible, else it is copied.
+
+        """
+        stored = self.path(sha1)
+        if not os.path.isfile(stored):
+            if not os.path.isdir(os.path.dirname(stored)):
+                os.makedirs(os.path.dirname(stored), exist_ok=True)
+
+            # concurrent stores of the same wav are harmless, the last
+            # renamed replaces the others with the same content
+            tmp = '{}.{}.tmp'.format(stored, os.getpid())
+            if move:
+                try:
+                    os.link(wav, tmp)
+                except OSError:  # not on the same filesystem
+                    shutil.copyfile(wav, tmp)
+            else:
+                shutil.copyfile(wav, tmp)
+            os.replace(tmp, stored)
+        return stored
+
+    def _link(self, stored, wav):
+        """Atomically replace `wav` by a link to `stored`"""
+        # wav moved to the store is already a hard link, and renaming
+        # a hard link on another one of the same file does nothing
+        if (self.link == 'hardlink' and os.path.isfile(wav)
+                and not os.path.islink(wav)
+                and os.path.samefile(stored, wav)):
+            return
+
+        tmp = '{}.{}.tmp'.format(wav, os.getpid())
+        if self.link == 'hardlink':
+            try:
+                os.link(stored, tmp)
+            except OSError:  # not on the same filesystem
+                os.symlink(stored, tmp)
+        else:
+            os.symlink(stored, tmp)
+        os.replace(tmp, wav)
+
+    def add(self, wav):
+        """Move the file `wav` in the store and replace it by a link
+
+        Return the SHA1 checksum of `wav`.
+
+        """
+        sha1 = self._checksum(wav)
+        if not self.is_link(wav):
+            self._link(self._store(wav, sha1, move=True), wav)
+        return sha1
+
+    def put(self, wav, output):
+        """Place a link to the content of `wav` as `output`
+
+        The content of `wav` is copied in the store if not already
+        there, `wav` itself is left unchanged. Return the SHA1
+        checksum of `wav`.
+
+        """
+        sha1 = self._checksum(wav)
+        self._link(self._store(wav, sha1, move=False), output)
+        return sha1
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Mathieu Bernard
+#
+# You can redistribute this program and/or modify it under the terms
+# of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""Benchmark of the corpus loading on a large synthetic corpus
+
+Generate a corpus of 1M utterances (no wav files, only the text
+files) and compare the loading times of a line by line sequential
+parse (as done by abkhazia up to version 0.3), of the concurrent bulk
+parse done by CorpusLoader, in dict and compact representations, and
+of a snapshot.
+
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import abkhazia.utils as utils
+from abkhazia.corpus import Corpus
+
+
+def generate_corpus(corpus_dir, nutts, nspeakers=1000, nwords=50000):
+    """Write a synthetic corpus of `nutts` utterances in `corpus_dir`"""
+    rand = random.Random(0)
+    phones = ['p{}'.format(i) for i in range(40)]
+    words = ['w{}'.format(i) for i in range(nwords)]
+
+    os.makedirs(os.path.join(corpus_dir, 'wavs'))
+    with open(os.path.join(corpus_dir, 'phones.txt'), 'w') as out:
+        out.write(''.join('{} {}\n'.format(p, p) for p in phones))
+    with open(os.path.join(corpus_dir, 'silences.txt'), 'w') as out:
+        out.write('SIL\nSPN\n')
+    with open(os.path.join(corpus_dir, 'variants.txt'), 'w') as out:
+        pass
+    with open(os.path.join(corpus_dir, 'lexicon.txt'), 'w') as out:
+        out.write(''.join('{} {}\n'.format(
+            w, ' '.join(rand.sample(phones, rand.randint(2, 8))))
+                          for w in words))
+
+    segments = open(os.path.join(corpus_dir, 'segments.txt'), 'w')
+    text = open(os.path.join(corpus_dir, 'text.txt'), 'w')
+    utt2spk = open(os.path.join(corpus_dir, 'utt2spk.txt'), 'w')
+    for i in range(nutts):
+        spk = 's{:04d}'.format(i % nspeakers)
+        utt = '{}-u{:07d}'.format(spk, i)
+        start = (i // nspeakers) * 10.0
+        segments.write('{} {}.wav {} {}\n'.format(
+            utt, spk, start, start + rand.uniform(1, 10)))
+        text.write('{} {}\n'.format(
+            utt, ' '.join(rand.choice(words)
+                          for _ in range(rand.randint(3, 15)))))
+        utt2spk.write('{} {}\n'.format(utt, spk))
+    for stream in (segments, text, utt2spk):
+        stream.close()
+
+
+def legacy_load(corpus_dir):
+    """Load the corpus files sequentially, line by line"""
+    def _lines(name):
+        return (line.strip().split() for line in utils.open_utf8(
+            os.path.join(corpus_dir, name + '.txt'), 'r'))
+
+    corpus = Corpus()
+    corpus.lexicon = {l[0]: ' '.join(l[1:]) for l in _lines('lexicon')}
+    corpus.segments = {
+        l[0]: (l[1], float(l[2]), float(l[3])) for l in _lines('segments')}
+    corpus.wavs = {w[0] for w in corpus.segments.values()}
+    corpus.text = {l[0]: ' '.join(l[1:]) for l in _lines('text')}
+    corpus.utt2spk = {l[0]: l[1] for l in _lines('utt2spk')}
+    corpus.phones = {l[0]: l[1] for l in _lines('phones')}
+    return corpus
+
+
+def timeit(name, function, reference=None):
+    """Print the execution time of `function` and return its result"""
+    t0 = time.time()
+    result = function()
+    elapsed = time.time() - t0
+    print('{:<32} {:7.2f}s{}'.format(
+        name, elapsed, '' if reference is None
+        else '  (x{:.1f})'.format(reference / elapsed)))
+    return result, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '-n', '--nutts', type=int, default=1000000,
+        help='number of utterances in the corpus, default is %(default)s')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        corpus_dir = os.path.join(tmpdir, 'corpus')
+        print('generating a corpus of {} utterances in {}'.format(
+            args.nutts, corpus_dir))
+        generate_corpus(corpus_dir, args.nutts)
+
+        legacy, ref = timeit(
+            'line by line sequential parse', lambda: legacy_load(corpus_dir))
+        corpus, _ = timeit(
+            'concurrent bulk parse', lambda: Corpus.load(corpus_dir), ref)
+        assert corpus.segments == legacy.segments
+        assert corpus.text == legacy.text
+        timeit('single threaded bulk parse',
+               lambda: Corpus.load(corpus_dir, njobs=1), ref)
+        timeit('concurrent bulk parse, compact',
+               lambda: Corpus.load(corpus_dir, compact=True), ref)
+
+        corpus.save(
+            os.path.join(tmpdir, 'saved'), no_wavs=True, snapshot=True)
+        os.makedirs(os.path.join(tmpdir, 'saved', 'wavs'))
+        timeit('snapshot', lambda: Corpus.load(
+            os.path.join(tmpdir, 'saved')), ref)
+    finally:
+        utils.remove(tmpdir, safe=True)
+
+
+if __name__ == '__main__':
+    main()
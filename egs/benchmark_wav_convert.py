@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Mathieu Bernard
+#
+# You can redistribute this program and/or modify it under the terms
+# of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""Benchmark of the wav conversion on a corpus of short files
+
+Generate short stereo wav files at 44.1 kHz and compare the
+throughput (in files per second) of their conversion to 16 kHz mono
+wavs by a sox subprocess per file (as done by abkhazia up to version
+0.3) and by the native conversion of utils.wav.convert. The sox
+conversion is skipped if sox is not installed.
+
+"""
+import argparse
+import contextlib
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import time
+import wave
+
+import numpy as np
+
+import abkhazia.utils as utils
+
+
+def generate_wavs(wavs_dir, nwavs, duration, rate=44100, nbc=2):
+    """Write `nwavs` wav files of white noise in `wavs_dir`"""
+    rand = np.random.RandomState(0)
+    os.makedirs(wavs_dir)
+    wavs = []
+    for i in range(nwavs):
+        wav = os.path.join(wavs_dir, '{:06d}.wav'.format(i))
+        data = rand.randint(
+            -8000, 8000, size=(int(duration * rate), nbc)).astype('<i2')
+        with contextlib.closing(wave.open(wav, 'w')) as stream:
+            stream.setparams((nbc, 2, rate, 0, 'NONE', 'not compressed'))
+            stream.writeframes(data.tobytes())
+        wavs.append(wav)
+    return wavs
+
+
+def sox_convert(inputs, outputs):
+    """Convert the wavs with a sox subprocess per file"""
+    for i, o in zip(inputs, outputs):
+        subprocess.call(shlex.split(
+            'sox -c 1 -b 16 {} -t wav {} rate 16k'.format(i, o)))
+
+
+def timeit(name, function, nfiles, reference=None):
+    """Print the throughput of `function` and return its duration"""
+    t0 = time.time()
+    function()
+    elapsed = time.time() - t0
+    print('{:<32} {:8.1f} files/s{}'.format(
+        name, nfiles / elapsed, '' if reference is None
+        else '  (x{:.1f})'.format(reference / elapsed)))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '-n', '--nwavs', type=int, default=2000,
+        help='number of wav files to convert, default is %(default)s')
+    parser.add_argument(
+        '-d', '--duration', type=float, default=2.0,
+        help='duration of a wav file in seconds, default is %(default)s')
+    parser.add_argument(
+        '-j', '--njobs', type=int, default=4,
+        help='number of parallel jobs, default is %(default)s')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print('generating {} wavs of {}s in {}'.format(
+            args.nwavs, args.duration, tmpdir))
+        inputs = generate_wavs(
+            os.path.join(tmpdir, 'inputs'), args.nwavs, args.duration)
+
+        def _outputs(name):
+            os.makedirs(os.path.join(tmpdir, name))
+            return [os.path.join(tmpdir, name, os.path.basename(i))
+                    for i in inputs]
+
+        ref = None
+        if shutil.which('sox'):
+            ref = timeit('sox subprocess per file', lambda: sox_convert(
+                inputs, _outputs('sox')), args.nwavs)
+        else:
+            print('sox not found, skipping the subprocess conversion')
+
+        timeit('native, single job', lambda: utils.wav.convert(
+            inputs, _outputs('native'), 'wav'), args.nwavs, ref)
+        timeit('native, {} jobs'.format(args.njobs), lambda: utils.wav.convert(
+            inputs, _outputs('native-jobs'), 'wav', njobs=args.njobs),
+               args.nwavs, ref)
+    finally:
+        utils.remove(tmpdir, safe=True)
+
+
+if __name__ == '__main__':
+    main()
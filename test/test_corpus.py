@@ -14,9 +14,27 @@
 # along with abkhazia. If not, see <http://www.gnu.org/licenses/>.
 """Test of the Corpus class"""
 
+import contextlib
+import logging
 import os
+import shutil
+import struct
+import wave
 from abkhazia.corpus import Corpus
+from abkhazia.corpus import corpus_tables
+from abkhazia.corpus.corpus_filter import CorpusFilter
+from abkhazia.corpus.corpus_loader import CorpusLoader
+from abkhazia.corpus.corpus_merge_wavs import CorpusMergeWavs
+from abkhazia.corpus.corpus_query import CorpusQuery
+from abkhazia.corpus.corpus_saver import CorpusSaver
+from abkhazia.kaldi.abkhazia2kaldi import Abkhazia2Kaldi
+from abkhazia.corpus.corpus_shards import CorpusShards
+from abkhazia.corpus.corpus_split import CorpusSplit
+from abkhazia.corpus.corpus_validation import CorpusValidation, ValidationCache
+from abkhazia.corpus.prepare.abstract_preparator import AbstractPreparator
+import abkhazia.utils as utils
 
+import numpy as np
 import pytest
 
 
@@ -129,6 +147,35 @@ def test_spk2utt():
     assert c.spk2utt() == {'s1': ['u1', 'u2'], 's2': ['u3']}
 
 
+def test_indexes_cache():
+    c = Corpus()
+    c.utt2spk = {'u1': 's1', 'u2': 's1', 'u3': 's2'}
+    c.text = {'u1': 'a b', 'u2': 'b c', 'u3': 'a'}
+    c.lexicon = {'a': 'a', 'b': 'b'}
+    assert 'u1' in c.utts()
+    assert c.has_utt('u1') and not c.has_utt('u4')
+    assert c.words() == {'a', 'b'}
+
+    # the cached indexes are invalidated when the tables change
+    c.utt2spk['u4'] = 's3'
+    assert 'u4' in c.utts()
+    assert c.has_utt('u4')
+    assert sorted(c.spks()) == ['s1', 's2', 's3']
+    c.lexicon['c'] = 'c'
+    assert c.words() == {'a', 'b', 'c'}
+    c.text = {'u1': 'd'}
+    assert c.words(in_lexicon=False) == {'d'}
+
+    # the returned indexes can be modified without altering the cache
+    c.spk2utt()['s1'].append('u5')
+    assert c.spk2utt()['s1'] == ['u1', 'u2']
+    utts = c.utts()
+    utts.remove('u1')
+    assert 'u1' not in utts
+    assert 'u1' in c.utts()
+    assert c.has_utt('u1')
+
+
 def test_phonemize_text(corpus, tmpdir):
     phones = corpus.phonemize_text()
     assert sorted(phones.keys()) == sorted(corpus.utts())
@@ -162,3 +209,1027 @@ def test_remove_phones(corpus):
     # make sure the phone is not here
     assert p not in corpus.phones
     assert not _aux(p, corpus.lexicon)
+
+
+def test_compact(corpus, tmpdir):
+    corpus_saved = str(tmpdir.mkdir('corpus'))
+    corpus.save(corpus_saved, copy_wavs=False)
+
+    d = Corpus.load(corpus_saved, compact=True)
+    assert d.is_compact()
+    assert not corpus.is_compact()
+    assert d.is_valid()
+    assert corpus.lexicon == d.lexicon
+    assert corpus.segments == d.segments
+    assert corpus.text == d.text
+    assert corpus.utt2spk == d.utt2spk
+    assert corpus.wavs == d.wavs
+
+    # subcorpora of compact corpora are compact
+    e = d.subcorpus(list(d.utts())[:5])
+    assert e.is_compact()
+    assert len(e.utts()) == 5
+    assert e.is_valid()
+
+
+def test_compact_tables():
+    c = Corpus()
+    c.segments = {'u1': ('w1.wav', None, None), 'u2': ('w2.wav', 0, 1.5)}
+    c.text = {'u1': 'a b', 'u2': 'b c a'}
+    c.utt2spk = {'u1': 's1', 'u2': 's2'}
+    c.lexicon = {'a': 'p a', 'b': 'b', 'c': 'k'}
+    c.compact()
+    assert c.is_compact()
+    assert c.segments['u1'] == ('w1.wav', None, None)
+    assert c.segments['u2'] == ('w2.wav', 0.0, 1.5)
+    assert c.text['u2'] == 'b c a'
+    assert c.spk2utt() == {'s1': ['u1'], 's2': ['u2']}
+
+    c.text['u1'] = 'c'
+    del c.utt2spk['u2']
+    assert c.text['u1'] == 'c'
+    assert 'u2' not in c.utt2spk
+    assert c.utts() == ['u1']
+    with pytest.raises(KeyError):
+        c.segments['u3']
+
+    # irregular whitespaces do not move tokens between entries
+    c.text.extend({'u1': 'a  b', 'u2': 'c\td'})
+    assert c.text['u1'] == 'a b'
+    assert c.text['u2'] == 'c d'
+    c.text.extend({'u3': '', 'u4': ' e f'})
+    assert c.text['u3'] == ''
+    assert c.text['u4'] == 'e f'
+
+
+def test_duration_cache(corpus, tmpdir, monkeypatch):
+    corpus_saved = str(tmpdir.mkdir('corpus'))
+    c = corpus.subcorpus(list(corpus.utts()), validate=False)
+    c.segments = {u: (w, None, None) for u, (w, _, _) in c.segments.items()}
+    c.save(corpus_saved, copy_wavs=False)
+
+    d = Corpus.load(corpus_saved)
+    assert d.cache_dir == os.path.join(corpus_saved, 'cache')
+    duration = d.duration()
+    cache = os.path.join(d.cache_dir, 'wav_durations.txt')
+    assert os.path.isfile(cache)
+    assert len(d.wav_durations) == len(d.wavs)
+
+    # a second load reuses the persisted durations, wavs are not opened
+    def _fail(wav):
+        raise AssertionError('wav opened: {}'.format(wav))
+    monkeypatch.setattr(utils.wav, 'duration', _fail)
+
+    e = Corpus.load(corpus_saved)
+    assert len(e.wav_durations) == len(e.wavs)
+    assert e.duration() == duration
+
+    # the WAVE_FORMAT_EXTENSIBLE wavs accepted by the validation are
+    # supported
+    monkeypatch.undo()
+    extensible = os.path.join(str(tmpdir), 'extensible.wav')
+    _write_extensible_wav(
+        extensible, np.zeros((24000, 1)), 16000, 0x0001, 2)
+    assert utils.wav.scan([extensible])[extensible].rate == 16000
+    assert utils.wav.duration(extensible) == 1.5
+    assert utils.wav.DurationCache().duration(extensible) == 1.5
+
+
+def test_snapshot(corpus, tmpdir):
+    corpus_saved = str(tmpdir.mkdir('corpus'))
+    corpus.save(corpus_saved, copy_wavs=False, snapshot=True)
+    snapshot = os.path.join(corpus_saved, 'cache', 'corpus.snapshot')
+    assert os.path.isfile(snapshot)
+
+    d = Corpus.load(corpus_saved)
+    assert d.is_compact()
+    assert d.is_valid()
+    for attr in ('lexicon', 'segments', 'text', 'utt2spk',
+                 'phones', 'wavs', 'silences', 'variants'):
+        assert getattr(corpus, attr) == getattr(d, attr)
+
+    # the snapshot is mapped in copy-on-write mode
+    utt = d.utts()[0]
+    d.text[utt] = 'foo'
+    assert d.text[utt] == 'foo'
+    assert Corpus.load(corpus_saved).text[utt] == corpus.text[utt]
+
+    # the snapshot of a subcorpus of a compact corpus is built from
+    # its data
+    sub = Corpus.load(corpus_saved).subcorpus(sorted(corpus.utts())[:5])
+    sub_saved = str(tmpdir.mkdir('subcorpus'))
+    sub.save(sub_saved, copy_wavs=False, snapshot=True)
+    e = Corpus.load(sub_saved)
+    assert e.is_compact()
+    for attr in ('lexicon', 'segments', 'text', 'utt2spk'):
+        assert getattr(sub, attr) == getattr(e, attr)
+
+    # the snapshot is ignored when the text files are modified
+    text = os.path.join(corpus_saved, 'text.txt')
+    os.utime(text, ns=(0, os.stat(text).st_mtime_ns + 1))
+    assert not Corpus.load(corpus_saved).is_compact()
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_lazy(corpus, tmpdir, compact):
+    corpus_saved = os.path.join(str(tmpdir), 'corpus')
+    corpus.save(corpus_saved, copy_wavs=False)
+
+    d = Corpus.load(corpus_saved, lazy=True, compact=compact)
+    assert 'lexicon' not in d.__dict__
+    assert 'segments' not in d.__dict__
+
+    # only the accessed attributes are loaded
+    assert d.utt2spk == corpus.utt2spk
+    assert 'utt2spk' in d.__dict__
+    assert 'lexicon' not in d.__dict__
+
+    for attr in ('lexicon', 'segments', 'text', 'phones',
+                 'wavs', 'silences', 'variants'):
+        assert getattr(d, attr) == getattr(corpus, attr)
+    assert d.is_compact() is compact
+    assert d.is_valid()
+
+    with pytest.raises(AttributeError):
+        d.foo
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_load_irregular(corpus, tmpdir, compact):
+    corpus_saved = os.path.join(str(tmpdir), 'corpus')
+    corpus.save(corpus_saved, copy_wavs=False)
+
+    # mixed separators and segments with and without timestamps
+    utt = sorted(corpus.utts())[0]
+    with open(os.path.join(corpus_saved, 'text.txt'), 'w') as out:
+        for k, v in corpus.text.items():
+            out.write(u'{}\t{} \n'.format(k, v.replace(' ', '  ')))
+    with open(os.path.join(corpus_saved, 'segments.txt'), 'w') as out:
+        for k, v in corpus.segments.items():
+            if k == utt:
+                out.write(u'{} {}\n'.format(k, v[0]))
+            else:
+                out.write(u'{} {} {} {}\n'.format(k, *v))
+
+    d = Corpus.load(corpus_saved, compact=compact)
+    assert d.text == corpus.text
+    assert d.segments[utt] == (corpus.segments[utt][0], None, None)
+    del d.segments[utt]
+    assert d.segments == {
+        k: v for k, v in corpus.segments.items() if k != utt}
+
+    # lines are separated by '\n' only
+    with open(os.path.join(corpus_saved, 'text.txt'), 'w') as out:
+        for k, v in corpus.text.items():
+            out.write(u'{} {}\n'.format(
+                k, v + u'\x1c' if k == utt else v))
+    d = Corpus.load(corpus_saved, compact=compact, validate=False)
+    assert sorted(d.text) == sorted(corpus.text)
+    assert d.text[utt].split() == corpus.text[utt].split()
+    if not compact:  # the compact text is stored as tokens
+        assert d.text[utt] == corpus.text[utt] + u'\x1c'
+
+    # the columns are checked line by line
+    assert CorpusLoader._split_columns(u'u1 s1 x\nu2\n', 2) is None
+    assert CorpusLoader._split_columns(u'u1 s1\nu2 s2\n', 2) == [
+        ['u1', 'u2'], ['s1', 's2']]
+
+
+def test_save_incremental(corpus, tmpdir):
+    corpus_saved = os.path.join(str(tmpdir), 'corpus')
+    corpus.save(corpus_saved, copy_wavs=False)
+
+    def _mtimes():
+        return {f: os.stat(os.path.join(corpus_saved, f)).st_mtime_ns
+                for f in os.listdir(corpus_saved) if f.endswith('.txt')}
+    mtimes = _mtimes()
+
+    # only the modified lexicon is rewritten
+    d = Corpus.load(corpus_saved)
+    del d.lexicon[sorted(d.lexicon)[0]]
+    d.save(corpus_saved, force=True)
+
+    new_mtimes = _mtimes()
+    for name in ('segments.txt', 'text.txt', 'utt2spk.txt', 'phones.txt'):
+        assert mtimes[name] == new_mtimes[name]
+    assert mtimes['lexicon.txt'] != new_mtimes['lexicon.txt']
+    assert not [f for f in os.listdir(corpus_saved) if f.endswith('.tmp')]
+
+    d2 = Corpus.load(corpus_saved)
+    assert d2.lexicon == d.lexicon
+    assert d2.text == corpus.text
+    assert os.path.isdir(os.path.join(corpus_saved, 'wavs'))
+
+
+def test_save_force(corpus, tmpdir):
+    corpus_saved = os.path.join(str(tmpdir), 'corpus')
+    corpus.save(corpus_saved, copy_wavs=False, snapshot=True)
+    d = Corpus.load(corpus_saved, validate=True)
+    CorpusValidation(d).validate_signal()
+
+    def _exists(*name):
+        return os.path.exists(os.path.join(corpus_saved, *name))
+    assert _exists(CorpusValidation.signal_qc_file)
+    assert _exists('cache', CorpusValidation.cache_file)
+    assert _exists('cache', 'corpus.snapshot')
+
+    # an existing path is never overwritten without force
+    with pytest.raises(OSError):
+        d.save(corpus_saved)
+    open(os.path.join(str(tmpdir), 'file'), 'w').close()
+    with pytest.raises(OSError):
+        d.save(os.path.join(str(tmpdir), 'file'))
+
+    # the files not written by the saver are deleted
+    open(os.path.join(corpus_saved, 'stray.txt'), 'w').close()
+    d.save(corpus_saved, force=True)
+    assert not _exists('stray.txt')
+    assert not _exists(CorpusValidation.signal_qc_file)
+    assert not _exists('cache', CorpusValidation.cache_file)
+    assert not _exists('cache', 'corpus.snapshot')
+    assert _exists('wavs')
+    assert Corpus.load(corpus_saved).text == corpus.text
+
+    # the wavs are deleted if not saved
+    d.save(corpus_saved, force=True, no_wavs=True)
+    assert not _exists('wavs')
+    assert _exists('text.txt')
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_subcorpus_view(corpus, compact):
+    c = corpus.subcorpus(corpus.utts(), validate=False)
+    if compact:
+        c.compact()
+    utts = sorted(c.utts())
+    sub = c.subcorpus(utts[:-1], validate=False)
+    assert sorted(sub.utts()) == utts[:-1]
+    assert sub.text == {u: c.text[u] for u in utts[:-1]}
+    assert utts[-1] not in sub.text
+
+    # modifying the view does not modify the parent, and conversely
+    text = c.text[utts[0]]
+    sub.text[utts[0]] = 'foo'
+    assert c.text[utts[0]] == text
+    del sub.segments[utts[1]]
+    assert utts[1] in c.segments
+    spk2utt = sub.spk2utt()
+    c.utt2spk[utts[2]] = 'bar'
+    assert sub.utt2spk[utts[2]] == corpus.utt2spk[utts[2]]
+    del c.utt2spk[utts[3]]
+    assert dict(sub.utt2spk) == {u: corpus.utt2spk[u] for u in utts[:-1]}
+    assert sub.spk2utt() == spk2utt
+
+    # the same on a plain dict corpus
+    c2 = Corpus()
+    c2.utt2spk = {'u1': 's1', 'u2': 's2'}
+    view = corpus_tables.view(c2.utt2spk, ['u1', 'u2'])
+    del c2.utt2spk['u1']
+    c2.utt2spk['u2'] = 's3'
+    assert dict(view) == {'u1': 's1', 'u2': 's2'}
+    view['u1'] = 's4'
+    assert 'u1' not in c2.utt2spk
+
+    with pytest.raises(KeyError):
+        c.subcorpus(['foo'], validate=False)
+
+
+def test_subcorpus_wavs_meta(corpus, monkeypatch):
+    corpus.validate()
+    assert set(corpus.wavs_meta) == corpus.wavs
+
+    # the wavs are not scanned again to validate a subcorpus
+    monkeypatch.setattr(utils.wav, 'scan', None)
+    sub = corpus.subcorpus(corpus.utts()[:-1])
+    assert sub.is_valid()
+    monkeypatch.undo()
+
+
+def test_wavs_meta_modified(corpus, tmpdir, monkeypatch):
+    corpus_saved = os.path.join(str(tmpdir), 'corpus')
+    corpus.save(corpus_saved, copy_wavs=True)
+    c = Corpus.load(corpus_saved, validate=True)
+    assert set(c.wavs_meta) == c.wavs
+
+    # a wav modified since its metadata is cached is scanned again
+    scanned = []
+    scan = utils.wav.scan
+
+    def _scan(wavs, *args, **kwargs):
+        scanned.extend(os.path.basename(w) for w in wavs)
+        return scan(wavs, *args, **kwargs)
+    monkeypatch.setattr(utils.wav, 'scan', _scan)
+
+    wav = sorted(c.wavs)[0]
+    path = os.path.join(c.wav_folder, wav)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    sub = c.subcorpus(c.utts())
+    assert scanned == [wav]
+    assert sub.wavs_meta is c.wavs_meta
+    assert c.wavs_meta[wav][0] == (stat.st_size, stat.st_mtime_ns + 10**9)
+
+
+def test_save_unchanged(corpus, tmpdir, monkeypatch):
+    corpus_saved = os.path.join(str(tmpdir), 'corpus')
+    corpus.save(corpus_saved, copy_wavs=False)
+
+    # tables unchanged since loading are not serialized again
+    d = Corpus.load(corpus_saved)
+    d.lexicon['foo'] = 'f o o'
+
+    from abkhazia.corpus.corpus_saver import CorpusSaver
+    for name in ('segments', 'text', 'utt2spk'):
+        monkeypatch.setattr(CorpusSaver, 'save_' + name, None)
+    d.save(corpus_saved, force=True)
+    assert Corpus.load(corpus_saved).lexicon['foo'] == 'f o o'
+
+
+def test_iter_utterances(corpus, tmpdir):
+    corpus_saved = os.path.join(str(tmpdir), 'corpus')
+    corpus.save(corpus_saved, copy_wavs=False)
+
+    utts = list(Corpus.iter_utterances(corpus_saved))
+    assert [u.utt_id for u in utts] == sorted(corpus.utts())
+    for utt in utts:
+        assert (utt.wav, utt.start, utt.stop) == corpus.segments[utt.utt_id]
+        assert utt.speaker == corpus.utt2spk[utt.utt_id]
+        assert utt.text == corpus.text[utt.utt_id]
+
+    # utterances missing from a file are ignored
+    text = os.path.join(corpus_saved, 'text.txt')
+    lines = open(text, 'r').readlines()
+    open(text, 'w').write(''.join(lines[1:]))
+    assert [u.utt_id for u in Corpus.iter_utterances(corpus_saved)] == \
+        sorted(corpus.utts())[1:]
+
+    # the files must be sorted
+    open(text, 'w').write(''.join(reversed(lines)))
+    with pytest.raises(IOError):
+        list(Corpus.iter_utterances(corpus_saved))
+
+
+@pytest.mark.parametrize('by', ['speakers', 'duration'])
+def test_shard(corpus, tmpdir, by):
+    shards = corpus.shard(2, by=by)
+    assert len(shards) == 2
+    assert sorted(shards[0].utts() + shards[1].utts()) == \
+        sorted(corpus.utts())
+    assert not set(shards[0].spks()).intersection(shards[1].spks())
+
+    shards_dir = os.path.join(str(tmpdir), 'shards')
+    CorpusShards.save(shards, shards_dir, by=by)
+    manifest = CorpusShards.load_manifest(shards_dir)
+    assert [s['utterances'] for s in manifest['shards']] == \
+        [len(s.utts()) for s in shards]
+    for i in range(2):
+        assert Corpus.load(CorpusShards.shard_dir(shards_dir, i)).is_valid()
+
+    merged_dir = os.path.join(str(tmpdir), 'merged')
+    CorpusShards.merge(shards_dir, merged_dir)
+    merged = Corpus.load(merged_dir)
+    assert merged.is_valid()
+    assert merged.segments == corpus.segments
+    assert merged.text == corpus.text
+    assert merged.utt2spk == corpus.utt2spk
+    assert merged.lexicon == corpus.lexicon
+
+    with pytest.raises(IOError):
+        corpus.shard(len(corpus.spks()) + 1)
+
+
+def test_validation_cache(corpus, tmpdir):
+    corpus_saved = os.path.join(str(tmpdir), 'corpus')
+    corpus.save(corpus_saved, copy_wavs=False)
+    cache = os.path.join(corpus_saved, 'cache', CorpusValidation.cache_file)
+
+    corpus1 = Corpus.load(corpus_saved, validate=True)
+    assert os.path.isfile(cache)
+    checks = ValidationCache(cache).checks
+    assert {'segments', 'speakers', 'transcription'}.issubset(checks)
+
+    # the wavs are not rescanned on the next validation
+    corpus2 = Corpus.load(corpus_saved)
+    validation = CorpusValidation(corpus2)
+    assert validation.cache.wavs.keys() == set(corpus2.wavs)
+    validation.validate()
+
+    # a modified file invalidates the checks depending on it
+    text = dict(corpus1.text)
+    text[corpus1.utts()[0]] += ' a'
+    corpus1.text = text
+    CorpusSaver.save(corpus1, corpus_saved)
+    corpus3 = Corpus.load(corpus_saved)
+    validation = CorpusValidation(corpus3)
+    assert validation.cache.checks['transcription'] != \
+        validation._key('segments', 'text')
+    assert validation.cache.checks['speakers'] == \
+        validation._key('segments', 'utt2spk')
+
+    # a corpus modified in memory is always checked
+    del corpus3.utt2spk[corpus3.utts()[0]]
+    with pytest.raises(IOError):
+        corpus3.validate()
+    corpus3 = Corpus.load(corpus_saved)
+    corpus3.validate(full=True)
+
+
+def test_scan_wavs(corpus, tmpdir):
+    wavs = [os.path.join(corpus.wav_folder, w) for w in corpus.wavs]
+
+    # a truncated and a non wav file
+    bad = os.path.join(str(tmpdir), 'bad.wav')
+    with open(bad, 'wb') as stream:
+        stream.write(open(wavs[0], 'rb').read(30))
+    wavs.append(bad)
+
+    meta = utils.wav.scan(wavs, njobs=2, batch_size=1)
+    assert meta[bad].nframes == 0
+    for wav in wavs[:-1]:
+        assert meta[wav] == utils.wav.scan([wav])[wav]
+        assert meta[wav].duration == pytest.approx(utils.wav.duration(wav))
+        assert meta[wav].comptype == 'NONE'
+
+
+@pytest.mark.parametrize('chunk_size', [602, 4000])
+def test_scan_big_chunk(tmpdir, chunk_size):
+    # a 16 kHz wav with a broadcast extension chunk bigger than the
+    # header buffer between the fmt and data chunks
+    data = np.arange(16000, dtype='<i2').tobytes()
+    chunks = (
+        b'fmt ' + struct.pack('<IHHIIHH', 16, 1, 1, 16000, 32000, 2, 16)
+        + b'bext' + struct.pack('<I', chunk_size) + b'\x00' * chunk_size
+        + b'data' + struct.pack('<I', len(data)) + data)
+    wav = os.path.join(str(tmpdir), 'bext.wav')
+    with open(wav, 'wb') as stream:
+        stream.write(b'RIFF' + struct.pack('<I', 4 + len(chunks))
+                     + b'WAVE' + chunks)
+
+    meta = utils.wav.scan([wav])[wav]
+    assert meta.nframes == 16000
+    assert meta.duration == pytest.approx(utils.wav.duration(wav))
+
+    output = os.path.join(str(tmpdir), 'trimmed.wav')
+    assert utils.wav.trim(wav, output, [(0, 0.5)]) == 8000
+    meta, offset = utils.wav._parse_header(open(output, 'rb'))
+    assert np.array_equal(
+        np.fromfile(output, dtype='<i2', offset=offset),
+        np.arange(8000, 16000, dtype='<i2'))
+
+
+def test_validate_segments(corpus, caplog):
+    sub = corpus.subcorpus(corpus.utts(), validate=False)
+    validation = CorpusValidation(sub, log=logging.getLogger('test'))
+    caplog.set_level(logging.DEBUG)
+    meta = validation.validate_wavs()
+    validation.validate_segments(meta)
+
+    compact = corpus.subcorpus(corpus.utts(), validate=False).compact()
+    CorpusValidation(compact).validate_segments(meta)
+
+    utt1, utt2 = sorted(corpus.utts())[:2]
+    wav, start, stop = sub.segments[utt1]
+
+    # overlapping utterances issue a warning
+    sub.segments[utt2] = (wav, start, stop)
+    caplog.clear()
+    validation.validate_segments(meta)
+    assert 'overlapping' in caplog.text
+    assert 'start at the same time' in caplog.text
+
+    # null and out of bounds utterances are errors
+    sub.segments[utt2] = (wav, start, start)
+    with pytest.raises(IOError) as err:
+        validation.validate_segments(meta)
+    assert 'duration of 0' in str(err.value)
+
+    sub.segments[utt2] = (wav, start, meta[wav].duration + 1)
+    with pytest.raises(IOError) as err:
+        validation.validate_segments(meta)
+    assert 'boudaries' in str(err.value)
+
+
+def test_validate_signal(corpus, tmpdir):
+    qc_file = os.path.join(str(tmpdir), 'qc.txt')
+    qc = CorpusValidation(corpus, njobs=2).validate_signal(qc_file)
+    assert sorted(qc['utt']) == sorted(corpus.utts())
+    assert ((qc['peak'] > 0) & (qc['peak'] <= 1)).all()
+    assert (qc['rms'] <= qc['peak']).all()
+    assert ((qc['silence'] >= 0) & (qc['silence'] <= 1)).all()
+
+    loaded = CorpusValidation.load_signal_qc(qc_file)
+    assert loaded['utt'] == qc['utt']
+    assert loaded['rms'] == pytest.approx(qc['rms'], rel=1e-5)
+
+    # filter the utterances with the lowest rms
+    threshold = np.median(qc['rms'])
+    sub, removed = CorpusFilter(corpus).filter_signal(
+        loaded, min_rms=threshold)
+    assert sorted(sub.utts() + removed) == sorted(corpus.utts())
+    assert all(qc['rms'][qc['utt'].index(utt)] >= threshold
+               for utt in sub.utts())
+
+
+@pytest.mark.parametrize('by_speakers', [True, False])
+def test_kfold(corpus, by_speakers):
+    k = 3
+    folds = list(corpus.kfold(k, by_speakers=by_speakers, random_seed=0))
+    assert len(folds) == k
+
+    tests = [test.utts() for _, test in folds]
+    assert sorted(utt for test in tests for utt in test) == \
+        sorted(corpus.utts())
+    for train, test in folds:
+        assert sorted(train.utts() + test.utts()) == sorted(corpus.utts())
+        if by_speakers:
+            assert not set(train.spks()).intersection(test.spks())
+
+    # same seed, same folds
+    assert tests == [test.utts() for _, test in corpus.kfold(
+        k, by_speakers=by_speakers, random_seed=0)]
+
+    with pytest.raises(RuntimeError):
+        next(corpus.kfold(len(corpus.utts()) + 1, by_speakers=by_speakers))
+
+
+def test_repeated_split(corpus):
+    spliter = CorpusSplit(corpus, random_seed=0, validate=False)
+    splits = list(spliter.repeated_split(3, test_prop=0.5))
+    assert len(splits) == 3
+    for train, test in splits:
+        assert not set(train.spks()).intersection(test.spks())
+
+    with pytest.raises(RuntimeError):
+        spliter.split_from_speakers_list([], ['unknown'])
+
+
+@pytest.mark.parametrize('by_speakers', [True, False])
+def test_split_by_duration(corpus, by_speakers):
+    utt2dur = corpus.utt2duration()
+    total = sum(utt2dur.values())
+
+    train, test = corpus.split_by_duration(
+        total / 2, by_speakers=by_speakers, random_seed=0)
+    assert 0 < test.duration() <= total / 2 + 1e-3
+    assert sorted(train.utts() + test.utts()) == sorted(corpus.utts())
+    if by_speakers:
+        assert not set(train.spks()).intersection(test.spks())
+
+    # reproducible under random seed
+    _, test2 = corpus.split_by_duration(
+        total / 2, by_speakers=by_speakers, random_seed=0)
+    assert sorted(test.utts()) == sorted(test2.utts())
+
+    # train duration can be specified
+    train, test = corpus.split_by_duration(
+        total / 2, total / 2, by_speakers=by_speakers, random_seed=0)
+    assert train.duration() <= total / 2 + 1e-3
+
+    with pytest.raises(RuntimeError):
+        corpus.split_by_duration(total + 1)
+
+
+def test_split_by_duration_strata(corpus):
+    spks = sorted(corpus.spks())
+    strata = {spk: i % 2 for i, spk in enumerate(spks)}
+    total = corpus.duration()
+
+    train, test = corpus.split_by_duration(
+        total / 2, strata=strata, random_seed=0)
+    assert sorted(train.utts() + test.utts()) == sorted(corpus.utts())
+    assert test.duration() <= total / 2 + 1e-3
+
+    with pytest.raises(RuntimeError):
+        corpus.split_by_duration(total / 2, strata={spks[0]: 0})
+    with pytest.raises(RuntimeError):
+        corpus.split_by_duration(
+            total / 2, by_speakers=False, strata=strata)
+
+
+def test_filter_durations(corpus):
+    # work on a copy-on-write view as filtering shifts the segments
+    sub = corpus.subcorpus(corpus.utts(), validate=False)
+    spk2dur = {spk: sum(sub.utt2duration()[utt] for utt in utts)
+               for spk, utts in sub.spk2utt().items()}
+    times = np.array(sorted(spk2dur.values(), reverse=True))
+
+    distrib = CorpusFilter._cutting_distribution('power-law', times)
+    assert distrib == pytest.approx(times[0] / np.arange(1, 4) + 30)
+    distrib = CorpusFilter._cutting_distribution('step', times, 1)
+    assert distrib == pytest.approx(
+        np.concatenate((times[:1], np.minimum(times[1:], 600))))
+    with pytest.raises(IOError):
+        CorpusFilter._cutting_distribution('unknown', times)
+
+    # less than 10 utterances per speaker, all are kept
+    filtered, removed = CorpusFilter(sub).create_filter(None, 'exponential')
+    assert sorted(filtered.utts()) == sorted(sub.utts())
+    assert not removed
+
+    # speakers with a null limit are ignored
+    spk = sorted(spk2dur)[0]
+    filtered, removed = CorpusFilter(sub).filter_corpus(
+        sorted(spk2dur), 'nothing', dict(spk2dur, **{spk: 0}))
+    assert sorted(filtered.spks()) == sorted(spk2dur)[1:]
+    assert not removed
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_query(corpus, tmpdir, compact):
+    corpus_saved = os.path.join(str(tmpdir), 'corpus')
+    corpus.save(corpus_saved, copy_wavs=False)
+    corpus = Corpus.load(corpus_saved, compact=compact)
+
+    utt2dur = corpus.utt2duration()
+    spk = sorted(corpus.spks())[0]
+    word = next(iter(corpus.lexicon))
+    expected = sorted(
+        utt for utt in corpus.utts()
+        if utt2dur[utt] > 1 and corpus.utt2spk[utt] != spk)
+
+    sub = corpus.query(
+        'duration > 1 and not speaker in @spks', variables={'spks': [spk]})
+    assert sorted(sub.utts()) == expected
+
+    utts, mask = CorpusQuery(
+        '0 <= oov_rate <= oov / words and words > 0').mask(corpus)
+    assert sorted(utts) == sorted(corpus.utts())
+    assert mask.all()
+
+    # oov are computed from the lexicon
+    del corpus.lexicon[word]
+    utts, mask = CorpusQuery('oov > 0').mask(corpus)
+    assert sorted(utt for utt, m in zip(utts, mask) if m) == sorted(
+        utt for utt, text in corpus.text.items() if word in text.split())
+
+    # repeated oov are counted on each occurrence
+    utt = sorted(corpus.utts())[0]
+    known = next(iter(corpus.lexicon))
+    corpus.text[utt] = '{} {} {}'.format(word, word, known)
+    utts, mask = CorpusQuery('oov == 2 and oov_rate > 0.5').mask(corpus)
+    assert [u for u, m in zip(utts, mask) if m] == [utt]
+
+    # signal columns
+    qc = {'utt': sorted(corpus.utts())[1:],
+          'rms': np.ones(len(corpus.utts()) - 1)}
+    sub, removed = CorpusFilter(corpus).filter_query(
+        'rms == 1 or utt in ("foo", "bar")', signal_qc=qc)
+    assert removed == [sorted(corpus.utts())[0]]
+
+    for query in ('1 <', 'foo > 0', 'duration', '@spks > 0',
+                  'speaker in speaker', 'len(utt) > 0', 'rms > 0'):
+        with pytest.raises(IOError):
+            CorpusQuery(query).mask(corpus)
+
+
+@pytest.mark.parametrize('padding', [0, 0.5])
+def test_merge_wavs(corpus, tmpdir, monkeypatch, padding):
+    # work on a copy-on-write view as merging modifies the corpus,
+    # with s0102a and s0102b from the same speaker
+    sub = corpus.subcorpus(corpus.utts(), validate=False)
+    for utt in sub.utts():
+        sub.utt2spk[utt] = utt[:5]
+    spk2wavs = {spk: sorted({corpus.segments[utt][0] for utt in utts})
+                for spk, utts in sub.spk2utt().items()}
+    assert sorted(len(wavs) for wavs in spk2wavs.values()) == [1, 2]
+
+    # stream the wavs by small chunks
+    monkeypatch.setattr(CorpusMergeWavs, 'chunk_size', 1000)
+    output_dir = os.path.join(str(tmpdir), 'merged')
+    sub.merge_wavs(output_dir, padding=padding, njobs=2)
+
+    assert sorted(sub.wavs) == sorted(spk + '.wav' for spk in spk2wavs)
+    for spk, wavs in spk2wavs.items():
+        merged = utils.wav.scan(
+            [os.path.join(output_dir, 'wavs', spk + '.wav')])
+        merged = list(merged.values())[0]
+        inputs = utils.wav.scan(
+            [os.path.join(corpus.wav_folder, wav) for wav in wavs])
+        assert merged.nframes == (
+            sum(meta.nframes for meta in inputs.values())
+            + int(round(padding * merged.rate)) * (len(wavs) - 1))
+
+    # the utterances are at the same place in the merged wavs
+    loaded = Corpus.load(output_dir)
+    for utt in corpus.utts():
+        assert loaded.utt2duration()[utt] == pytest.approx(
+            corpus.utt2duration()[utt])
+
+
+def test_merge_wavs_virtual(corpus, tmpdir):
+    sub = corpus.subcorpus(corpus.utts(), validate=False)
+    for utt in sub.utts():
+        sub.utt2spk[utt] = utt[:5]
+
+    output_dir = os.path.join(str(tmpdir), 'merged')
+    sub.merge_wavs(output_dir, padding=0.5, virtual=True)
+    assert os.path.islink(os.path.join(output_dir, 'wavs'))
+
+    merged = Corpus.load(output_dir, validate=True)
+    assert sorted(merged.wavs) == ['s0101.wav', 's0102.wav']
+    assert merged.wav_files() == corpus.wavs
+    assert [w for w, _, _ in merged.merged_wavs['s0102.wav']] == [
+        's0102a.wav', 's0102b.wav']
+
+    # utterances of the second wav are shifted by its offset
+    offset = corpus.wav_durations.duration(
+        os.path.join(corpus.wav_folder, 's0102a.wav')) + 0.5
+    assert merged.merged_wavs['s0102.wav'][1][1] == pytest.approx(offset)
+    for utt in corpus.utts():
+        wav, start, stop = merged.segments[utt]
+        shift = offset if corpus.segments[utt][0] == 's0102b.wav' else 0
+        assert start == pytest.approx(corpus.segments[utt][1] + shift)
+
+    # the signal QC is computed on the files the merged wavs are made of
+    qc = CorpusValidation(corpus).validate_signal(
+        os.path.join(str(tmpdir), 'qc.txt'))
+    merged_qc = CorpusValidation(merged).validate_signal(
+        os.path.join(str(tmpdir), 'merged_qc.txt'))
+    assert sorted(merged_qc['utt']) == sorted(qc['utt'])
+    rms = dict(zip(qc['utt'], qc['rms']))
+    assert [rms[utt] for utt in merged_qc['utt']] == pytest.approx(
+        merged_qc['rms'], rel=1e-3)
+
+    # the merged wavs are concatenated on the fly in kaldi recipes
+    recipe = Abkhazia2Kaldi(merged, str(tmpdir.mkdir('recipe')))
+    recipe.setup_wav()
+    wav_scp = dict(line.strip().split(' ', 1) for line in open(
+        os.path.join(recipe._output_path(), 'wav.scp')))
+    assert wav_scp['s0101.wav'] == 'sox {} -t wav - |'.format(
+        os.path.join(merged.wav_folder, 's0101b.wav'))
+    assert 'trim 0 0.5' in wav_scp['s0102.wav']
+    assert wav_scp['s0102.wav'].endswith('s0102b.wav -t wav - |')
+
+
+def test_trim(corpus, tmpdir):
+    removed_utt = 's0102a-sent16'
+    wav, start, stop = corpus.segments[removed_utt]
+    sub = corpus.subcorpus(
+        [utt for utt in corpus.utts() if utt != removed_utt])
+    not_kept = {corpus.utt2spk[removed_utt]: [
+        (removed_utt, corpus.segments[removed_utt])]}
+
+    output_dir = str(tmpdir)
+    sub.trim(None, output_dir, 'trimmed', not_kept, njobs=2)
+    wavs_dir = os.path.join(output_dir, 'trimmed', 'data', 'wavs')
+    assert sorted(os.listdir(wavs_dir)) == sorted(sub.wavs)
+
+    # the wavs without removed utterances are copied
+    def _read(path):
+        with open(path, 'rb') as stream:
+            return stream.read()
+    for w in sub.wavs - {wav}:
+        assert _read(os.path.join(wavs_dir, w)) == _read(
+            os.path.join(corpus.wav_folder, w))
+
+    # the samples of the removed utterance are not in the trimmed wav
+    def _samples(path):
+        meta, offset = utils.wav._parse_header(open(path, 'rb'))
+        return np.memmap(path, dtype='<i2', mode='r', offset=offset,
+                         shape=(meta.nframes,)), meta.rate
+    orig, rate = _samples(os.path.join(corpus.wav_folder, wav))
+    trimmed, _ = _samples(os.path.join(wavs_dir, wav))
+    start, stop = int(round(start * rate)), int(round(stop * rate))
+    assert np.array_equal(
+        trimmed, np.concatenate((orig[:start], orig[stop:])))
+
+    # removing everything leaves an empty wav
+    output = os.path.join(str(tmpdir), 'empty.wav')
+    assert utils.wav.trim(
+        os.path.join(corpus.wav_folder, wav), output,
+        [(None, 1), (0.5, None)]) == 0
+
+
+@pytest.mark.parametrize('rate, nbc, width, fileformat', [
+    (16000, 2, 2, 'wav'), (44100, 1, 3, 'wav'), (8000, 2, 1, 'wav'),
+    (22050, 1, 4, 'wav'), (8000, 1, 2, 'sph')])
+def test_convert(tmpdir, rate, nbc, width, fileformat):
+    # a 440 Hz sine at half the full scale on each channel
+    signal = 0.5 * np.sin(2 * np.pi * 440 * np.arange(rate) / rate)
+    scale = 2 ** (8 * width - 1) - 1
+    data = np.round(np.repeat(signal[:, None], nbc, axis=1) * scale)
+
+    audio = os.path.join(str(tmpdir), 'input.' + fileformat)
+    if fileformat == 'sph':
+        header = ('NIST_1A\n   1024\nsample_rate -i {}\nchannel_count -i {}\n'
+                  'sample_n_bytes -i 2\nsample_byte_format -s2 10\n'
+                  'sample_coding -s3 pcm\nend_head\n'.format(rate, nbc))
+        with open(audio, 'wb') as stream:
+            stream.write(header.encode('ascii').ljust(1024, b' '))
+            stream.write(data.astype('>i2').tobytes())
+    else:
+        if width == 1:
+            raw = (data + 128).astype('u1').tobytes()
+        elif width == 3:
+            raw = data.astype('<i4').view('u1').reshape(-1, 4)[:, :3]
+            raw = raw.tobytes()
+        else:
+            raw = data.astype('<i{}'.format(width)).tobytes()
+        with contextlib.closing(wave.open(audio, 'w')) as stream:
+            stream.setparams((nbc, width, rate, 0, 'NONE', 'not compressed'))
+            stream.writeframes(raw)
+
+    output = os.path.join(str(tmpdir), 'output.wav')
+    utils.wav.convert([audio], [output], fileformat)
+    assert not os.path.islink(output)
+
+    meta, offset = utils.wav._parse_header(open(output, 'rb'))
+    assert (meta.nbc, meta.width, meta.rate, meta.nframes) == (
+        1, 2, 16000, 16000)
+    converted = np.fromfile(output, dtype='<i2', offset=offset) / 32768.
+    expected = 0.5 * np.sin(2 * np.pi * 440 * np.arange(16000) / 16000.)
+    assert np.abs(converted - expected)[100:-100].max() < 0.01
+
+
+@pytest.mark.parametrize('copy_wavs', [True, False])
+def test_make_wavs(corpus, tmpdir, monkeypatch, copy_wavs):
+    # a minimal preparator of raw wavs copied from the corpus
+    raw_dir = os.path.join(str(tmpdir), 'raw')
+    os.makedirs(raw_dir)
+    for wav in corpus.wavs:
+        shutil.copy(os.path.join(corpus.wav_folder, wav), raw_dir)
+
+    class Preparator(AbstractPreparator):
+        name = 'test'
+        audio_format = 'wav'
+
+        def list_audio_files(self):
+            return [os.path.join(raw_dir, w) for w in sorted(corpus.wavs)]
+
+    preparator = Preparator(raw_dir)
+    preparator.copy_wavs = copy_wavs
+    preparator.njobs = 1
+
+    converted = []
+    convert = utils.wav.convert
+
+    def _convert(inputs, outputs, *args, **kwargs):
+        converted.extend(os.path.basename(o) for o in outputs)
+        return convert(inputs, outputs, *args, **kwargs)
+    monkeypatch.setattr(utils.wav, 'convert', _convert)
+
+    wavs_dir = os.path.join(str(tmpdir), 'wavs')
+    preparator.make_wavs(wavs_dir)
+    assert sorted(converted) == sorted(corpus.wavs)
+    assert sorted(os.listdir(wavs_dir)) == sorted(
+        list(corpus.wavs) + ['.manifest.txt'])
+    for wav in corpus.wavs:
+        assert os.path.islink(os.path.join(wavs_dir, wav)) != copy_wavs
+
+    # nothing to do on a second run, the wavs are not read again
+    checksums = []
+    checksum = utils.checksum
+
+    def _checksum(filename):
+        checksums.append(os.path.basename(filename))
+        return checksum(filename)
+    monkeypatch.setattr(utils, 'checksum', _checksum)
+
+    del converted[:]
+    preparator.make_wavs(wavs_dir)
+    assert converted == []
+    assert checksums == []
+
+    # a touched wav is checked by its checksum only
+    if copy_wavs:
+        wav = sorted(corpus.wavs)[0]
+        os.utime(os.path.join(wavs_dir, wav), ns=(0, 10**9))
+        preparator.make_wavs(wavs_dir)
+        assert converted == []
+        assert checksums == [wav]
+
+    # the wavs prepared without a manifest are kept
+    utils.remove(os.path.join(wavs_dir, '.manifest.txt'))
+    preparator.make_wavs(wavs_dir)
+    assert converted == []
+    preparator.make_wavs(wavs_dir)
+    assert converted == []
+
+    # a truncated output, a modified input and an undesired file are
+    # detected, the other wavs are not prepared again
+    wav1, wav2, wav3 = sorted(corpus.wavs)
+    if copy_wavs:
+        with open(os.path.join(wavs_dir, wav1), 'r+b') as stream:
+            stream.truncate(100)
+    else:
+        utils.remove(os.path.join(wavs_dir, wav1))
+    stat = os.stat(os.path.join(raw_dir, wav2))
+    os.utime(os.path.join(raw_dir, wav2),
+             ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    open(os.path.join(wavs_dir, 'undesired.wav.tmp'), 'w').close()
+
+    preparator.make_wavs(wavs_dir)
+    assert sorted(converted) == [wav1, wav2]
+    assert sorted(os.listdir(wavs_dir)) == sorted(
+        list(corpus.wavs) + ['.manifest.txt'])
+    assert os.path.isfile(os.path.join(raw_dir, wav3))
+    for wav in corpus.wavs:
+        assert utils.checksum(os.path.join(wavs_dir, wav)) == \
+            utils.checksum(os.path.join(raw_dir, wav))
+
+
+def test_convert_failures(corpus, tmpdir, caplog):
+    wavs = sorted(os.path.join(corpus.wav_folder, w) for w in corpus.wavs)
+    bad = os.path.join(str(tmpdir), 'bad.wav')
+    with open(bad, 'wb') as stream:
+        stream.write(b'not a wav file')
+    inputs = wavs[:1] + [bad] + wavs[1:]
+    outputs = [os.path.join(str(tmpdir), 'out{}.wav'.format(i))
+               for i in range(len(inputs))]
+
+    caplog.set_level(logging.INFO)
+    failed = utils.wav.convert(
+        inputs, outputs, 'wav', njobs=2, copy=True, batch_size=1,
+        log=logging.getLogger('test'))
+
+    # the bad file is reported, the others are converted
+    assert list(failed.keys()) == [bad]
+    assert not os.path.exists(outputs[1])
+    assert not any(f.endswith('.tmp') for f in os.listdir(str(tmpdir)))
+    for i, o in zip(inputs, outputs):
+        if i != bad:
+            assert utils.checksum(i) == utils.checksum(o)
+    assert 'wav (copy): {} files'.format(len(wavs)) in caplog.text
+    assert 'failed to convert {}'.format(bad) in caplog.text
+
+
+@pytest.mark.parametrize('link', ['hardlink', 'symlink'])
+def test_wav_store(corpus, tmpdir, link):
+    store_dir = os.path.join(str(tmpdir), 'store')
+    previous = utils.config.get('abkhazia', 'wav-store', fallback=None)
+    utils.config.set('abkhazia', 'wav-store', store_dir)
+    utils.config.set('abkhazia', 'wav-store-link', link)
+    try:
+        store = utils.wav.WavStore.from_config()
+        assert store.directory == store_dir
+
+        # two copies of the corpus share the same stored wavs
+        sub = corpus.subcorpus(corpus.utts(), validate=False)
+        for name in ('copy1', 'copy2'):
+            sub.save(os.path.join(str(tmpdir), name), copy_wavs=True)
+        for wav in corpus.wavs:
+            sha1 = utils.checksum(os.path.join(corpus.wav_folder, wav))
+            stored = store.path(sha1)
+            assert os.path.isfile(stored)
+            for name in ('copy1', 'copy2'):
+                copied = os.path.join(str(tmpdir), name, 'wavs', wav)
+                assert os.path.samefile(copied, stored)
+                assert store.is_link(copied) == (link == 'symlink')
+        assert sum(len(files) for _, _, files in os.walk(store_dir)) == len(
+            corpus.wavs)
+
+        # the merged wavs are moved to the store
+        for utt in sub.utts():
+            sub.utt2spk[utt] = utt[:5]
+        output_dir = os.path.join(str(tmpdir), 'merged')
+        sub.merge_wavs(output_dir)
+        assert sorted(os.listdir(os.path.join(output_dir, 'wavs'))) == sorted(
+            sub.wavs)
+        for wav in sub.wavs:
+            merged = os.path.join(output_dir, 'wavs', wav)
+            assert os.path.samefile(
+                merged, store.path(utils.checksum(merged)))
+        Corpus.load(output_dir).validate()
+    finally:
+        if previous is None:
+            utils.config.remove_option('abkhazia', 'wav-store')
+        else:
+            utils.config.set('abkhazia', 'wav-store', previous)
+        utils.config.remove_option('abkhazia', 'wav-store-link')
+
+
+def _write_extensible_wav(filename, signal, rate, subformat, width):
+    """Write the `signal` (nframes, nbc) as a WAVE_FORMAT_EXTENSIBLE wav"""
+    nbc = signal.shape[1]
+    data = (signal.astype('<f4') if subformat == 0x0003
+            else np.round(signal * 32767).astype('<i2')).tobytes()
+    guid = struct.pack('<H', subformat) + (
+        b'\x00\x00\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71')
+    chunks = (
+        b'fmt ' + struct.pack(
+            '<IHHIIHHHHI', 40, 0xFFFE, nbc, rate, rate * nbc * width,
+            nbc * width, 8 * width, 22, 8 * width, 2 ** nbc - 1) + guid
+        + b'data' + struct.pack('<I', len(data)) + data)
+    with open(filename, 'wb') as stream:
+        stream.write(b'RIFF' + struct.pack('<I', 4 + len(chunks))
+                     + b'WAVE' + chunks)
+
+
+@pytest.mark.parametrize('subformat, width', [(0x0001, 2), (0x0003, 4)])
+def test_convert_extensible(tmpdir, subformat, width):
+    # a WAVE_FORMAT_EXTENSIBLE stereo wav of a 440 Hz sine at 8 kHz
+    signal = 0.5 * np.sin(2 * np.pi * 440 * np.arange(8000) / 8000.)
+    signal = np.repeat(signal[:, None], 2, axis=1)
+    audio = os.path.join(str(tmpdir), 'input.wav')
+    _write_extensible_wav(audio, signal, 8000, subformat, width)
+
+    meta = utils.wav.scan([audio])[audio]
+    assert meta.comptype == ('NONE' if subformat == 1 else '0x0003')
+
+    output = os.path.join(str(tmpdir), 'output.wav')
+    utils.wav.convert([audio], [output], 'wav')
+    meta, offset = utils.wav._parse_header(open(output, 'rb'))
+    assert (meta.nbc, meta.rate, meta.nframes) == (1, 16000, 16000)
+    converted = np.fromfile(output, dtype='<i2', offset=offset) / 32768.
+    expected = 0.5 * np.sin(2 * np.pi * 440 * np.arange(16000) / 16000.)
+    assert np.abs(converted - expected)[100:-100].max() < 0.01
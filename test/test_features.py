@@ -19,6 +19,7 @@ import os
 import pytest
 
 import abkhazia.features as features
+from abkhazia.corpus import Corpus
 import abkhazia.utils as utils
 import abkhazia.kaldi.ark as ark
 from .conftest import assert_no_expr_in_log
@@ -86,3 +87,29 @@ def test_features(pitch, ftype, corpus, tmpdir):
     assert len(times.keys()) == len(subcorpus.utts())
     for t, c in zip(times.keys(), subcorpus.utts()):
         assert t == c
+
+
+def test_export_merged_wavs(corpus, tmpdir):
+    sub = corpus.subcorpus(corpus.utts(), validate=False)
+    for utt in sub.utts():
+        sub.utt2spk[utt] = utt[:5]
+    merged_dir = str(tmpdir.join('merged'))
+    sub.merge_wavs(merged_dir, padding=0.5, virtual=True)
+    merged = Corpus.load(merged_dir)
+
+    # the virtual merged wavs do not exist, they are exported as in
+    # the recipe wav.scp
+    output_dir = str(tmpdir.mkdir('feats'))
+    feat = features.Features(merged, output_dir)
+    feat.a2k.setup_wav()
+    feat.export()
+
+    recipe_scp = os.path.join(
+        output_dir, 'recipe', 'data', feat.name, 'wav.scp')
+    exported = dict(line.strip().split(' ', 1) for line in open(
+        os.path.join(output_dir, 'wav.scp')))
+    assert exported == dict(
+        line.strip().split(' ', 1) for line in open(recipe_scp))
+    assert sorted(exported) == sorted(merged.merged_wavs)
+    for wav, entry in exported.items():
+        assert entry.startswith('sox ') and entry.endswith('|')